@@ -0,0 +1,581 @@
+"""Micro-benchmarks for the interpreter. Run from this directory with `python benchmark.py [name ...]`"""
+import sys
+import time
+from scanner import Scanner
+from parser import Parser
+from settings import *
+from stack import *
+from interpeter import Interpreter
+from module import Module
+
+
+def timeit(fn, repeat=3):
+    """Return the best wall-clock time of `repeat` runs of fn"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+class HeadStack:
+    """The original stack, which keeps its top at index 0 of the list"""
+    def __init__(self):
+        self.stack = []
+    def pop(self):
+        return self.stack.pop(0)
+    def push(self, e):
+        self.stack.insert(0, e)
+
+
+def fillAndDrain(stack, depth):
+    for i in range(depth):
+        stack.push(i)
+    for i in range(depth):
+        stack.pop()
+
+
+def benchStack(depths=(1000, 10000, 50000)):
+    """Push then pop `depth` values on the head-inserting stack and on the operand stack"""
+    print("stack depth  head-insert (s)  operand stack (s)  speedup")
+    for depth in depths:
+        old = timeit(lambda: fillAndDrain(HeadStack(), depth))
+        new = timeit(lambda: fillAndDrain(OperandStack(), depth))
+        print(f"{depth:>11}  {old:>15.4f}  {new:>17.4f}  {old / new:>7.1f}x")
+
+
+def loadModule(path="fib.wat"):
+    with open(path, 'r', encoding='utf-8') as file:
+        return Parser().parse(Scanner().scanTokens(file.read()))
+
+
+# (module, export, argument) workloads: the recursive fib and a loop-heavy sum
+WORKLOADS = (("fib.wat", "fib", 20), ("loop.wat", "sum", 100000))
+
+
+def benchTiers(tiers=("ast", "bytecode", "register", "closure", "jit")):
+    """Run every workload under every execution tier"""
+    for path, name, n in WORKLOADS:
+        ast = loadModule(path)
+        print(f"tier        {name}({n}) (s)")
+        for tier in tiers:
+            interpreter = Interpreter(tier=tier)
+            interpreter.instantiate(ast)
+            elapsed = timeit(lambda: interpreter.callExtern(name, FUNC, n))
+            print(f"{tier:<10}  {elapsed:>14.4f}")
+
+
+def generateModule(count):
+    """Source of a module with `count` functions, each calling the next one by name"""
+    lines = ["(module", "  (type (;0;) (func (param i32) (result i32)))"]
+    for i in range(count):
+        callee = f"call $f{i + 1}" if i + 1 < count else ""
+        lines.append(f"  (func $f{i} (type 0) (param i32) (result i32) local.get 0 {callee})")
+    lines.append('  (export "f0" (func $f0))')
+    lines.append(")")
+    return "\n".join(lines)
+
+
+def benchParser(counts=(1000, 10000, 100000)):
+    """Parse modules of growing size; identifier lookups are O(1), so the time per function stays flat"""
+    print("functions  parse (s)  per function (us)  lookup (us)")
+    for count in counts:
+        source = generateModule(count)
+        tokens = Scanner().scanTokens(source)
+        def parse():
+            tokens.reset()
+            return Parser().parse(tokens)
+        elapsed = timeit(parse, repeat=1)
+        env = parse()['env']
+        lookups = 10000
+        identifier = f"$f{count - 1}"
+        lookup = timeit(lambda: [env.getIdentifierIndex("funcs", identifier) for _ in range(lookups)])
+        print(f"{count:>9}  {elapsed:>9.3f}  {elapsed / count * 1e6:>17.2f}  {lookup / lookups * 1e6:>11.3f}")
+
+
+def benchDepth(depths=(500, 10000, 100000)):
+    """Recurse `depth` calls deep. Tiers that recurse in Python stop at the recursion limit"""
+    ast = loadModule("depth.wat")
+    print(f"depth    {'  '.join(f'{tier:>10}' for tier in ('ast', 'bytecode'))}")
+    for depth in depths:
+        cells = []
+        for tier in ("ast", "bytecode"):
+            interpreter = Interpreter(tier=tier, maxCallDepth=depth + 1)
+            interpreter.instantiate(ast)
+            try:
+                cells.append(f"{timeit(lambda: interpreter.callExtern('depth', FUNC, depth), repeat=1):>9.4f}s")
+            except RecursionError:
+                cells.append(f"{'overflow':>10}")
+        print(f"{depth:<7}  {'  '.join(cells)}")
+
+
+def benchMemo(tiers=("ast", "bytecode", "closure", "jit"), n=20):
+    """fib(n) with and without memoization of pure functions, starting from empty caches"""
+    ast = loadModule()
+    print(f"tier        plain (s)  memoized (s)")
+    for tier in tiers:
+        times = []
+        for memoize in (False, True):
+            def run():
+                interpreter = Interpreter(tier=tier, memoize=memoize)
+                interpreter.instantiate(ast)
+                interpreter.callExtern("fib", FUNC, n)
+            times.append(timeit(run))
+        print(f"{tier:<10}  {times[0]:>9.4f}  {times[1]:>12.4f}")
+
+
+def benchFusion():
+    """Profile each workload, fuse its most frequent sequences and compare against plain bytecode"""
+    from fusion import selectPatterns
+    print("workload       entries  fused  plain (s)  fused (s)")
+    for path, name, n in WORKLOADS:
+        ast = loadModule(path)
+        profiler = Interpreter(tier="bytecode", profileOpcodes=True)
+        profiler.instantiate(ast)
+        profiler.callExtern(name, FUNC, n // 4)
+        patterns = selectPatterns(profiler.opcodeProfile)
+        plain = Interpreter(tier="bytecode")
+        plain.instantiate(ast)
+        fused = Interpreter(tier="bytecode", superinstructions=patterns)
+        fused.instantiate(ast)
+        sizes = [sum(len(f.code) for f in interpreter.funcInstances.values()) for interpreter in (plain, fused)]
+        times = [timeit(lambda: interpreter.callExtern(name, FUNC, n)) for interpreter in (plain, fused)]
+        print(f"{name + f'({n})':<13}  {sizes[0]:>7}  {sizes[1]:>5}  {times[0]:>9.4f}  {times[1]:>9.4f}")
+
+
+# (module, export, arguments) conformance corpus: every tier must agree on every call
+CORPUS = (
+    ("fib.wat", "fib", range(16)),
+    ("loop.wat", "sum", (0, 1, 2, 7, 100, 1000)),
+    ("loop.wat", "count", (0, 1, 2, 7, 100)),
+    ("depth.wat", "depth", (0, 1, 2, 50, 100)),
+    ("branch.wat", "pick", (0, 1, 7)),
+    ("branch.wat", "first", (0, 1, 7)),
+    ("branch.wat", "over", (0, 1, 7)),
+    ("unsigned.wat", "wrap", (0, 1, -1, 5, 1 << 30, (1 << 31) - 1)),
+    ("unsigned.wat", "above", (0, 1, 5, 6, -1, 1 << 30)),
+)
+
+
+def benchRegisters(tiers=("ast", "bytecode", "closure", "jit")):
+    """Check the register tier against the others on the corpus, then compare its size and speed with plain bytecode"""
+    for path, name, arguments in CORPUS:
+        ast = loadModule(path)
+        interpreters = {}
+        for tier in tiers + ("register",):
+            interpreters[tier] = Interpreter(tier=tier)
+            interpreters[tier].instantiate(ast)
+        for n in arguments:
+            results = {tier: interpreter.callExtern(name, FUNC, n) for tier, interpreter in interpreters.items()}
+            if len(set(results.values())) != 1:
+                raise AssertionError(f"{name}({n}) differs between tiers: {results}")
+    print("corpus: all tiers agree")
+    print("workload       bytecode  registers  bytecode (s)  registers (s)")
+    for path, name, n in WORKLOADS:
+        ast = loadModule(path)
+        plain = Interpreter(tier="bytecode")
+        plain.instantiate(ast)
+        registers = Interpreter(tier="register")
+        registers.instantiate(ast)
+        sizes = (sum(len(f.code) for f in plain.funcInstances.values()),
+                 sum(len(f.registers) for f in registers.funcInstances.values()))
+        times = [timeit(lambda: interpreter.callExtern(name, FUNC, n)) for interpreter in (plain, registers)]
+        print(f"{name + f'({n})':<13}  {sizes[0]:>8}  {sizes[1]:>9}  {times[0]:>12.4f}  {times[1]:>13.4f}")
+
+
+def benchOptimizer(tiers=("ast", "bytecode")):
+    """Instructions each optimizer pass removes from a workload, and its effect on the slower tiers"""
+    from optimizer import Optimizer
+    for path, name, n in WORKLOADS:
+        optimizer = Optimizer()
+        ast = loadModule(path)
+        optimized = optimizer.optimize(ast)
+        print(f"{name}: " + ", ".join(f"{passName} -{removed}" for passName, removed in optimizer.stats.items()))
+        for tier in tiers:
+            times = []
+            for module in (ast, optimized):
+                interpreter = Interpreter(tier=tier)
+                interpreter.instantiate(module)
+                times.append(timeit(lambda: interpreter.callExtern(name, FUNC, n)))
+            print(f"  {tier:<10}  plain {times[0]:.4f}s  optimized {times[1]:.4f}s")
+
+
+def benchMemory(tiers=("ast", "bytecode", "register", "closure", "jit"), n=10000):
+    """Store and load back n i32 values of linear memory under every tier"""
+    import tracemalloc
+    from memory import Memory
+    ast = loadModule("memory.wat")
+    print(f"tier        checksum({n}) (s)")
+    for tier in tiers:
+        interpreter = Interpreter(tier=tier)
+        interpreter.instantiate(ast)
+        if interpreter.callExtern("checksum", FUNC, n) != n * (n + 1) // 2:
+            raise AssertionError(f"checksum({n}) is wrong under the {tier} tier")
+        elapsed = timeit(lambda: interpreter.callExtern("checksum", FUNC, n))
+        print(f"{tier:<10}  {elapsed:>18.4f}")
+    tracemalloc.start()
+    memory = Memory(16)
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"16 pages take {allocated / (16 * 65536):.2f} bytes per byte of guest memory")
+
+
+def benchSparse(instances=50, pages=64, n=1000):
+    """Host many instances of a module declaring `pages` pages but touching one, with dense and sparse memory"""
+    import tracemalloc
+    with open("memory.wat", 'r', encoding='utf-8') as file:
+        source = file.read().replace("(memory (;0;) 1)", f"(memory (;0;) {pages})")
+    ast = Parser().parse(Scanner().scanTokens(source))
+    print(f"backend  instances  declared  committed  resident (MiB)  checksum({n}) (s)")
+    for backend in ("dense", "sparse"):
+        tracemalloc.start()
+        interpreters = []
+        for _ in range(instances):
+            interpreter = Interpreter(tier="register", memoryBackend=backend)
+            interpreter.instantiate(ast)
+            interpreter.callExtern("checksum", FUNC, n)
+            interpreters.append(interpreter)
+        resident = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        memory = interpreters[0].memory
+        elapsed = timeit(lambda: interpreters[0].callExtern("checksum", FUNC, n))
+        print(f"{backend:<7}  {instances:>9}  {memory.size():>8}  {memory.committed():>9}  "
+              f"{resident / 2 ** 20:>14.1f}  {elapsed:>16.4f}")
+
+
+def benchViews(megabytes=8):
+    """Move a multi-MB buffer into guest memory per i32 store, with `write` and through a zero-copy view"""
+    from memory import MEMORYBACKENDS, PAGESIZE, I32STORE
+    length = megabytes * 2 ** 20
+    payload = bytes(range(256)) * (length // 256)
+    print(f"backend  per-i32 store (s)  write (s)  view (s)   ({megabytes} MiB)")
+    for backend in ("dense", "mmap"):
+        memory = MEMORYBACKENDS[backend](length // PAGESIZE)
+        store = memory.storer(I32STORE)
+        words = memoryview(payload).cast('I')
+        def perStore():
+            for i in range(len(words)):
+                store(i * 4, words[i])
+        def viaView():
+            view = memory.view(0, length)
+            view[:] = payload
+            view.release()
+        times = [timeit(fn, repeat=1) for fn in (perStore, lambda: memory.write(0, payload), viaView)]
+        if memory.read(0, length) != payload:
+            raise AssertionError(f"{backend} memory lost the payload")
+        print(f"{backend:<7}  {times[0]:>17.4f}  {times[1]:>9.4f}  {times[2]:>8.4f}")
+
+
+def benchArrays(count=1000000):
+    """Exchange `count` int32 values with guest memory per element and as NumPy arrays"""
+    import numpy as np
+    from memory import I32LOAD, I32STORE
+    interpreter = Interpreter(memoryBackend="mmap")
+    with open("memory.wat", 'r', encoding='utf-8') as file:
+        source = file.read().replace("(memory (;0;) 1)", f"(memory (;0;) {count * 4 // 65536 + 1})")
+    interpreter.instantiate(Parser().parse(Scanner().scanTokens(source)))
+    values = np.arange(count, dtype=np.int32)
+    store = interpreter.memory.storer(I32STORE)
+    load = interpreter.memory.loader(I32LOAD)
+    def perElement():
+        for i, value in enumerate(values.tolist()):
+            store(i * 4, value)
+        return sum(load(i * 4) for i in range(count))
+    def viaNumPy():
+        interpreter.writeArray(0, values)
+        return int(interpreter.arrayView(0, count, "int32").sum())
+    results = []
+    times = [timeit(lambda: results.append(fn()), repeat=1) for fn in (perElement, viaNumPy)]
+    if results[0] != results[1]:
+        raise AssertionError("NumPy exchange disagrees with per-element access")
+    print(f"{count} int32  per element {times[0]:.4f}s  numpy {times[1]:.4f}s")
+
+
+def benchHandlers(n=15):
+    """Per-opcode handler timings of the AST walker on fib(n)"""
+    import settings
+    names = {value: name for name, value in vars(settings).items() if isinstance(value, int)}
+    interpreter = Interpreter()
+    interpreter.instantiate(loadModule())
+    interpreter.enableHandlerTiming()
+    interpreter.callExtern("fib", FUNC, n)
+    print("opcode         calls  inclusive (s)")
+    for opcode, (calls, seconds) in sorted(interpreter.handlerTimings.items(), key=lambda item: -item[1][1]):
+        if calls:
+            print(f"{names[opcode]:<12}  {calls:>6}  {seconds:>13.4f}")
+
+
+def repeatCall(fn, count):
+    for _ in range(count):
+        fn()
+
+
+def benchInstantiate(count=1000, tiers=("ast", "bytecode", "register", "closure", "jit")):
+    """Create `count` instances of memory.wat by compiling the module each time and from one compiled `Module`"""
+    ast = loadModule("memory.wat")
+    print("tier      compile+bind (us)  bind only (us)  speedup")
+    for tier in tiers:
+        module = Module(ast, tier)
+        full = timeit(lambda: repeatCall(lambda: Interpreter(tier=tier).instantiate(ast), count)) / count
+        bound = timeit(lambda: repeatCall(module.instantiate, count)) / count
+        if module.instantiate().callExtern("checksum", FUNC, 100) != 5050:
+            raise AssertionError(f"{tier} instance computed a wrong checksum")
+        print(f"{tier:<8}  {full * 1e6:>17.1f}  {bound * 1e6:>14.1f}  {full / bound:>7.1f}x")
+
+
+def initializedModule(pages, stride):
+    """Source of a module with `pages` pages of memory whose start function stores every `stride`-th address at
+    itself, from the top of memory down"""
+    return "\n".join([
+        "(module",
+        "  (type (;0;) (func (param i32) (result i32)))",
+        f"  (memory (;0;) {pages})",
+        "  (func $fill (type 0) (param i32) (result i32)",
+        "    loop",
+        "      local.get 0",
+        f"      i32.const {-stride}",
+        "      i32.add",
+        "      local.tee 0",
+        "      local.get 0",
+        "      i32.store",
+        "      local.get 0",
+        "      br_if 0",
+        "    end",
+        "    local.get 0)",
+        "  (func $init",
+        f"    i32.const {pages * 65536}",
+        "    call $fill",
+        "    drop)",
+        "  (func $get (type 0) (param i32) (result i32)",
+        "    local.get 0",
+        "    i32.load)",
+        "  (start $init)",
+        '  (export "get" (func $get))',
+        ")",
+    ])
+
+
+def benchSnapshot(pages=128, stride=256, count=20, tier="jit"):
+    """Create instances of a module with `pages` pages of memory written by its start function: instantiating it,
+    running the start function each time, against spawning from a snapshot taken after the start function. Sparse
+    and mmap spawns are copy-on-write clones, dense ones copy the memory, which shows in the resident memory each
+    spawned instance adds after one store"""
+    import gc
+    module = Module(Parser().parse(Scanner().scanTokens(initializedModule(pages, stride))), tier)
+    top = pages * 65536 - stride
+    print(f"{pages * 64 // 1024} MiB of memory, written every {stride} bytes by the start function")
+    print("backend  spawn          instantiate (ms)  spawn (ms)  speedup  resident per spawn (KiB)")
+    for backend in ("dense", "sparse", "mmap"):
+        snapshot = module.instantiate(memoryBackend=backend).snapshot()
+        # Measured first, before the timing loops leave freed memory around for the allocator to reuse
+        gc.collect()
+        before = residentKiB()
+        clones = []
+        for _ in range(count):
+            clone = snapshot.spawn()
+            clone.memory.write(0, b"\x01")
+            clones.append(clone)
+        after = residentKiB()
+        resident = f"{(after - before) / count:.0f}" if before is not None else "n/a"
+        if any(clone.exports.get(top) != top or clone.exports.get(stride) != stride for clone in clones):
+            raise AssertionError(f"{backend} spawn does not hold the initialized memory")
+        del clones
+        instantiated = timeit(lambda: repeatCall(lambda: module.instantiate(memoryBackend=backend), count)) / count
+        spawned = timeit(lambda: repeatCall(snapshot.spawn, count)) / count
+        kind = "copy" if backend == "dense" else "copy-on-write"
+        print(f"{backend:<7}  {kind:<13}  {instantiated * 1e3:>16.2f}  {spawned * 1e3:>10.2f}  "
+              f"{instantiated / spawned:>6.1f}x  {resident:>24}")
+
+
+def benchExports(count=100000, tiers=("ast", "bytecode", "register", "closure", "jit")):
+    """Per-call latency of a tiny export, fib(1), through callExtern and through `instance.exports`"""
+    ast = loadModule()
+    print("tier      callExtern (us)  exports (us)  speedup")
+    for tier in tiers:
+        instance = Module(ast, tier).instantiate()
+        fib = instance.exports.fib
+        viaName = timeit(lambda: repeatCall(lambda: instance.callExtern("fib", FUNC, 1), count)) / count
+        bound = timeit(lambda: repeatCall(lambda: fib(1), count)) / count
+        print(f"{tier:<8}  {viaName * 1e6:>15.2f}  {bound * 1e6:>12.2f}  {viaName / bound:>7.1f}x")
+
+
+def benchBatch(count=100000, tiers=("ast", "bytecode", "register", "closure", "jit")):
+    """Calls per second of fib(n % 8) over `count` inputs: callExtern in a loop against invokeMany"""
+    ast = loadModule()
+    inputs = [(n % 8,) for n in range(count)]
+    print("tier      callExtern (calls/s)  invokeMany (calls/s)  invokeMany list (calls/s)")
+    for tier in tiers:
+        instance = Module(ast, tier).instantiate()
+        looped = []
+        batches = []
+        times = (
+            timeit(lambda: looped.append([instance.callExtern("fib", FUNC, *args) for args in inputs]), repeat=1),
+            timeit(lambda: batches.append(list(instance.invokeMany("fib", inputs))), repeat=1),
+            timeit(lambda: batches.append(instance.invokeMany("fib", inputs, asList=True)), repeat=1),
+        )
+        if any(batch != looped[0] for batch in batches):
+            raise AssertionError(f"{tier} batch results differ from callExtern")
+        print(f"{tier:<8}  " + "  ".join(f"{count / t:>{width}.0f}" for t, width in zip(times, (20, 20, 25))))
+
+
+def benchLockstep(count=1000000, tiers=("register", "jit")):
+    """Throughput of f(x) over `count` inputs: lane by lane with invokeMany against invokeVectorized's lockstep mode"""
+    import numpy as np
+    workloads = (("loop.wat", "sum", np.arange(count) % 100), ("unsigned.wat", "above", np.arange(count) - count // 2))
+    print("workload   tier      invokeMany (calls/s)  lockstep (calls/s)  speedup")
+    for path, name, inputs in workloads:
+        ast = loadModule(path)
+        for tier in tiers:
+            instance = Module(ast, tier).instantiate()
+            results = []
+            scalar = timeit(lambda: results.append(instance.invokeMany(name, [(x,) for x in inputs.tolist()], asList=True)), repeat=1)
+            lockstep = timeit(lambda: results.append(instance.invokeVectorized(name, inputs).tolist()), repeat=1)
+            if results[0] != results[1]:
+                raise AssertionError(f"lockstep {name} disagrees with the {tier} tier")
+            print(f"{name:<9}  {tier:<8}  {len(inputs) / scalar:>20.0f}  {len(inputs) / lockstep:>18.0f}  {scalar / lockstep:>7.1f}x")
+
+
+def benchParallel(count=4000, n=12, tier="register", maxWorkers=None):
+    """Scaling of fib(n) over `count` calls with a ParallelRunner of 1 up to `maxWorkers` workers (every available
+    core by default)"""
+    from parallel import ParallelRunner, availableCores
+    with open("fib.wat", 'r', encoding='utf-8') as file:
+        source = file.read()
+    inputs = [(n,)] * count
+    expected = Module(loadModule(), tier).instantiate().invokeMany("fib", inputs, asList=True)
+    serial = timeit(lambda: Module(loadModule(), tier).instantiate().invokeMany("fib", inputs, asList=True), repeat=1)
+    print(f"in process: {count / serial:.0f} calls/s")
+    print("workers  startup (s)  calls/s  speedup")
+    base = None
+    for workers in range(1, (maxWorkers or availableCores()) + 1):
+        start = time.perf_counter()
+        with ParallelRunner(source, tier, workers=workers, chunkSize=64) as runner:
+            # Wait for every worker to be up so startup is timed on its own
+            list(runner.map("fib", [(0,)] * workers * 64))
+            startup = time.perf_counter() - start
+            results = []
+            elapsed = timeit(lambda: results.append(list(runner.map("fib", inputs))), repeat=1)
+        if results[0] != expected:
+            raise AssertionError("parallel results differ from the in-process run")
+        base = base or elapsed
+        print(f"{workers:>7}  {startup:>11.3f}  {count / elapsed:>7.0f}  {base / elapsed:>6.2f}x")
+
+
+def residentKiB(pid="self"):
+    """Resident set size of a process in KiB, read from /proc (Linux only, None elsewhere)"""
+    try:
+        with open(f"/proc/{pid}/status", 'r') as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def benchIsolation(count=4000, n=12, workers=2, tier="register"):
+    """Throughput of fib(n) and resident memory per instance for instances on host threads, in worker processes
+    and in sub-interpreters (when this Python has them)"""
+    import multiprocessing
+    from parallel import ParallelRunner, SubinterpreterRunner, subinterpretersAvailable
+    with open("fib.wat", 'r', encoding='utf-8') as file:
+        source = file.read()
+    inputs = [(n,)] * count
+    expected = Module(loadModule(), tier).instantiate().invokeMany("fib", inputs, asList=True)
+    modes = [("threads", lambda: SubinterpreterRunner(source, tier, workers, isolated=False)),
+             ("processes", lambda: ParallelRunner(source, tier, workers))]
+    if subinterpretersAvailable():
+        modes.append(("subinterpreters", lambda: SubinterpreterRunner(source, tier, workers, isolated=True)))
+    else:
+        print("sub-interpreters need CPython 3.14+, skipped")
+    print("mode             calls/s  KiB per instance")
+    for mode, create in modes:
+        before = residentKiB()
+        with create() as runner:
+            # Start every worker before measuring
+            list(runner.map("fib", [(0,)] * workers * runner.chunkSize))
+            if mode == "processes":
+                used = sum(residentKiB(process.pid) or 0 for process in multiprocessing.active_children())
+            else:
+                used = (residentKiB() or 0) - (before or 0)
+            results = []
+            elapsed = timeit(lambda: results.append(list(runner.map("fib", inputs))), repeat=1)
+        if results[0] != expected:
+            raise AssertionError(f"{mode} results differ from the in-process run")
+        print(f"{mode:<15}  {count / elapsed:>7.0f}  {used / workers:>16.0f}")
+
+
+def benchThreads(threads=8, calls=200, tiers=("ast", "bytecode", "register", "closure", "jit")):
+    """Stress one shared instance per tier with `threads` threads calling fib concurrently, through both
+    callExtern and `exports`, and check every result"""
+    import random
+    import threading
+    fib = [0, 1]
+    while len(fib) < 16:
+        fib.append(fib[-1] + fib[-2])
+    ast = loadModule()
+    # Switch threads as often as possible so unsafe interleavings show up
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        print("tier      memoize  calls   wrong  errors  time (s)")
+        for tier in tiers:
+            for memoize in (False, True):
+                instance = Module(ast, tier, memoize=memoize, cacheSize=4).instantiate()
+                failures = []
+                def worker(seed):
+                    rng = random.Random(seed)
+                    exported = instance.exports.fib
+                    for i in range(calls):
+                        n = rng.randrange(16)
+                        try:
+                            result = exported(n) if i % 2 else instance.callExtern("fib", FUNC, n)
+                        except Exception as error:
+                            failures.append(("error", repr(error)))
+                            continue
+                        if result != fib[n]:
+                            failures.append(("wrong", n, result))
+                workers = [threading.Thread(target=worker, args=(seed,)) for seed in range(threads)]
+                start = time.perf_counter()
+                for thread in workers:
+                    thread.start()
+                for thread in workers:
+                    thread.join()
+                elapsed = time.perf_counter() - start
+                wrong = sum(1 for failure in failures if failure[0] == "wrong")
+                print(f"{tier:<8}  {str(memoize):<7}  {threads * calls:>5}  {wrong:>6}  {len(failures) - wrong:>6}  {elapsed:>8.3f}")
+                if failures:
+                    raise AssertionError(f"concurrent calls on the {tier} tier failed: {failures[:3]}")
+    finally:
+        sys.setswitchinterval(interval)
+
+
+BENCHMARKS = {
+    "stack": benchStack,
+    "tiers": benchTiers,
+    "handlers": benchHandlers,
+    "parser": benchParser,
+    "depth": benchDepth,
+    "memo": benchMemo,
+    "fusion": benchFusion,
+    "registers": benchRegisters,
+    "optimizer": benchOptimizer,
+    "memory": benchMemory,
+    "sparse": benchSparse,
+    "views": benchViews,
+    "arrays": benchArrays,
+    "instantiate": benchInstantiate,
+    "snapshot": benchSnapshot,
+    "exports": benchExports,
+    "batch": benchBatch,
+    "lockstep": benchLockstep,
+    "parallel": benchParallel,
+    "isolation": benchIsolation,
+    "threads": benchThreads,
+}
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
@@ -0,0 +1,29 @@
+(module
+  (type (;0;) (func (param i32) (result i32)))
+  (func $pick (type 0) (param i32) (result i32)
+    i32.const 5  ;; returned by the branch to the function body when the argument is not zero
+    local.get 0
+    br_if 0
+    drop
+    i32.const 9)
+  (func $first (type 0) (param i32) (result i32)
+    block  ;; label = @1 - return 7 from inside a block when the argument is not zero
+      i32.const 7
+      local.get 0
+      br_if 1
+      drop
+    end
+    local.get 0
+    i32.const 1
+    i32.add
+    br 0)
+  (func $over (type 0) (param i32) (result i32)
+    local.get 0  ;; left below the result when branching to the function body
+    i32.const 3
+    local.get 0
+    br_if 0
+    i32.sub)
+  (export "pick" (func $pick))
+  (export "first" (func $first))
+  (export "over" (func $over))
+)
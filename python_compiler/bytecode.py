@@ -0,0 +1,179 @@
+"""Lowers the nested instruction dictionaries produced by `Parser.parseFunc` into flat bytecode.
+Every entry is an (opcode, immediate) pair. Structured control instructions disappear: `br`/`br_if`
+carry the absolute position they jump to (a block's end or a loop's head), together with the operand
+stack height to unwind to and the number of values the branch keeps."""
+from settings import *
+from env import FrameTemplate
+
+# Net operand stack effect of the plain instructions
+STACKEFFECTS = {
+    LOCALGET: 1, LOCALSET: -1, LOCALTEE: 0, CONST: 1, DROP: -1,
+    ADD: -1, SUB: -1, AND: -1, OR: -1, EQ: -1, GE_S: -1, GT_U: -1, LT_S: -1, EQZ: 0,
+    MEMORYSIZE: 1, MEMORYGROW: 0,
+}
+# Loads replace the address with the value, stores pop the address and the value
+STACKEFFECTS.update({op: 0 for op in LOADS})
+STACKEFFECTS.update({op: -2 for op in STORES})
+
+
+class Code:
+    """Flat bytecode for a single function"""
+    __slots__ = ('entries', 'heights', 'localCount', 'paramCount', 'returnArity', 'defaults')
+
+    def __init__(self, entries, heights, localCount, paramCount, returnArity, defaults):
+        self.entries = entries
+        # Static operand stack height before each entry
+        self.heights = heights
+        self.localCount = localCount
+        self.paramCount = paramCount
+        self.returnArity = returnArity
+        # Zero values of the locals that are not parameters (see `env.FrameTemplate`)
+        self.defaults = defaults
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class ControlEntry:
+    """A structured control instruction that is open while lowering"""
+    __slots__ = ('type', 'height', 'arity', 'head', 'fixups')
+
+    def __init__(self, type, height, arity, head):
+        self.type = type # BLOCK, LOOP
+        self.height = height
+        self.arity = arity
+        self.head = head
+        # Positions of the branches that jump to the (not yet known) end of a block
+        self.fixups = []
+
+
+class Lowering:
+    """Lowers the body of one function"""
+
+    def __init__(self, frame, signatures, env):
+        self.frame = frame
+        self.signatures = signatures
+        self.env = env
+        self.entries = []
+        self.heights = []
+        self.controls = []
+        self.height = 0
+
+    def lower(self, instructions):
+        # The body is the outermost label: branching to it jumps to the return at its end, carrying the results
+        body = ControlEntry(BLOCK, 0, self.frame.returnArity(), 0)
+        self.controls.append(body)
+        self.lowerSequence(instructions)
+        self.controls.pop()
+        self.height = body.arity
+        for position in body.fixups:
+            self.entries[position][1] = (len(self.entries), body.height, body.arity)
+        # Falling off the end of the body returns from the function
+        self.append(RETURN, None)
+        return [tuple(entry) for entry in self.entries]
+
+    def append(self, type, immediate):
+        self.heights.append(self.height)
+        self.entries.append([type, immediate])
+
+    def lowerSequence(self, instructions):
+        """Lower an instruction sequence. Everything after an unconditional branch is unreachable and skipped"""
+        for instruction in instructions:
+            if not self.lowerInstruction(instruction):
+                return False
+        return True
+
+    def lowerInstruction(self, instruction):
+        """
+            False -> the rest of the sequence is unreachable
+            True -> continue lowering
+        """
+        type = instruction['type']
+        if type == BLOCK or type == LOOP:
+            control = ControlEntry(type, self.height, 0, len(self.entries))
+            self.controls.append(control)
+            self.lowerSequence(instruction['instructions'])
+            self.controls.pop()
+            # The operands of the construct are replaced by its results
+            self.height = control.height + control.arity
+            for position in control.fixups:
+                self.entries[position][1] = (len(self.entries), control.height, control.arity)
+            return True
+        elif type == BR:
+            self.lowerBranch(BR, int(instruction['operand']))
+            return False
+        elif type == BR_IF:
+            self.lowerBranch(BR_IF, int(instruction['operand']))
+            self.height -= 1
+            return True
+        elif type == RETURN:
+            self.append(RETURN, None)
+            return False
+        elif type == CALL:
+            funcidx = self.env.getIdentifierIndex("funcs", instruction['operand'])
+            frame = self.signatures[funcidx]
+            self.append(CALL, funcidx)
+            self.height += frame.returnArity() - frame.argArity()
+            return True
+        elif type in (LOCALGET, LOCALSET, LOCALTEE):
+            self.append(type, localIndex(self.frame, instruction['operand']))
+        elif type == CONST:
+            self.append(CONST, int(instruction['operand']))
+        elif type in LOADS or type in STORES:
+            # The static offset; linking binds the entry to an accessor of the instance's memory
+            self.append(type, instruction['operand']['offset'])
+        elif type in STACKEFFECTS:
+            self.append(type, None)
+        else:
+            raise ValueError("Unsupported instruction in bytecode lowering.")
+        self.height += STACKEFFECTS[type]
+        return True
+
+    def lowerBranch(self, type, depth):
+        target = self.controls[-1 - depth]
+        if target.type == LOOP:
+            # Branching to a loop jumps back to its head and carries the loop's parameters (none for now)
+            self.append(type, (target.head, target.height, 0))
+        else:
+            target.fixups.append(len(self.entries))
+            self.append(type, None)
+
+
+def toUnsigned(value):
+    """The low 32 bits of an i32 as an unsigned integer. Additions and subtractions do not wrap, so every tier
+    reduces the operands of unsigned comparisons with this. Also works on NumPy integer arrays"""
+    return value & 0xFFFFFFFF
+
+
+def localIndex(frame, operand):
+    """Resolve a local given either as an index or as a `$identifier`"""
+    if isinstance(operand, str) and operand.startswith('$'):
+        for index, local in frame.locals.items():
+            if local['id'] == operand: return index
+    return int(operand)
+
+
+def moduleSignatures(ast):
+    """Map every function index (imported or defined) to the frame holding its signature"""
+    signatures = {}
+    for field in ast['fields']:
+        if field['type'] == FUNC:
+            signatures[field['id']] = field['frame']
+        elif field['type'] == IMPORT and field['importDesc']['type'] == TYPEUSE:
+            signatures[field['importDesc']['id']] = field['importDesc']['env']
+    return signatures
+
+
+def lowerFunc(field, signatures, env):
+    """Lower one FUNC field of the AST"""
+    frame = field['frame']
+    lowering = Lowering(frame, signatures, env)
+    entries = lowering.lower(field['instr'])
+    return Code(entries, lowering.heights, len(frame.locals), frame.argArity(), frame.returnArity(),
+                FrameTemplate(frame).defaults)
+
+
+def compileModule(ast):
+    """Compile step run after `Parser.parse`: returns the bytecode of every function keyed by function index"""
+    signatures = moduleSignatures(ast)
+    return {field['id']: lowerFunc(field, signatures, ast['env']) for field in ast['fields'] if field['type'] == FUNC}
@@ -0,0 +1,231 @@
+"""Compiles function bodies into trees of pre-bound Python closures. Every instruction becomes a closure
+`step(locals, stack, instance)` with its immediates already bound, and every block or loop becomes a closure running
+its children, so execution never looks at `instruction['type']` again.
+
+The tree is compiled once per `module.Module` and shared by its instances. Only the steps touching instance state
+use `instance`, the running interpreter: loads and stores call its accessor of the linked index, and calls to
+memoized functions consult its result cache.
+
+A step returns None to continue, the relative depth of a pending branch, or RETURNING for a pending return."""
+from settings import *
+from bytecode import localIndex, toUnsigned
+from purity import callMemoized
+
+RETURNING = -1
+
+
+class ClosureFunction:
+    """A function whose body has been compiled into closures"""
+    __slots__ = ('id', 'body', 'defaults', 'paramCount', 'returnArity', 'memoized')
+
+    def __init__(self, function):
+        template = function.template
+        self.id = function.id
+        self.body = None
+        # Pure functions with memoization enabled look up the result cache of the calling instance
+        self.memoized = function.memoized
+        self.defaults = template.defaults
+        self.paramCount = template.paramCount
+        self.returnArity = template.returnArity
+
+    def __call__(self, stack, instance):
+        """Call the function for `instance` with its arguments on top of `stack` (the list backing the operand stack)"""
+        if self.memoized:
+            return callMemoized(instance.caches[self.id], stack, self.paramCount, self.returnArity,
+                                lambda: self.invoke(stack, instance))
+        self.invoke(stack, instance)
+
+    def call(self, args, instance):
+        """Call the function with a sequence of arguments on a stack of its own, returning the list of its results"""
+        stack = list(args)
+        self(stack, instance)
+        return stack
+
+    def invoke(self, stack, instance):
+        base = len(stack) - self.paramCount
+        # Parameters are the first locals, the remaining locals start at their zero value
+        locals = stack[base:]
+        del stack[base:]
+        locals.extend(self.defaults)
+        self.body(locals, stack, instance)
+        # Keep the return values and drop everything else the function left on the stack
+        unwind(stack, base, self.returnArity)
+
+
+def unwind(stack, height, arity):
+    if len(stack) == height + arity:
+        return
+    if arity:
+        results = stack[-arity:]
+        del stack[height:]
+        stack.extend(results)
+    else:
+        del stack[height:]
+
+
+def compileSequence(instructions, functions, frame):
+    """Compile an instruction sequence into a list of steps"""
+    return [compileInstruction(instruction, functions, frame) for instruction in instructions]
+
+
+def compileBody(instructions, functions, frame):
+    steps = compileSequence(instructions, functions, frame)
+    def body(locals, stack, instance):
+        for step in steps:
+            signal = step(locals, stack, instance)
+            if signal is not None:
+                return signal
+    return body
+
+
+def compileBlock(instructions, functions, frame):
+    steps = compileSequence(instructions, functions, frame)
+    def block(locals, stack, instance):
+        height = len(stack)
+        for step in steps:
+            signal = step(locals, stack, instance)
+            if signal is not None:
+                # The branch targets this block: continue after its end
+                if signal == 0:
+                    unwind(stack, height, 0)
+                    return None
+                # A return or a branch to an enclosing label keeps unwinding
+                return signal if signal == RETURNING else signal - 1
+    return block
+
+
+def compileLoop(instructions, functions, frame):
+    steps = compileSequence(instructions, functions, frame)
+    def loop(locals, stack, instance):
+        height = len(stack)
+        while True:
+            for step in steps:
+                signal = step(locals, stack, instance)
+                if signal is not None:
+                    break
+            else:
+                # Falling off the end of a loop leaves it
+                return None
+            # The branch targets this loop: jump back to its head
+            if signal == 0:
+                unwind(stack, height, 0)
+                continue
+            return signal if signal == RETURNING else signal - 1
+    return loop
+
+
+def compileInstruction(instruction, functions, frame):
+    type = instruction['type']
+    if type == BLOCK:
+        return compileBlock(instruction['instructions'], functions, frame)
+    elif type == LOOP:
+        return compileLoop(instruction['instructions'], functions, frame)
+    elif type == LOCALGET:
+        index = localIndex(frame, instruction['operand'])
+        def localGet(locals, stack, instance):
+            stack.append(locals[index])
+        return localGet
+    elif type == LOCALSET:
+        index = localIndex(frame, instruction['operand'])
+        def localSet(locals, stack, instance):
+            locals[index] = stack.pop()
+        return localSet
+    elif type == LOCALTEE:
+        index = localIndex(frame, instruction['operand'])
+        def localTee(locals, stack, instance):
+            locals[index] = stack[-1]
+        return localTee
+    elif type == CONST:
+        value = int(instruction['operand'])
+        def const(locals, stack, instance):
+            stack.append(value)
+        return const
+    elif type == CALL:
+        # Linking replaced the operand with the callee's function instance
+        callee = functions[instruction['operand'].id]
+        def call(locals, stack, instance):
+            callee(stack, instance)
+        return call
+    elif type == BR:
+        depth = int(instruction['operand'])
+        def br(locals, stack, instance):
+            return depth
+        return br
+    elif type == BR_IF:
+        depth = int(instruction['operand'])
+        def brIf(locals, stack, instance):
+            if stack.pop() != 0:
+                return depth
+        return brIf
+    elif type == RETURN:
+        def ret(locals, stack, instance):
+            return RETURNING
+        return ret
+    elif type in LOADS or type in STORES:
+        # Linking gave the instruction the index of the accessor each instance binds to its memory
+        access = instruction['access']
+        if type in LOADS:
+            def loadStep(locals, stack, instance):
+                stack[-1] = instance.accessors[access](stack[-1])
+            return loadStep
+        def storeStep(locals, stack, instance):
+            value = stack.pop()
+            instance.accessors[access](stack.pop(), value)
+        return storeStep
+    elif type == MEMORYSIZE:
+        def memorySize(locals, stack, instance):
+            stack.append(instance.memory.size())
+        return memorySize
+    elif type == MEMORYGROW:
+        def memoryGrow(locals, stack, instance):
+            stack[-1] = instance.memory.grow(stack[-1])
+        return memoryGrow
+    elif type in BINARYOPS:
+        return BINARYOPS[type]
+    elif type == EQZ:
+        return eqz
+    elif type == DROP:
+        return drop
+    raise ValueError("Unsupported instruction in closure compilation.")
+
+
+def add(locals, stack, instance):
+    second = stack.pop()
+    stack[-1] += second
+def sub(locals, stack, instance):
+    second = stack.pop()
+    stack[-1] -= second
+def geS(locals, stack, instance):
+    second = stack.pop()
+    stack[-1] = int(stack[-1] >= second)
+def gtU(locals, stack, instance):
+    second = toUnsigned(stack.pop())
+    stack[-1] = int(toUnsigned(stack[-1]) > second)
+def ltS(locals, stack, instance):
+    second = stack.pop()
+    stack[-1] = int(stack[-1] < second)
+def eq(locals, stack, instance):
+    second = stack.pop()
+    stack[-1] = int(stack[-1] == second)
+def or_(locals, stack, instance):
+    second = stack.pop()
+    stack[-1] = int(stack[-1] or second)
+def and_(locals, stack, instance):
+    second = stack.pop()
+    stack[-1] = stack[-1] & second
+def eqz(locals, stack, instance):
+    stack[-1] = int(stack[-1] == 0)
+def drop(locals, stack, instance):
+    stack.pop()
+
+BINARYOPS = {ADD: add, SUB: sub, GE_S: geS, GT_U: gtU, LT_S: ltS, EQ: eq, OR: or_, AND: and_}
+
+
+def compileModule(functions):
+    """Compile the linked function instances of a module (see `module.Module.link`) into closures, keyed by function
+    index"""
+    # Create every function first so calls, including recursive ones, can be bound directly to their callee
+    compiled = {funcidx: ClosureFunction(function) for funcidx, function in functions.items()}
+    for funcidx, function in functions.items():
+        compiled[funcidx].body = compileBody(function.instr, compiled, function.field['frame'])
+    return compiled
@@ -0,0 +1,17 @@
+(module
+  (type (;0;) (func (param i32) (result i32)))
+  (func $depth (type 0) (param i32) (result i32)
+    block  ;; label = @1 - recurse while the argument is not zero
+      local.get 0
+      br_if 0 (;@1;)
+      i32.const 0
+      return
+    end
+    local.get 0
+    i32.const -1
+    i32.add
+    call $depth
+    i32.const 1
+    i32.add)
+  (export "depth" (func $depth))
+)
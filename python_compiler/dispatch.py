@@ -0,0 +1,36 @@
+import time
+
+
+class OpcodeRegistry:
+    """Maps the integer opcodes from `settings.py` to the handlers that interpret them.
+    Dispatch is a single dictionary lookup, so it costs the same for every opcode however many are registered"""
+
+    def __init__(self):
+        self.handlers = {}
+
+    def register(self, *opcodes):
+        """Decorator registering a handler for one or more opcodes"""
+        def decorator(handler):
+            for opcode in opcodes:
+                if opcode in self.handlers:
+                    raise ValueError("Opcode already has a handler.")
+                self.handlers[opcode] = handler
+            return handler
+        return decorator
+
+    def timed(self, timings):
+        """Return a copy of the handler table whose handlers add their call count and elapsed
+        time to `timings`, a dictionary of opcode -> [calls, seconds]"""
+        return {opcode: timeHandler(opcode, handler, timings) for opcode, handler in self.handlers.items()}
+
+
+def timeHandler(opcode, handler, timings):
+    perfCounter = time.perf_counter
+    entry = timings.setdefault(opcode, [0, 0.0])
+    def timedHandler(interpreter, instruction, frame):
+        start = perfCounter()
+        result = handler(interpreter, instruction, frame)
+        entry[0] += 1
+        entry[1] += perfCounter() - start
+        return result
+    return timedHandler
@@ -1,9 +1,15 @@
 from settings import *
 
+class Trap(Exception):
+    """Immediately aborts execution. Traps cannot be handled by WebAssembly code and are reported to the embedder"""
+
+
 class Env:
     """Definitions are referenced with zero-based indices. Each class of definitions has its own index space, as distinguished
     by the following classes"""
 
+    SPACES = ("types", "funcs", "tables", "mems", "globals", "elems", "data", "typedefs")
+
     def __init__(self):
         # Unnamed indices are associated with the empty (\epsilon) entries in these lists
         self.types = {}
@@ -14,36 +20,33 @@ class Env:
         self.elems = {}
         self.data = {}
         self.typedefs = {}
+        # index -> identifier for every space, and the inverse identifier -> index maps
+        self.spaces = {space: getattr(self, space) for space in self.SPACES}
+        self.indices = {space: {} for space in self.SPACES}
 
     def _getContext(self, space):
-        if space == "types":
-            return self.types
-        elif space == "funcs":
-            return self.funcs
-        elif space == "tables":
-            return self.tables
-        elif space == "mems":
-            return self.mems
-        elif space == "globals":
-            return self.globals
-        elif space == "data":
-            return self.data
-        elif space == "elems":
-            return self.elems
-        elif space == "typedefs":
-            return self.typedefs
+        return self.spaces[space]
 
     def getIdentifierIndex(self, space, identifier):
         """Returns the index corresponding to the identifier"""
         if isinstance(identifier, str):
-            for index,iteratedIdentifier in self._getContext(space).items():
-                if iteratedIdentifier == identifier: return index
+            return self.indices[space].get(identifier)
         elif isinstance(identifier, int):
             return identifier
+    def getIdentifier(self, space, index):
+        """Returns the identifier bound to the index, or None for an unnamed index"""
+        return self.spaces[space].get(index)
     def addIdentifierIndex(self, space, identifier):
         """Add index corresponding to the identifier"""
-        index = len(self._getContext(space))
-        self._getContext(space)[index] = identifier
+        context = self.spaces[space]
+        index = len(context)
+        if identifier is not None:
+            indices = self.indices[space]
+            # An identifier context is only well-formed if no index space contains duplicate identifiers
+            if identifier in indices:
+                raise ValueError("Duplicate identifier.")
+            indices[identifier] = index
+        context[index] = identifier
         return index
 
 class Frame:
@@ -62,7 +65,8 @@ class Frame:
     def setLocalValue(self, value, index):
         self.locals[index]['value'] = value
     def getLocal(self, index):
-        return self.locals[index]['value']
+        # Locals that were never set hold their zero default
+        return self.locals[index].get('value', 0)
     def addArg(self, arg):
         index = len(self.args)
         self.args[index] = arg
@@ -70,14 +74,65 @@ class Frame:
         self.returns.append(valtype)
     def argArity(self):
         return len(self.args)
-    
+
+class FrameTemplate:
+    """The shape of a function's frame, computed once at instantiate time and never modified afterwards.
+    Activating it only allocates the flat list of local values."""
+    __slots__ = ('localCount', 'paramCount', 'returnArity', 'defaults')
+
+    def __init__(self, frame):
+        self.localCount = len(frame.locals)
+        self.paramCount = frame.argArity()
+        self.returnArity = frame.returnArity()
+        # Zero values of the locals that are not parameters
+        self.defaults = [0.0 if frame.locals[i]['type'] in (F32, F64) else 0 for i in range(self.paramCount, self.localCount)]
+
+    def activate(self, args):
+        """Create the activation of a call whose arguments are the list `args`"""
+        return Activation(args + self.defaults)
+
+class FuncInstance:
+    """A function of a compiled module, shared by all its instances. Call sites are linked directly to it, so a call
+    needs no lookups"""
+    __slots__ = ('id', 'field', 'template', 'instr', 'code', 'registers', 'memoized')
+
+    def __init__(self, field):
+        self.id = field['id']
+        self.field = field
+        self.template = FrameTemplate(field['frame'])
+        # The instructions with their call operands linked, filled in by `Module.link`
+        self.instr = field['instr']
+        # The function's bytecode or register IR, depending on the execution tier
+        self.code = None
+        self.registers = None
+        # Whether the function is pure and memoization is enabled; the result caches belong to the instances
+        self.memoized = False
+
+class Activation:
+    """The frame of a single function call"""
+    __slots__ = ('locals', 'height', 'branchDepth')
+
+    def __init__(self, locals):
+        self.locals = locals
+        # Height of the operand stack when the frame was activated
+        self.height = 0
+        # Number of labels left to exit for a pending branch; None for a pending return
+        self.branchDepth = None
+
+    def setLocalValue(self, value, index):
+        self.locals[index] = value
+    def getLocal(self, index):
+        return self.locals[index]
+
 
 class Label:
-    def __init__(self, instructions, argumentArity, index, type):
+    def __init__(self, instructions, argumentArity, index, type, height=0):
         self.instructions = instructions
         self.argumentArity = argumentArity
         self.index = index
         self.type = type # BLOCK, LOOP
+        # Height of the operand stack when the label was entered
+        self.height = height
         self.continuation = []
         # If it is of type loop, then the continuation is all instructions leading up to the branch instruction
         if self.type == LOOP:
@@ -0,0 +1,148 @@
+"""Superinstruction fusion for flat bytecode. Frequent opcode sequences are rewritten into a single fused entry,
+so the interpreter loop dispatches once instead of once per entry.
+
+The fused set is chosen from data: run a workload with `Interpreter(profileOpcodes=True)`, which counts opcode
+bigrams and trigrams in an `OpcodeProfile`, then pass `selectPatterns(profile)` to `Interpreter(superinstructions=...)`."""
+import copy
+from collections import Counter
+from settings import *
+
+# Every sequence the interpreter loop has a fused handler for, mapped to its fused opcode and to a function
+# building the fused immediate from the immediates of the sequence
+SUPERINSTRUCTIONS = {
+    (LOCALGET, CONST, ADD): (LOCALGET_CONST_ADD, lambda imms: (imms[0], imms[1])),
+    (LOCALGET, LOCALGET, ADD): (LOCALGET_LOCALGET_ADD, lambda imms: (imms[0], imms[1])),
+    (LOCALGET, ADD, LOCALSET): (LOCALGET_ADD_LOCALSET, lambda imms: (imms[0], imms[2])),
+    (LOCALGET, CONST): (LOCALGET_CONST, lambda imms: (imms[0], imms[1])),
+    (LOCALGET, LOCALGET): (LOCALGET_LOCALGET, lambda imms: (imms[0], imms[1])),
+    (LOCALGET, ADD): (LOCALGET_ADD, lambda imms: imms[0]),
+    (CONST, ADD): (CONST_ADD, lambda imms: imms[0]),
+    (ADD, LOCALSET): (ADD_LOCALSET, lambda imms: imms[1]),
+    (LOCALTEE, LOCALSET): (LOCALTEE_LOCALSET, lambda imms: (imms[0], imms[1])),
+    (LOCALGET, BR_IF): (LOCALGET_BR_IF, lambda imms: (imms[0], imms[1])),
+    (GE_S, BR_IF): (GE_S_BR_IF, lambda imms: imms[1]),
+    (LT_S, BR_IF): (LT_S_BR_IF, lambda imms: imms[1]),
+    (EQZ, BR_IF): (EQZ_BR_IF, lambda imms: imms[1]),
+}
+
+# Fused opcodes whose immediate holds a branch target, and where in the immediate it is (None: the immediate itself)
+BRANCHING = {BR: None, BR_IF: None, LOCALGET_BR_IF: 1, GE_S_BR_IF: None, LT_S_BR_IF: None, EQZ_BR_IF: None}
+
+
+class OpcodeProfile:
+    """Counts the opcode bigrams and trigrams executed by the bytecode tier"""
+
+    def __init__(self):
+        self.bigrams = Counter()
+        self.trigrams = Counter()
+        self.previous = None
+        self.beforePrevious = None
+
+    def record(self, op):
+        if self.previous is not None:
+            self.bigrams[(self.previous, op)] += 1
+            if self.beforePrevious is not None:
+                self.trigrams[(self.beforePrevious, self.previous, op)] += 1
+        self.beforePrevious = self.previous
+        self.previous = op
+
+    def mostCommon(self, n=10):
+        """The n most frequent bigrams and trigrams, most frequent first"""
+        return (self.bigrams + self.trigrams).most_common(n)
+
+
+class ProfiledEntries(list):
+    """Bytecode entries recording the opcode of every entry fetched from them in an `OpcodeProfile`"""
+    __slots__ = ('profile',)
+
+    def __init__(self, entries, profile):
+        super().__init__(entries)
+        self.profile = profile
+
+    def __getitem__(self, pc):
+        entry = list.__getitem__(self, pc)
+        self.profile.record(entry[0])
+        return entry
+
+
+def profileCode(functions, profile):
+    """Copies of the bytecode of `functions` (funcidx -> linked `env.FuncInstance`) whose entries record what they
+    execute in `profile`, keyed by the original code. Calls are linked to the copies, so callees are profiled too"""
+    copies = {}
+    for funcidx, function in functions.items():
+        copies[funcidx] = copy.copy(function)
+        copies[funcidx].code = copy.copy(function.code)
+    for function in copies.values():
+        entries = [(op, copies[imm.id]) if op == CALL else (op, imm) for op, imm in function.code.entries]
+        function.code.entries = ProfiledEntries(entries, profile)
+    return {functions[funcidx].code: function.code for funcidx, function in copies.items()}
+
+
+def selectPatterns(profile, limit=8):
+    """Pick the `limit` most frequently executed sequences that have a fused handler"""
+    counts = profile.bigrams + profile.trigrams
+    candidates = [pattern for pattern in SUPERINSTRUCTIONS if counts[pattern] > 0]
+    candidates.sort(key=lambda pattern: (-counts[pattern], -len(pattern)))
+    return candidates[:limit]
+
+
+def branchTargets(entries):
+    """Positions that some branch jumps to"""
+    targets = set()
+    for op, imm in entries:
+        if op in BRANCHING:
+            targets.add(branchImmediate(op, imm)[0])
+    return targets
+
+
+def branchImmediate(op, imm):
+    index = BRANCHING[op]
+    return imm if index is None else imm[index]
+
+
+def replaceBranchImmediate(op, imm, branch):
+    index = BRANCHING[op]
+    if index is None:
+        return branch
+    return imm[:index] + (branch,) + imm[index + 1:]
+
+
+def fuse(code, patterns):
+    """Rewrite a function's bytecode in place, replacing occurrences of `patterns` with superinstructions.
+    A sequence is only fused when no branch jumps into its middle. Returns the number of entries removed"""
+    if not patterns:
+        return 0
+    # Try longer sequences first so a trigram is not shadowed by its leading bigram
+    patterns = sorted(patterns, key=len, reverse=True)
+    entries = code.entries
+    targets = branchTargets(entries)
+    fused = []
+    heights = []
+    positions = {}
+    pc = 0
+    while pc < len(entries):
+        positions[pc] = len(fused)
+        heights.append(code.heights[pc])
+        for pattern in patterns:
+            end = pc + len(pattern)
+            if end > len(entries) or tuple(op for op, imm in entries[pc:end]) != pattern:
+                continue
+            if any(position in targets for position in range(pc + 1, end)):
+                continue
+            fusedOp, immediate = SUPERINSTRUCTIONS[pattern]
+            fused.append((fusedOp, immediate([imm for op, imm in entries[pc:end]])))
+            pc = end
+            break
+        else:
+            fused.append(entries[pc])
+            pc += 1
+    positions[pc] = len(fused)
+    # Branch targets move with the entries they point at
+    for i, (op, imm) in enumerate(fused):
+        if op in BRANCHING:
+            target, height, arity = branchImmediate(op, imm)
+            fused[i] = (op, replaceBranchImmediate(op, imm, (positions[target], height, arity)))
+    removed = len(entries) - len(fused)
+    code.entries = fused
+    code.heights = heights
+    return removed
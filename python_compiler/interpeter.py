@@ -1,6 +1,14 @@
+import copy
+import threading
 from settings import *
 from env import *
-import copy
+from stack import *
+from dispatch import OpcodeRegistry
+from fusion import OpcodeProfile, profileCode
+from purity import MISSING, ResultCache, callMemoized, memoizeCompiled, memoizeResults
+from memory import MEMORYBACKENDS, numpy
+from module import Module
+from bytecode import toUnsigned
 """
 def constructStore():
     return {"funcAddr": [], "tableAddr": [], "memAddr": [], "globalAddr": [], "elemAddr": [], "dataAddr": [], "externAddr": []}
@@ -19,194 +27,859 @@ def constructTableInstance(type):
 def constructActivationFrame(returnArity, locals, moduleInstanceRef):
     return {"returnArity": returnArity, "locals": locals, "moduleInstanceRef": moduleInstanceRef}
 """
-class Stack:
-    """Stores elements that are processed in LIFO fashion (Last-In First-Out)"""
-    def __init__(self):
-        self.stack = []
-    def peek(self):
-        return self.stack[0]
-    def pop(self):
-        return self.stack.pop(0)
-    def push(self,e):
-        self.stack.insert(0,e)
-    def search(self, e):
-        if e in self.stack: return e
-        return None
-    def empty(self):
-        if self.stack == []:
-            return True
-        return False
+# Handlers of the AST walker. Each takes the interpreter, the instruction and the current frame and returns
+# True to stay in the current instruction sequence or False to leave it
+HANDLERS = OpcodeRegistry()
+
+@HANDLERS.register(BLOCK)
+def interpretBlock(self, instruction, frame):
+    # Instatiate label object
+    label = Label(instruction["instructions"], 0, 0, BLOCK, self.stack.height())
+    # Enter constroled instruction sequence
+    return self.interpretStructuredControlInstructions(frame, label)
+
+@HANDLERS.register(LOOP)
+def interpretLoop(self, instruction, frame):
+    # Instatiate label object
+    label = Label(instruction["instructions"], 0, 0, LOOP, self.stack.height())
+    # Enter constroled instruction sequence. 
+    # If it returns false, then exit out of the instruction sequence
+    return self.interpretStructuredControlInstructions(frame, label)
+
+@HANDLERS.register(LOCALGET)
+def interpretLocalGet(self, instruction, frame):
+    self.stack.push(frame.getLocal(int(instruction['operand'])))
+    return True
+
+@HANDLERS.register(LOCALSET)
+def interpretLocalSet(self, instruction, frame):
+    frame.setLocalValue(self.stack.pop(), int(instruction['operand']))
+    return True
+
+@HANDLERS.register(LOCALTEE)
+def interpretLocalTee(self, instruction, frame):
+    frame.setLocalValue(self.stack.peek(), int(instruction['operand']))
+    return True
+
+@HANDLERS.register(CALL)
+def interpretCall(self, instruction, frame):
+    # The operand was linked to the callee's function instance at instantiate time
+    self.callFunc(instruction['operand'])
+    return True
+
+@HANDLERS.register(CONST)
+def interpretConst(self, instruction, frame):
+    self.stack.push(int(instruction['operand']))
+    return True
+
+@HANDLERS.register(ADD)
+def interpretAdd(self, instruction, frame):
+    self.stack.push(self.stack.pop() + self.stack.pop())
+    return True
+
+@HANDLERS.register(SUB)
+def interpretSub(self, instruction, frame):
+    second = self.stack.pop()
+    first = self.stack.pop()
+    self.stack.push(first - second)
+    return True
+
+@HANDLERS.register(GE_S)
+def interpretGeS(self, instruction, frame):
+    second = self.stack.pop()
+    first = self.stack.pop()
+    self.stack.push(int(first >= second))
+    return True
+
+@HANDLERS.register(GT_U)
+def interpretGtU(self, instruction, frame):
+    second = self.stack.pop()
+    first = self.stack.pop()
+    self.stack.push(int(toUnsigned(first) > toUnsigned(second)))
+    return True
+
+@HANDLERS.register(LT_S)
+def interpretLtS(self, instruction, frame):
+    second = self.stack.pop()
+    first = self.stack.pop()
+    self.stack.push(int(first < second))
+    return True
+
+@HANDLERS.register(EQZ)
+def interpretEqz(self, instruction, frame):
+    self.stack.push(int(self.stack.pop() == 0))
+    return True
+
+@HANDLERS.register(EQ)
+def interpretEq(self, instruction, frame):
+    self.stack.push(int(self.stack.pop() == self.stack.pop()))
+    return True
+
+@HANDLERS.register(OR)
+def interpretOr(self, instruction, frame):
+    self.stack.push(int(self.stack.pop() or self.stack.pop()))
+    return True
+
+@HANDLERS.register(AND)
+def interpretAnd(self, instruction, frame):
+    self.stack.push(self.stack.pop() & self.stack.pop())
+    return True
+
+@HANDLERS.register(DROP)
+def interpretDrop(self, instruction, frame):
+    self.stack.pop()
+    return True
+
+@HANDLERS.register(*LOADS)
+def interpretLoad(self, instruction, frame):
+    # Linking replaced the offset with the index of the instance's accessor
+    self.stack.push(self.accessors[instruction['access']](self.stack.pop()))
+    return True
+
+@HANDLERS.register(*STORES)
+def interpretStore(self, instruction, frame):
+    value = self.stack.pop()
+    self.accessors[instruction['access']](self.stack.pop(), value)
+    return True
+
+@HANDLERS.register(MEMORYSIZE)
+def interpretMemorySize(self, instruction, frame):
+    self.stack.push(self.memory.size())
+    return True
+
+@HANDLERS.register(MEMORYGROW)
+def interpretMemoryGrow(self, instruction, frame):
+    self.stack.push(self.memory.grow(self.stack.pop()))
+    return True
+
+@HANDLERS.register(RETURN)
+def interpretReturn(self, instruction, frame):
+    frame.branchDepth = None
+    return False
+
+@HANDLERS.register(BR)
+def interpretBr(self, instruction, frame):
+    frame.branchDepth = int(instruction['operand'])
+    return False
+
+@HANDLERS.register(BR_IF)
+def interpretBrIf(self, instruction, frame):
+    # If the result is false, continue normally
+    if self.stack.pop() == 0:
+        return True
+    frame.branchDepth = int(instruction['operand'])
+    return False
+
+
+class Exports:
+    """The exported functions of an instance as callables (see `Interpreter.exportFunction`), resolved on first use:
+    `instance.exports.fib(20)`, or `instance.exports["fib"]` for names that are not Python identifiers"""
+
+    def __init__(self, instance):
+        self._instance = instance
+
+    def __getattr__(self, name):
+        funcidx = self._instance.module.exportIndex(name)
+        if funcidx is None:
+            raise AttributeError(f"No exported function named {name!r}.")
+        function = self._instance.exportFunction(funcidx)
+        # Later lookups find the callable in the instance dictionary and skip __getattr__
+        setattr(self, name, function)
+        return function
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name) from None
+
+    def __dir__(self):
+        return list(self._instance.module.exports)
+
+
+class Snapshot:
+    """The state of an instance at one point: the contents of its linear memory, as a `memory.MemoryImage`. The
+    module's globals and tables are not supported yet, so memory is all the state there is. Result caches are not
+    kept; they only hold what can be computed again.
+    `spawn` creates an instance from the snapshot without running the start function again, with the same memory
+    backend as the original. Sparse and mmap memories are copy-on-write clones: they share the snapshot's pages
+    until they write to them. A dense memory is a `bytearray`, which cannot share pages, so spawning copies all of
+    it; use one of the other backends for cheap clones of a large memory"""
+
+    def __init__(self, instance):
+        self.module = instance.module
+        self.options = {"maxCallDepth": instance.maxCallDepth, "memoryBackend": instance.memoryBackend}
+        self.memoryClass = type(instance.memory)
+        self.memory = instance.memory.snapshot() if instance.memory is not None else None
+
+    def spawn(self):
+        memory = self.memoryClass.fromImage(self.memory) if self.memory is not None else None
+        return self.module.interpreter(**self.options).attach(self.module, memory)
+
 
 class Interpreter:
-    def __init__(self):
-        self.stack = Stack()
-
-    def instantiate(self, ast):
-        self.funcInstances = {}
-        self.typeInstances = {}
-        self.exportInstances = {}
-        self.importInstances = {}
-        """We first must instantiate an instance to run any functions within it"""
-        self.ast = ast
-        self.globalEnv = self.ast['env']
-        """We take as input an AST dictionary. """
-        for field in self.ast['fields']:
-            # Ignore types for now as part of our quick and dirty implementation
-            if field['type'] == TYPE:
-                self.typeInstances[field['id']] = field
-            # Append func to auxiliary list containing all our functions
-            elif field['type'] == FUNC:
-                self.funcInstances[field['id']] = field
-            elif field['type'] == IMPORT:
-                pass
-            elif field['type'] == EXPORT:
-                self.exportInstances[field['id']] = field
- 
+    def __init__(self, tier="ast", maxCallDepth=100000, memoize=False, cacheSize=1024, cachePolicy="lru",
+                 profileOpcodes=False, superinstructions=None, memoryBackend="dense"):
+        """`tier` selects how function bodies are executed:
+            "ast"      -> walk the instruction dictionaries produced by the parser
+            "bytecode" -> run the flat bytecode produced by `bytecode.compileModule`
+            "register" -> run the register IR that `register.lowerCode` derives from the bytecode
+            "closure"  -> call the pre-bound closures produced by `closures.compileModule`
+            "jit"      -> call the Python functions generated by `jit.Jit`, walking the AST for functions it cannot compile
+        `maxCallDepth` bounds the number of nested calls the bytecode and register tiers run before trapping.
+        `memoize` caches the results of pure functions (see `purity.analyzePurity`) in a `purity.ResultCache`
+        of `cacheSize` entries per function, evicted by `cachePolicy` ("lru" or "fifo").
+        `profileOpcodes` counts the opcode bigrams and trigrams the bytecode tier executes in `self.opcodeProfile`, and
+        `superinstructions` lists the opcode sequences the bytecode tier fuses (see `fusion.selectPatterns`). Opcode
+        profiles and handler timings are collected without locking, so only use them from one thread.
+        `memoryBackend` picks the linear memory implementation from `memory.MEMORYBACKENDS`: "dense" allocates every
+        page up front, "sparse" allocates pages on first write and "mmap" maps anonymous memory. It may also be a
+        callable taking the (min, max) page limits, such as `lambda min, max: MmapMemory(min, max, path)`.
+        """
+        self.tier = tier
+        self.maxCallDepth = maxCallDepth
+        self.memoize = memoize
+        self.cacheSize = cacheSize
+        self.cachePolicy = cachePolicy
+        self.opcodeProfile = OpcodeProfile() if profileOpcodes else None
+        self.superinstructions = superinstructions
+        if not callable(memoryBackend) and memoryBackend not in MEMORYBACKENDS:
+            raise ValueError("Unknown memory backend.")
+        self.memoryBackend = memoryBackend
+        # Values, labels and activation frames each live on their own stack
+        self.stack = OperandStack()
+        self.labels = LabelStack()
+        self.frames = CallStack()
+        # Opcode -> handler table of the AST walker, and opcode -> [calls, seconds] once timing is enabled
+        self.handlers = HANDLERS.handlers
+        self.handlerTimings = {}
+
+    def instantiate(self, ast, imports=None):
+        """Compile a parsed module with this interpreter's options and bind to it (see `bind`). To create many
+        instances of one module, compile it once as a `module.Module` and call its `instantiate` instead"""
+        return self.bind(Module(ast, self.tier, self.memoize, self.cacheSize, self.cachePolicy, self.superinstructions), imports)
+
+    def bind(self, module, imports=None):
+        """Make this interpreter an instance of a compiled `module.Module` and run the module's start function. The
+        instance owns the stacks, the linear memory and the result caches; the code is shared with every other
+        instance of the module.
+        `imports` maps module name -> field name -> value supplied by the host, for now only `memory.Memory`
+        objects. An imported memory the host does not supply is created from its declared limits"""
+        imports = imports or {}
+        memory = None
+        if module.memoryImport is not None:
+            moduleName, name = module.memoryImport
+            memory = imports.get(moduleName, {}).get(name)
+        if memory is None and module.memoryType is not None:
+            memory = self.createMemory(module.memoryType)
+        self.attach(module, memory)
+        if module.start is not None:
+            self.exportFunction(module.start)()
+        return self
+
+    def attach(self, module, memory):
+        """Bind to `module` with `memory` as the instance's linear memory, without running the start function"""
+        if module.tier != self.tier:
+            raise ValueError("The module was compiled for another tier.")
+        self.module = module
+        # The interpreter running calls on each thread (see `executionState`)
+        self.threads = threading.local()
+        self.threads.interpreter = self
+        self.ast = module.ast
+        self.globalEnv = module.env
+        self.typeInstances = module.types
+        self.funcInstances = module.functions
+        self.exportInstances = module.exportFields
+        self.memory = memory
+        # Linked loads and stores refer to these by index
+        self.accessors = [self.memoryAccessor(op, offset) for op, offset in module.memoryAccesses]
+        self.caches = {funcidx: ResultCache(module.cacheSize, module.cachePolicy) for funcidx in module.pure}
+        # Compiled once by the module; they reach this instance's memory and caches through the instance they run for
+        self.closures = module.closures
+        self.compiled = {}
+        # Profiled copies of the bytecode, made on the first call when profiling opcodes
+        self.profiledCodes = None
+        if self.tier == "jit":
+            self.jitNamespace, self.compiled = module.jit.bind(self.hostCallable, self.memory)
+        self.attachResultCaches()
+        self.exports = Exports(self)
+        return self
+
+    def snapshot(self):
+        """Capture the instance's current state, typically right after instantiation, so `Snapshot.spawn` can
+        create instances starting from it without instantiating again"""
+        return Snapshot(self)
+
+    def executionState(self):
+        """The interpreter whose stacks the current thread runs calls on: this one on the thread that bound the module,
+        and on any other thread a copy with stacks of its own sharing everything else (code, memory, caches). Every
+        entry point goes through it, so one instance can serve concurrent calls"""
+        interpreter = getattr(self.threads, 'interpreter', None)
+        if interpreter is None:
+            interpreter = copy.copy(self)
+            interpreter.stack = OperandStack()
+            interpreter.labels = LabelStack()
+            interpreter.frames = CallStack()
+            self.threads.interpreter = interpreter
+        return interpreter
+
+    def createMemory(self, limits):
+        backend = self.memoryBackend if callable(self.memoryBackend) else MEMORYBACKENDS[self.memoryBackend]
+        return backend(limits['min'], limits.get('max'))
+
+    def memoryAccessor(self, op, offset):
+        """The function performing a load or store of the instance's memory at a static offset"""
+        if self.memory is None:
+            raise ValueError("Memory instruction without a memory.")
+        return self.memory.loader(op, offset) if op in LOADS else self.memory.storer(op, offset)
+
+    def writeArray(self, address, array, dtype=None):
+        """Copy a NumPy array into the instance's linear memory at `address` (see `memory.Memory.writeArray`)"""
+        if self.memory is None:
+            raise ValueError("The module has no memory.")
+        return self.memory.writeArray(address, array, dtype)
+
+    def arrayView(self, address, count, dtype="int32"):
+        """A zero-copy NumPy view of `count` `dtype` elements of linear memory at `address`: "int32", "int64",
+        "float32" or "float64" (see `memory.Memory.array`)"""
+        if self.memory is None:
+            raise ValueError("The module has no memory.")
+        return self.memory.array(address, count, dtype)
+
+    def attachResultCaches(self):
+        """Hand the result cache of every pure function to its compiled function, so calls from callExtern and from
+        other functions are memoized. Closures look their cache up in `caches` themselves"""
+        for funcidx, cache in self.caches.items():
+            if funcidx in self.compiled:
+                self.compiled[funcidx] = memoizeCompiled(cache, self.compiled[funcidx])
+                # Compiled callers find their callee in the JIT namespace
+                self.jitNamespace[f"f{funcidx}"] = self.compiled[funcidx]
+
+    def resultCache(self, funcname):
+        """Return the result cache of an exported function, or None if it is not memoized"""
+        return self.caches.get(self.module.exportIndex(funcname))
 
     def callExtern(self, funcname, opType, *args):
-        """User calls an exported function."""
-        
-        for exportId, export in self.exportInstances.items():
-            # Evaluate the export if it is found
-            if funcname != export['name']:
-                continue
-            if opType == FUNC:
-                function = self.funcInstances[export['id']]
-                # Push external arguments onto the stack
-                for arg in args:
-                    self.stack.push(arg)
-                self.callFunc(function)
-                for result in self.stack.stack:
-                    return result
-                
+        """User calls an exported function and receives its first result. For repeated calls, the callables of
+        `exports` are faster"""
+        interpreter = self.executionState()
+        if interpreter is not self:
+            return interpreter.callExtern(funcname, opType, *args)
+        funcidx = self.module.exportIndex(funcname)
+        if funcidx is None or opType != FUNC:
+            return None
+        function = self.funcInstances[funcidx]
+        height = self.stack.height()
+        depth = self.frames.depth()
+        labels = self.labels.height()
+        # Push external arguments onto the stack
+        self.stack.pushValues(args)
+        try:
+            self.callFunc(function)
+        except BaseException:
+            self.discardAbove(height, depth, labels)
+            raise
+        # Hand the results back to the caller and leave the stack as we found it
+        results = self.stack.popValues(self.stack.height() - height)
+        if results:
+            return results[0]
 
     def callFunc(self, funcInstance):
-        # On each function call, we create a new local frame from our base frame that will hold the current instantiation's
-        # metadata
-        frame = copy.deepcopy(funcInstance['frame'])
-
-        # Pop values from stack and store them on the local activation frame.
-        # Note that these are parameters so we start at index 0.
-        for i in range(frame.argArity()):
-            frame.setLocalValue(self.stack.pop(), i)
+        # Closures and JIT-compiled functions consult their result cache themselves
+        if self.tier == "closure":
+            return self.closures[funcInstance.id](self.stack.stack, self)
+        elif self.tier == "jit" and funcInstance.id in self.compiled:
+            return self.callCompiled(self.compiled[funcInstance.id], funcInstance.template)
+        elif funcInstance.memoized:
+            template = funcInstance.template
+            return callMemoized(self.caches[funcInstance.id], self.stack.stack, template.paramCount, template.returnArity,
+                                lambda: self.executeFunc(funcInstance))
+        return self.executeFunc(funcInstance)
+
+    def executeFunc(self, funcInstance):
+        """Run a function on the bytecode, register or AST tier without consulting its result cache"""
+        args = self.stack.popValues(funcInstance.template.paramCount)
+        if self.tier == "register":
+            code = funcInstance.registers
+            args.extend(code.tail)
+            self.stack.pushValues(self.interpretRegisters(code, args))
+        else:
+            self.runFunc(funcInstance, args)
+
+    def runFunc(self, funcInstance, args):
+        """Run a function on the bytecode or AST tier with the list of arguments `args`, leaving its results on the stack"""
+        if self.tier == "bytecode":
+            return self.interpretCode(funcInstance.code, args)
+        # On each function call, we activate the function's frame template. Its parameters are `args`, with
+        # index 0 holding the first argument.
+        template = funcInstance.template
+        frame = template.activate(args)
         
-        # Push the frame onto the stack
-        self.stack.push(frame)
+        # Push the frame onto the call stack, remembering where its operands begin
+        frame.height = self.stack.height()
+        self.frames.push(frame)
         # Parse the instructions
-        self.enterInstructionSequence(funcInstance['instr'], frame)
-        # Determine the number of values returned by the function
-        returnArity = frame.returnArity()
-        # Save the return values and pop from the stack
-        returns = []
-
-        for i in range(returnArity):
-            returns.append(self.stack.pop())       
+        self.enterInstructionSequence(funcInstance.instr, frame)
+        # Keep the return values and drop everything else the function left on the stack
+        self.stack.unwind(frame.height, template.returnArity)
         # pop activation frame for that function
-        poppedFrame = self.stack.pop()
-        # Push return values back onto the stack
-        for result in returns:
-            self.stack.push(result)
-    
+        self.frames.pop()
+
+    def exportFunction(self, funcidx):
+        """A callable running the function `funcidx` with Python arguments and returning its results: None, a single
+        value, or a tuple for several results. It is resolved once, so calls skip the export lookup of callExtern,
+        and arguments go straight into the callee's frame instead of through the operand stack"""
+        funcInstance = self.funcInstances[funcidx]
+        template = funcInstance.template
+        paramCount = template.paramCount
+        arity = template.returnArity
+        if self.tier == "jit" and funcidx in self.compiled:
+            # Compiled functions already take and return Python values, and consult their result cache themselves
+            return self.compiled[funcidx]
+        if self.tier == "closure":
+            # Runs on a stack of its own, so there is nothing to clean up after a trap
+            closure = self.closures[funcidx]
+            run = lambda args: closure.call(args, self)
+        else:
+            run = self.frameRunner(funcInstance)
+            if funcInstance.memoized:
+                run = memoizeResults(self.caches[funcidx], run)
+        def call(*args):
+            if len(args) != paramCount:
+                raise TypeError(f"Expected {paramCount} arguments, got {len(args)}.")
+            results = run(args)
+            if arity == 1:
+                return results[0]
+            return tuple(results) if arity else None
+        return call
+
+    def invokeMany(self, funcname, argsIterable, asList=False):
+        """Call an export once for every argument tuple of `argsIterable`, with results as returned by the callables
+        of `exports`. The export is resolved once for the whole batch. Results are yielded as they are computed, or
+        with `asList` returned in a list, allocated up front when `argsIterable` has a length"""
+        funcidx = self.module.exportIndex(funcname)
+        if funcidx is None:
+            raise ValueError("Unknown export.")
+        results = self.batchResults(funcidx, argsIterable)
+        if not asList:
+            return results
+        if not hasattr(argsIterable, '__len__'):
+            return list(results)
+        collected = [None] * len(argsIterable)
+        for i, result in enumerate(results):
+            collected[i] = result
+        return collected
+
+    def invokeVectorized(self, funcname, *columns, chunkSize=65536):
+        """Call an export once per lane of `columns`, one array of arguments per parameter. Returns an array holding
+        each result: a single array, a tuple of arrays for several results, or None. Pure integer functions without
+        calls run in lockstep `chunkSize` lanes at a time (see `vectorize`); others fall back to `invokeMany`, lane by
+        lane"""
+        funcidx = self.module.exportIndex(funcname)
+        if funcidx is None:
+            raise ValueError("Unknown export.")
+        np = numpy()
+        template = self.funcInstances[funcidx].template
+        if len(columns) != template.paramCount:
+            raise TypeError(f"Expected {template.paramCount} argument columns, got {len(columns)}.")
+        if not columns:
+            raise ValueError("Vectorized calls need at least one argument column.")
+        columns = [np.asarray(column) for column in columns]
+        lanes = len(columns[0])
+        if any(len(column) != lanes for column in columns):
+            raise ValueError("Argument columns differ in length.")
+        arity = template.returnArity
+        lockstep = self.module.lockstep()
+        if funcidx in lockstep.functions:
+            columns = [column.astype(np.int64, copy=False) for column in columns]
+            results = [np.empty(lanes, dtype=np.int64) for _ in range(arity)]
+            for start in range(0, lanes, chunkSize):
+                chunk = lockstep.run(funcidx, [column[start:start + chunkSize] for column in columns])
+                for result, values in zip(results, chunk):
+                    result[start:start + chunkSize] = values
+        else:
+            results = self.scalarColumns(funcname, columns, arity)
+        if arity == 0:
+            return None
+        return results[0] if arity == 1 else tuple(results)
+
+    def scalarColumns(self, funcname, columns, arity):
+        """Call an export lane by lane with `invokeMany`, returning one array per result"""
+        np = numpy()
+        rows = self.invokeMany(funcname, zip(*(column.tolist() for column in columns)), asList=True)
+        if arity == 1:
+            return [np.array(rows)]
+        return [np.array([row[k] for row in rows]) for k in range(arity)]
+
+    def batchResults(self, funcidx, argsIterable):
+        funcInstance = self.funcInstances[funcidx]
+        if self.tier != "register" or funcInstance.memoized:
+            call = self.exportFunction(funcidx)
+            for args in argsIterable:
+                yield call(*args)
+            return
+        # The register tier runs every call of the batch in one register file, reset from the arguments and the
+        # function's tail instead of allocated per call
+        code = funcInstance.registers
+        paramCount = code.paramCount
+        arity = code.returnArity
+        tail = code.tail
+        registers = [0] * (paramCount + len(tail))
+        interpreter = self.executionState()
+        interpretRegisters = interpreter.interpretRegisters
+        depth = len(interpreter.frames.stack)
+        for args in argsIterable:
+            if len(args) != paramCount:
+                raise TypeError(f"Expected {paramCount} arguments, got {len(args)}.")
+            registers[:paramCount] = args
+            registers[paramCount:] = tail
+            try:
+                results = interpretRegisters(code, registers)
+            except BaseException:
+                del interpreter.frames.stack[depth:]
+                raise
+            if arity == 1:
+                yield results[0]
+            else:
+                yield tuple(results) if arity else None
+
+    def frameRunner(self, funcInstance):
+        """A function running `funcInstance` with a sequence of arguments and returning the list of its results"""
+        executionState = self.executionState
+        if self.tier == "register":
+            code = funcInstance.registers
+            def run(args):
+                interpreter = executionState()
+                height = len(interpreter.stack.stack)
+                depth = len(interpreter.frames.stack)
+                registers = list(args)
+                registers.extend(code.tail)
+                try:
+                    return interpreter.interpretRegisters(code, registers)
+                except BaseException:
+                    interpreter.discardAbove(height, depth, len(interpreter.labels.stack))
+                    raise
+            return run
+        # The bytecode and AST tiers still work on the operand stack, which they leave as they found it
+        def run(args):
+            interpreter = executionState()
+            stack = interpreter.stack.stack
+            height = len(stack)
+            depth = len(interpreter.frames.stack)
+            labels = len(interpreter.labels.stack)
+            try:
+                interpreter.runFunc(funcInstance, list(args))
+            except BaseException:
+                interpreter.discardAbove(height, depth, labels)
+                raise
+            results = stack[height:]
+            del stack[height:]
+            return results
+        return run
+
+    def discardAbove(self, height, depth, labels):
+        """A trap, or any other error escaping a call, aborts the whole call, so discard everything it left on
+        the stacks"""
+        del self.stack.stack[height:]
+        del self.frames.stack[depth:]
+        del self.labels.stack[labels:]
+
+    def callCompiled(self, compiled, template):
+        """Call a Python function generated by the JIT with the arguments on the operand stack"""
+        results = compiled(*self.stack.popValues(template.paramCount))
+        arity = template.returnArity
+        if arity == 1:
+            self.stack.push(results)
+        elif arity > 1:
+            self.stack.pushValues(results)
+
+    def hostCallable(self, funcidx):
+        """Wrap a function so Python code can call it with arguments and receive its results"""
+        def call(*args):
+            interpreter = self.executionState()
+            funcInstance = self.funcInstances[funcidx]
+            arity = funcInstance.template.returnArity
+            interpreter.stack.pushValues(args)
+            interpreter.callFunc(funcInstance)
+            results = interpreter.stack.popValues(arity)
+            if arity == 0:
+                return None
+            return results[0] if arity == 1 else tuple(results)
+        return call
+
+    def generatedSource(self, funcname):
+        """Return the Python source the JIT generated for an exported function, or None if it was not compiled"""
+        return self.module.jit.sources.get(self.module.exportIndex(funcname))
+
+    def interpretCode(self, code, locals):
+        """Run the flat bytecode of a function with a program counter. `locals` holds the arguments and is used as
+        the function's locals; the results are left on the operand stack.
+        Calls do not recurse: the caller's state is saved as a frame on the call stack and the loop continues in the
+        callee, so call depth is bounded by `maxCallDepth` rather than by Python's recursion limit"""
+        if self.opcodeProfile is not None:
+            # The copies record each opcode as it is fetched, so the loop itself never checks for profiling
+            if self.profiledCodes is None:
+                self.profiledCodes = profileCode(self.funcInstances, self.opcodeProfile)
+            code = self.profiledCodes[code]
+        stack = self.stack.stack
+        frames = self.frames.stack
+        # Frames below this height belong to whoever called into the loop
+        entryDepth = len(frames)
+        maxDepth = entryDepth + self.maxCallDepth - 1
+        # Parameters are the first locals, the remaining locals start at their zero value
+        locals.extend(code.defaults)
+        base = len(stack)
+        entries = code.entries
+        returnArity = code.returnArity
+        accessors = self.accessors
+        memory = self.memory
+        caches = self.caches
+        pc = 0
+        while True:
+            op, imm = entries[pc]
+            pc += 1
+            if op >= LOCALGET_CONST:
+                # Superinstructions (see fusion.py) all have opcodes above the plain ones, so they cost a single test to skip
+                if op == LOCALGET_CONST_ADD:
+                    stack.append(locals[imm[0]] + imm[1])
+                elif op == LOCALGET_LOCALGET_ADD:
+                    stack.append(locals[imm[0]] + locals[imm[1]])
+                elif op == LOCALGET_ADD_LOCALSET:
+                    locals[imm[1]] = stack.pop() + locals[imm[0]]
+                elif op == LOCALGET_CONST:
+                    stack.append(locals[imm[0]])
+                    stack.append(imm[1])
+                elif op == LOCALGET_LOCALGET:
+                    stack.append(locals[imm[0]])
+                    stack.append(locals[imm[1]])
+                elif op == LOCALGET_ADD:
+                    stack[-1] += locals[imm]
+                elif op == CONST_ADD:
+                    stack[-1] += imm
+                elif op == ADD_LOCALSET:
+                    second = stack.pop()
+                    locals[imm] = stack.pop() + second
+                elif op == LOCALTEE_LOCALSET:
+                    locals[imm[0]] = locals[imm[1]] = stack.pop()
+                elif op == LOCALGET_BR_IF:
+                    if locals[imm[0]] == 0:
+                        continue
+                    pc, height, arity = imm[1]
+                    if len(stack) != base + height + arity:
+                        self.stack.unwind(base + height, arity)
+                elif op == GE_S_BR_IF or op == LT_S_BR_IF or op == EQZ_BR_IF:
+                    if op == EQZ_BR_IF:
+                        taken = stack.pop() == 0
+                    else:
+                        second = stack.pop()
+                        taken = stack.pop() >= second if op == GE_S_BR_IF else stack.pop() < second
+                    if not taken:
+                        continue
+                    pc, height, arity = imm
+                    if len(stack) != base + height + arity:
+                        self.stack.unwind(base + height, arity)
+            elif op == LOCALGET:
+                stack.append(locals[imm])
+            elif op == CONST:
+                stack.append(imm)
+            elif op == ADD:
+                second = stack.pop()
+                stack[-1] += second
+            elif op == LOCALSET:
+                locals[imm] = stack.pop()
+            elif op == LOCALTEE:
+                locals[imm] = stack[-1]
+            elif op == BR_IF:
+                if stack.pop() == 0:
+                    continue
+                pc, height, arity = imm
+                if len(stack) != base + height + arity:
+                    self.stack.unwind(base + height, arity)
+            elif op == BR:
+                pc, height, arity = imm
+                if len(stack) != base + height + arity:
+                    self.stack.unwind(base + height, arity)
+            elif op == CALL:
+                code = imm.code
+                pending = None
+                if imm.memoized:
+                    cache = caches[imm.id]
+                    key = tuple(stack[len(stack) - code.paramCount:])
+                    results = cache.get(key)
+                    if results is not MISSING:
+                        del stack[len(stack) - code.paramCount:]
+                        stack.extend(results)
+                        continue
+                    # A miss runs the callee like any other call; its return records the results
+                    pending = (cache, key)
+                if len(frames) >= maxDepth:
+                    raise Trap("Call stack exhausted.")
+                # Save the caller as (entries, pc, locals, base, returnArity, pending cache entry) and enter the callee
+                frames.append((entries, pc, locals, base, returnArity, pending))
+                base = len(stack) - code.paramCount
+                locals = stack[base:]
+                del stack[base:]
+                locals.extend(code.defaults)
+                entries = code.entries
+                returnArity = code.returnArity
+                pc = 0
+            elif op == LOAD:
+                # Linking replaced the offset with the index of the instance's accessor
+                stack[-1] = accessors[imm](stack[-1])
+            elif op == STORE:
+                value = stack.pop()
+                accessors[imm](stack.pop(), value)
+            elif op == SUB:
+                second = stack.pop()
+                stack[-1] -= second
+            elif op == GE_S:
+                second = stack.pop()
+                stack[-1] = int(stack[-1] >= second)
+            elif op == GT_U:
+                second = toUnsigned(stack.pop())
+                stack[-1] = int(toUnsigned(stack[-1]) > second)
+            elif op == LT_S:
+                second = stack.pop()
+                stack[-1] = int(stack[-1] < second)
+            elif op == EQZ:
+                stack[-1] = int(stack[-1] == 0)
+            elif op == EQ:
+                second = stack.pop()
+                stack[-1] = int(stack[-1] == second)
+            elif op == OR:
+                second = stack.pop()
+                stack[-1] = int(stack[-1] or second)
+            elif op == AND:
+                second = stack.pop()
+                stack[-1] = stack[-1] & second
+            elif op == DROP:
+                stack.pop()
+            elif op == MEMORYSIZE:
+                stack.append(memory.size())
+            elif op == MEMORYGROW:
+                stack[-1] = memory.grow(stack[-1])
+            elif op == RETURN:
+                if len(stack) != base + returnArity:
+                    self.stack.unwind(base, returnArity)
+                if len(frames) == entryDepth:
+                    return
+                # Resume the caller
+                calleeArity = returnArity
+                entries, pc, locals, base, returnArity, pending = frames.pop()
+                if pending is not None:
+                    pending[0].put(pending[1], tuple(stack[len(stack) - calleeArity:]))
+
+    def interpretRegisters(self, code, registers):
+        """Run the register IR of a function and return the list of its results. `registers` is the initial register
+        file: the arguments followed by `code.tail`. The function writes into it, so batches reset it between calls.
+        Like `interpretCode`, calls save the caller on the call stack instead of recursing, memoized calls included"""
+        frames = self.frames.stack
+        entryDepth = len(frames)
+        maxDepth = entryDepth + self.maxCallDepth - 1
+        entries = code.entries
+        accessors = self.accessors
+        memory = self.memory
+        caches = self.caches
+        # Register receiving the first result of the current function in its caller
+        resultBase = None
+        pc = 0
+        while True:
+            op, a, b, c = entries[pc]
+            pc += 1
+            if op == ADD:
+                registers[a] = registers[b] + registers[c]
+            elif op == MOVE:
+                registers[a] = registers[b]
+            elif op == BR_IF:
+                if registers[b] != 0:
+                    pc = a
+            elif op == GE_S:
+                registers[a] = int(registers[b] >= registers[c])
+            elif op == CALL:
+                pending = None
+                if a.memoized:
+                    cache = caches[a.id]
+                    key = tuple([registers[argument] for argument in b])
+                    results = cache.get(key)
+                    if results is not MISSING:
+                        registers[c:c + len(results)] = results
+                        continue
+                    # A miss runs the callee like any other call; its return records the results
+                    pending = (cache, key)
+                if len(frames) >= maxDepth:
+                    raise Trap("Call stack exhausted.")
+                frames.append((entries, pc, registers, resultBase, pending))
+                callee = a.registers
+                registers = [registers[argument] for argument in b]
+                registers.extend(callee.tail)
+                entries = callee.entries
+                resultBase = c
+                pc = 0
+            elif op == BR:
+                pc = a
+            elif op == LOAD:
+                registers[a] = accessors[c](registers[b])
+            elif op == STORE:
+                accessors[a](registers[b], registers[c])
+            elif op == SUB:
+                registers[a] = registers[b] - registers[c]
+            elif op == GT_U:
+                registers[a] = int(toUnsigned(registers[b]) > toUnsigned(registers[c]))
+            elif op == LT_S:
+                registers[a] = int(registers[b] < registers[c])
+            elif op == EQZ:
+                registers[a] = int(registers[b] == 0)
+            elif op == EQ:
+                registers[a] = int(registers[b] == registers[c])
+            elif op == OR:
+                registers[a] = int(registers[b] or registers[c])
+            elif op == AND:
+                registers[a] = registers[b] & registers[c]
+            elif op == MEMORYSIZE:
+                registers[a] = memory.size()
+            elif op == MEMORYGROW:
+                registers[a] = memory.grow(registers[b])
+            elif op == RETURN:
+                if len(frames) == entryDepth:
+                    return [registers[result] for result in a]
+                results = [registers[result] for result in a]
+                # Resume the caller, writing the results into its registers
+                base = resultBase
+                entries, pc, registers, resultBase, pending = frames.pop()
+                registers[base:base + len(results)] = results
+                if pending is not None:
+                    pending[0].put(pending[1], tuple(results))
+
     def enterInstructionSequence(self, code, frame):
         for i in range(len(code)):
             instruction = code[i]
             if not self.interpretInstruction(instruction, frame):
                 return False
+        return True
 
     def interpretInstruction(self, instruction, frame):
         """
-            False -> exit out of function
-            True -> stay in function
+            False -> exit out of the current instruction sequence (a branch or return is pending on the frame)
+            True -> stay in the current instruction sequence
         """
-        if instruction['type'] == BLOCK:
-            # Instatiate label object
-            label = Label(instruction["instructions"], 0, 0, BLOCK)
-            # Push label onto stack
-            self.stack.push(label)
-            # Enter constroled instruction sequence
-            return self.interpretStructuredControlInstructions(frame, label)
-        elif instruction['type'] == LOOP:
-            # Instatiate label object
-            label = Label(instruction["instructions"], 0, 0, LOOP)
-            # Push label onto stack
-            self.stack.push(label)
-            # Enter constroled instruction sequence. 
-            # If it returns false, then exit out of the instruction sequence
-            return self.interpretStructuredControlInstructions(frame, label)
-        elif instruction['type'] == LOCALGET:
-            self.stack.push(frame.getLocal(int(instruction['operand'])))
-            return True      
-        elif instruction['type'] == LOCALSET:
-            frame.setLocalValue(self.stack.pop(), int(instruction['operand']))
-            return True
-        elif instruction['type'] == LOCALTEE:
-            frame.setLocalValue(self.stack.peek(), int(instruction['operand'])) 
-            return True   
-        elif instruction['type'] == CALL:
-            # Get address of function in our store
-            functionAddress = self.globalEnv.getIdentifierIndex("funcs", instruction['operand'])
-            function = self.funcInstances[functionAddress]           
-            self.callFunc(function)
-            return True
-        elif instruction['type'] == CONST:
-            self.stack.push(int(instruction['operand']))
-            return True
-        elif instruction['type'] == ADD:
-            self.stack.push(self.stack.pop() + self.stack.pop())
-            return True
-        elif instruction['type'] == GE_S:
-            second = self.stack.pop()
-            first = self.stack.pop()
-            self.stack.push(int(first >= second))
-            return True
-        elif instruction['type'] == SUB:
-            second = self.stack.pop()
-            first = self.stack.pop()
-            self.stack.push(first - second)
-            return True
-        elif instruction['type'] == GT_U:
-            # Convert both to unsigned
-            second = self.stack.pop()
-            first = self.stack.pop()
-            if first < 0:
-                first += (1 << 32)
-            if second < 0:
-                second += (1 << 32)
-            self.stack.push(int(first > second))
-            return True
-        elif instruction['type'] == EQZ:
-            self.stack.push(int(self.stack.pop() == 0))
-            return True
-        elif instruction['type'] == EQ:
-            self.stack.push(int(self.stack.pop() == self.stack.pop()))
-            return True
-        elif instruction['type'] == OR:
-            self.stack.push(int(self.stack.pop() or self.stack.pop()))
-            return True
-        elif instruction['type'] == LT_S:
-            second = self.stack.pop()
-            first = self.stack.pop()
-            self.stack.push(int(first < second))
-            return True
-        elif instruction['type'] == GE_S:
-            second = self.stack.pop()
-            first = self.stack.pop()
-            self.stack.push(int(first >= second))
-            return True
-        elif instruction['type'] == DROP:
-            self.stack.pop()
-            return True
-        elif instruction['type'] == RETURN:
-            return False
-        elif instruction['type'] in [BR, BR_IF]:
-            return False
+        handler = self.handlers.get(instruction['type'])
+        if handler is None:
+            raise ValueError("Unsupported instruction.")
+        return handler(self, instruction, frame)
+
+    def enableHandlerTiming(self):
+        """Time every handler of the AST walker from now on. Times of blocks, loops and calls include the instructions they run"""
+        self.handlers = HANDLERS.timed(self.handlerTimings)
+
+    def disableHandlerTiming(self):
+        self.handlers = HANDLERS.handlers
 
-    
     def interpretStructuredControlInstructions(self, frame, label):
         """
             True -> jump to position after "end" keyword
-            False -> exit out of function call itself
+            False -> exit out of the enclosing instruction sequence (a branch to an outer label or a return is pending)
         """
+        self.labels.push(label)
         i=0
         while i < len(label.instructions):
             instruction = label.instructions[i]
@@ -214,52 +887,24 @@ class Interpreter:
             # If the instruction type was not a branch instruction
             if self.interpretInstruction(instruction, frame):
                 continue
-            elif instruction['type'] == BR_IF:
-                # If the result is True
-                if self.stack.pop() != 0:
-                    for __ in range(instruction['operand'] + 1): # Loop through l + 1 (l is our operand)
-                        # I.e., while the top of a stack is a value
-                        while not isinstance(self.stack.peek(), Label) and not isinstance(self.stack.peek(), Frame): 
-                            self.stack.pop()
-                        # Pop the label from the stack
-                        poppedLabel = self.stack.pop()
-                    if label.type==LOOP: 
-                        self.stack.push(poppedLabel)
-                        i = 0 # Jump to the continuation of L (for a loop, this means going to the original loop index)
-                    elif label.type==BLOCK: 
-                        return True # Jump to the continuation of L (for a block, this means breaking out of the current block)
-                # If the result is false, continue normally
-                else:
-                    continue
-            # If it is not a branch instruction but we returned false, then it implies we must break out of all the structured control instructions.
-            # This implies we return from our function call, and we must configure the stack appropriately
-            else:
-                values = []
-                # Pop all the values from the stack
-                while not isinstance(self.stack.peek(), Frame) and not isinstance(self.stack.peek(), Label):
-                    values.append(self.stack.pop())
-                # Pop the label from the stack
-                poppedLabel = self.stack.pop()
-                # Push the values back onto the stack
-                if len(values) == 0: return False
-                elif len(values) == 1: self.stack.push(values[0])
-                else:
-                    for i in range(len(values) - 1, 0, -1):
-                        self.stack.push(values[i])
-                # Exit out of structured control sequence
-                return False      
+            # A return breaks out of all the structured control instructions of the function
+            if frame.branchDepth is None:
+                self.labels.pop()
+                return False
+            # The branch targets an enclosing label, so keep unwinding
+            if frame.branchDepth > 0:
+                frame.branchDepth -= 1
+                self.labels.pop()
+                return False
+            # The branch targets this label: drop the operands pushed since the label was entered
+            self.stack.unwind(label.height, label.argumentArity)
+            if label.type==LOOP: 
+                i = 0 # Jump to the continuation of L (for a loop, this means going to the original loop index)
+            elif label.type==BLOCK: 
+                self.labels.pop()
+                return True # Jump to the continuation of L (for a block, this means breaking out of the current block)
         # If we completed all of our instructions without a trap, abort, or return, then we can continue normally
-        values = []
-        # Pop all the values from the stack
-        while not isinstance(self.stack.peek(), Frame) and not isinstance(self.stack.peek(), Label):
-            values.append(self.stack.pop())
-        # Pop the label from the stack
-        poppedLabel = self.stack.pop()
-        # Push the values back onto the stack
-        if len(values) == 1: self.stack.push(values[0])
-        else:
-            for i in range(len(values) - 1, 0, -1):
-                self.stack.push(values[i])
+        self.labels.pop()
         return True
 
 
@@ -0,0 +1,310 @@
+"""Translates function bodies into Python source, compiles it with `compile()` and caches the resulting
+function objects. Locals become Python locals (`l0`, `l1`, ...), operand stack slots become temporaries
+named after their height (`s0`, `s1`, ...), and blocks and loops become `while True:` statements that
+branches leave with `break` or restart with `continue`.
+
+Pure operands are kept as expressions until something forces them into a temporary, so
+`local.get 0; i32.const -1; i32.add; call $fib` becomes `s0 = f0((l0 + -1))`."""
+import functools
+from settings import *
+from env import FrameTemplate
+from bytecode import localIndex, moduleSignatures, toUnsigned
+
+# Number of recently compiled sources whose code objects are kept, so identical functions, e.g. of the same module
+# loaded by several workers, are only compiled once. Bounded, since a long-running host may compile any number of
+# modules
+CODECACHESIZE = 256
+
+# Python expressions of the pure binary and unary instructions
+BINARYEXPRESSIONS = {
+    ADD: "({0} + {1})",
+    SUB: "({0} - {1})",
+    AND: "({0} & {1})",
+    OR: "int({0} or {1})",
+    EQ: "int({0} == {1})",
+    GE_S: "int({0} >= {1})",
+    LT_S: "int({0} < {1})",
+    GT_U: "int(toUnsigned({0}) > toUnsigned({1}))",
+}
+UNARYEXPRESSIONS = {
+    EQZ: "int({0} == 0)",
+}
+# Loads and stores call accessors bound in the namespace, named after the instruction and its offset
+MEMORYNAMES = {type: name.replace('.', '_') for name, type in MEMORYINSTRUCTIONS.items()}
+
+
+@functools.lru_cache(maxsize=CODECACHESIZE)
+def compileSource(source, name):
+    """Compile a generated function, reusing the code object of an identical recent source"""
+    return compile(source, f"<jit {name}>", "exec")
+
+
+class Unsupported(Exception):
+    """Raised when a function uses an instruction the JIT cannot translate"""
+
+
+class Construct:
+    """A block or loop that is open while generating source"""
+    __slots__ = ('type', 'height', 'level')
+
+    def __init__(self, type, height, level):
+        self.type = type # BLOCK, LOOP
+        self.height = height
+        # Nesting depth of the `while` statement emitted for the construct
+        self.level = level
+
+
+class SourceGenerator:
+    """Generates the Python source of one function"""
+
+    def __init__(self, name, frame, signatures, env, hasMemory=False):
+        self.name = name
+        self.hasMemory = hasMemory
+        # Accessor name -> (instruction, offset) of every load and store in the function
+        self.accessors = {}
+        self.frame = frame
+        self.signatures = signatures
+        self.env = env
+        self.lines = []
+        self.indent = 1
+        self.constructs = []
+        # Compile-time operand stack of Python expressions
+        self.stack = []
+        # Whether a branch left a construct other than the innermost one, so the `_target` flag is needed
+        self.usesTarget = False
+
+    def generate(self, instructions):
+        paramCount = self.frame.argArity()
+        params = ", ".join(f"l{i}" for i in range(paramCount))
+        self.lines.append(f"def {self.name}({params}):")
+        for i, default in enumerate(FrameTemplate(self.frame).defaults, paramCount):
+            self.emit(f"l{i} = {default!r}")
+        targetLine = len(self.lines)
+        if self.generateSequence(instructions):
+            self.emitReturn()
+        if self.usesTarget:
+            self.lines.insert(targetLine, "    _target = -1")
+        return "\n".join(self.lines) + "\n"
+
+    def emit(self, line):
+        self.lines.append("    " * self.indent + line)
+
+    def slot(self, height):
+        return f"s{height}"
+
+    def push(self, expression):
+        self.stack.append(expression)
+
+    def pop(self):
+        return self.stack.pop()
+
+    def flush(self):
+        """Materialize every pending expression into the temporary of its stack slot"""
+        for height, expression in enumerate(self.stack):
+            if expression != self.slot(height):
+                self.emit(f"{self.slot(height)} = {expression}")
+                self.stack[height] = self.slot(height)
+
+    def emitReturn(self):
+        arity = self.frame.returnArity()
+        results = self.stack[len(self.stack) - arity:]
+        if arity == 0:
+            self.emit("return None")
+        elif arity == 1:
+            self.emit(f"return {results[0]}")
+        else:
+            self.emit(f"return ({', '.join(results)},)")
+
+    def generateSequence(self, instructions):
+        """
+            False -> the rest of the sequence is unreachable
+            True -> continue generating
+        """
+        for instruction in instructions:
+            if not self.generateInstruction(instruction):
+                return False
+        return True
+
+    def generateInstruction(self, instruction):
+        type = instruction['type']
+        if type == BLOCK or type == LOOP:
+            self.flush()
+            construct = Construct(type, len(self.stack), len(self.constructs) + 1)
+            self.constructs.append(construct)
+            self.emit("while True:")
+            self.indent += 1
+            if self.generateSequence(instruction['instructions']):
+                self.flush()
+                self.emit("break")
+            self.indent -= 1
+            self.constructs.pop()
+            # Forward a branch that targets a construct further out
+            if self.usesTarget and self.constructs:
+                self.emit("if _target >= 0:")
+                self.indent += 1
+                self.emitBranchFrom(self.constructs[-1])
+                self.indent -= 1
+            del self.stack[construct.height:]
+            return True
+        elif type == BR:
+            self.flush()
+            self.emitBranch(int(instruction['operand']))
+            return False
+        elif type == BR_IF:
+            condition = self.pop()
+            self.flush()
+            self.emit(f"if {condition}:")
+            self.indent += 1
+            self.emitBranch(int(instruction['operand']))
+            self.indent -= 1
+            return True
+        elif type == RETURN:
+            self.emitReturn()
+            return False
+        elif type == CALL:
+            funcidx = self.env.getIdentifierIndex("funcs", instruction['operand'])
+            signature = self.signatures[funcidx]
+            args = [self.pop() for _ in range(signature.argArity())][::-1]
+            self.flush()
+            call = f"f{funcidx}({', '.join(args)})"
+            height = len(self.stack)
+            results = [self.slot(height + i) for i in range(signature.returnArity())]
+            if not results:
+                self.emit(call)
+            elif len(results) == 1:
+                self.emit(f"{results[0]} = {call}")
+            else:
+                self.emit(f"{', '.join(results)} = {call}")
+            self.stack.extend(results)
+            return True
+        elif type == LOCALGET:
+            self.push(f"l{localIndex(self.frame, instruction['operand'])}")
+        elif type == LOCALSET:
+            value = self.pop()
+            # Pending expressions may read the local, so evaluate them before it changes
+            self.flush()
+            self.emit(f"l{localIndex(self.frame, instruction['operand'])} = {value}")
+        elif type == LOCALTEE:
+            value = self.pop()
+            self.flush()
+            local = f"l{localIndex(self.frame, instruction['operand'])}"
+            self.emit(f"{local} = {value}")
+            self.push(local)
+            # The stack keeps the value, not the local, which a later local.set may overwrite
+            self.flush()
+        elif type == CONST:
+            self.push(repr(int(instruction['operand'])))
+        elif type in BINARYEXPRESSIONS:
+            second = self.pop()
+            first = self.pop()
+            self.push(BINARYEXPRESSIONS[type].format(first, second))
+        elif type in UNARYEXPRESSIONS:
+            self.push(UNARYEXPRESSIONS[type].format(self.pop()))
+        elif type == DROP:
+            self.pop()
+        elif type in LOADS or type in STORES or type == MEMORYSIZE or type == MEMORYGROW:
+            self.generateMemoryInstruction(instruction)
+        else:
+            raise Unsupported(instruction['type'])
+        return True
+
+    def generateMemoryInstruction(self, instruction):
+        """Memory instructions have side effects, so they run in order: pending expressions are evaluated first"""
+        type = instruction['type']
+        if not self.hasMemory:
+            raise Unsupported(type)
+        if type == MEMORYSIZE:
+            self.flush()
+            self.emit(f"{self.slot(len(self.stack))} = memory.size()")
+        elif type == MEMORYGROW:
+            delta = self.pop()
+            self.flush()
+            self.emit(f"{self.slot(len(self.stack))} = memory.grow({delta})")
+        else:
+            offset = instruction['operand']['offset']
+            accessor = f"{MEMORYNAMES[type]}_{offset}"
+            self.accessors[accessor] = (type, offset)
+            if type in LOADS:
+                address = self.pop()
+                self.flush()
+                self.emit(f"{self.slot(len(self.stack))} = {accessor}({address})")
+            else:
+                value = self.pop()
+                address = self.pop()
+                self.flush()
+                self.emit(f"{accessor}({address}, {value})")
+                return
+        self.push(self.slot(len(self.stack)))
+
+    def emitBranch(self, depth):
+        """Emit a branch to the construct `depth` levels out from the innermost one"""
+        if depth >= len(self.constructs):
+            # Branching to the function body itself returns
+            self.emitReturn()
+            return
+        target = self.constructs[-1 - depth]
+        if target is self.constructs[-1]:
+            self.emit("continue" if target.type == LOOP else "break")
+        else:
+            self.usesTarget = True
+            self.emit(f"_target = {target.level}")
+            self.emit("break")
+
+    def emitBranchFrom(self, construct):
+        """Emit the code that resumes a pending branch once control is back inside `construct`"""
+        self.emit(f"if _target == {construct.level}:")
+        self.emit("    _target = -1")
+        self.emit("    continue" if construct.type == LOOP else "    break")
+        self.emit("break")
+
+
+class Jit:
+    """Compiles the functions of a module into Python code objects. They are generated once per module; every
+    instance executes them into a namespace of its own with `bind`"""
+
+    def __init__(self, ast, hasMemory=False):
+        self.ast = ast
+        self.signatures = moduleSignatures(ast)
+        self.hasMemory = hasMemory
+        self.codes = {}
+        self.sources = {}
+        # Accessor name -> (instruction, offset) of every load and store of the generated functions
+        self.accessors = {}
+
+    def compileModule(self):
+        for field in self.ast['fields']:
+            if field['type'] == FUNC:
+                self.compileFunc(field)
+        return self.codes
+
+    def compileFunc(self, field):
+        """Compile one FUNC field, returning None when it uses an instruction the JIT does not support"""
+        if field['id'] in self.codes:
+            return self.codes[field['id']]
+        name = f"f{field['id']}"
+        generator = SourceGenerator(name, field['frame'], self.signatures, self.ast['env'], self.hasMemory)
+        try:
+            source = generator.generate(field['instr'])
+        except Unsupported:
+            return None
+        self.accessors.update(generator.accessors)
+        code = compileSource(source, name)
+        self.sources[field['id']] = source
+        self.codes[field['id']] = code
+        return code
+
+    def bind(self, fallback, memory=None):
+        """Define the compiled functions in a fresh namespace whose loads and stores go to `memory`. Calls to
+        functions that could not be compiled go to `fallback(funcidx)`. Returns the namespace and funcidx -> function"""
+        # Shared by the functions so calls resolve to `f<index>` and memory accesses to their accessors
+        namespace = {"memory": memory, "toUnsigned": toUnsigned}
+        for accessor, (type, offset) in self.accessors.items():
+            namespace[accessor] = (memory.loader if type in LOADS else memory.storer)(type, offset)
+        functions = {}
+        for funcidx, code in self.codes.items():
+            exec(code, namespace)
+            functions[funcidx] = namespace[f"f{funcidx}"]
+        for funcidx in self.signatures:
+            if funcidx not in functions:
+                namespace[f"f{funcidx}"] = fallback(funcidx)
+        return namespace, functions
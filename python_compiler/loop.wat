@@ -0,0 +1,36 @@
+(module
+  (type (;0;) (func (param i32) (result i32)))
+  (func $sum (type 0) (param i32) (result i32)
+    (local i32)
+    block  ;; label = @1 - nothing to add
+      local.get 0
+      i32.eqz
+      br_if 0 (;@1;)
+      loop  ;; label = @2 - add n, n - 1, ..., 1
+        local.get 1
+        local.get 0
+        i32.add
+        local.set 1
+        local.get 0
+        i32.const -1
+        i32.add
+        local.tee 0
+        br_if 0 (;@2;)
+      end
+    end
+    local.get 1)
+  (func $count (type 0) (param i32) (result i32)
+    (local i32)
+    loop  ;; label = @1 - count up to n, at least once
+      local.get 1
+      i32.const 1
+      i32.add
+      local.tee 1
+      local.get 0
+      i32.lt_s
+      br_if 0 (;@1;)
+    end
+    local.get 1)
+  (export "sum" (func $sum))
+  (export "count" (func $count))
+)
@@ -2,6 +2,7 @@ from scanner import Scanner
 from parser import Parser
 from settings import *
 from interpeter import Interpreter
+from optimizer import Optimizer
 
 file_path = "/Users/johncabrahams/Desktop/Projects/Research Project/python_compiler/fib.wat"
 
@@ -12,6 +13,8 @@ tokens = Scanner().scanTokens(text_content)
 
 # Our abstract syntax tree
 ast = Parser().parse(tokens)
+# Peephole-optimize the function bodies before instantiating
+ast = Optimizer().optimize(ast)
 
 # Input function name to evaluate
 funcName = "fib"
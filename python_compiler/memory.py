@@ -0,0 +1,467 @@
+"""Linear memory. The bytes live in a single `bytearray` (or `mmap`), and every load and store goes through a
+precompiled `struct.Struct`, so reading an i64 costs one bounds check and one `unpack_from` however large the memory is.
+
+Execution tiers do not interpret load and store instructions themselves: at instantiate time each one is bound
+to an accessor from `Memory.loader`/`Memory.storer`, which already knows its struct and static offset."""
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import weakref
+from settings import *
+from env import Trap
+
+PAGESIZE = 65536
+# Served for reads of every page that was never written. Being `bytes`, it cannot be written by accident
+ZEROPAGE = bytes(PAGESIZE)
+# A 32-bit address space holds at most 65536 pages
+MAXPAGES = 65536
+# Whether mmap.resize works: outside Windows it needs mremap(), which only Linux has
+MMAPRESIZE = sys.platform.startswith("linux") or sys.platform == "win32"
+
+# Loads read values as the interpreter represents them: i32 and i64 signed unless the instruction says otherwise
+LOADSTRUCTS = {
+    I32LOAD: struct.Struct('<i'), I64LOAD: struct.Struct('<q'), F32LOAD: struct.Struct('<f'), F64LOAD: struct.Struct('<d'),
+    I32LOAD8_S: struct.Struct('<b'), I32LOAD8_U: struct.Struct('<B'),
+    I32LOAD16_S: struct.Struct('<h'), I32LOAD16_U: struct.Struct('<H'),
+    I64LOAD8_S: struct.Struct('<b'), I64LOAD8_U: struct.Struct('<B'),
+    I64LOAD16_S: struct.Struct('<h'), I64LOAD16_U: struct.Struct('<H'),
+    I64LOAD32_S: struct.Struct('<i'), I64LOAD32_U: struct.Struct('<I'),
+}
+
+# Stores wrap integers to the stored width with the mask; floats have none
+STORESTRUCTS = {
+    I32STORE: (struct.Struct('<I'), 0xFFFFFFFF), I64STORE: (struct.Struct('<Q'), 0xFFFFFFFFFFFFFFFF),
+    F32STORE: (struct.Struct('<f'), None), F64STORE: (struct.Struct('<d'), None),
+    I32STORE8: (struct.Struct('<B'), 0xFF), I32STORE16: (struct.Struct('<H'), 0xFFFF),
+    I64STORE8: (struct.Struct('<B'), 0xFF), I64STORE16: (struct.Struct('<H'), 0xFFFF),
+    I64STORE32: (struct.Struct('<I'), 0xFFFFFFFF),
+}
+
+
+# NumPy dtypes that can be exchanged with guest memory, fixed to the little-endian layout WebAssembly uses
+DTYPES = {"int32": "<i4", "int64": "<i8", "float32": "<f4", "float64": "<f8"}
+
+
+def numpy():
+    """Import NumPy on first use, so the interpreter runs without it"""
+    try:
+        import numpy
+    except ImportError:
+        raise ValueError("NumPy is required for array exchange and lockstep execution.") from None
+    return numpy
+
+
+def outOfBounds():
+    raise Trap("Out of bounds memory access.")
+
+
+def checkLimits(min, max):
+    """Validate the limits of a memory type and return its maximum in pages"""
+    if max is not None and min > max:
+        raise ValueError("Memory minimum exceeds its maximum.")
+    if min > MAXPAGES:
+        raise ValueError("Memory size exceeds the address space.")
+    return MAXPAGES if max is None else max
+
+
+class MemoryImage:
+    """The contents of a linear memory at one point, as a list of immutable page-sized `bytes`. Pages that were
+    all zeros are the shared ZEROPAGE"""
+
+    def __init__(self, pages, max):
+        self.pages = pages
+        self.max = max
+        # An unlinked file holding the same contents, for backends that map the image (see `MmapMemory`)
+        self.file = None
+
+    def size(self):
+        return len(self.pages)
+
+
+def imageFile(image):
+    """Write `image` to an unlinked file, in memory where the platform allows it. Only non-zero pages are written,
+    so the zero pages stay holes of the file"""
+    if hasattr(os, "memfd_create"):
+        file = open(os.memfd_create("snapshot"), 'w+b')
+    else:
+        file = tempfile.TemporaryFile()
+    file.truncate(image.size() * PAGESIZE)
+    for index, page in enumerate(image.pages):
+        if page is not ZEROPAGE:
+            file.seek(index * PAGESIZE)
+            file.write(page)
+    file.flush()
+    return file
+
+
+def isReleased(view):
+    try:
+        view.nbytes
+    except ValueError:
+        return True
+    return False
+
+
+class Memory:
+    """A linear memory of `min` pages that `memory.grow` may extend up to `max` pages"""
+
+    def __init__(self, min=0, max=None):
+        self.max = checkLimits(min, max)
+        self.data = bytearray(min * PAGESIZE)
+        # Views and NumPy arrays handed to the host, invalidated when growing moves the memory
+        self.views = []
+        self.arrays = []
+
+    def size(self):
+        """The current size in pages (`memory.size`)"""
+        return len(self.data) // PAGESIZE
+
+    def committed(self):
+        """Number of pages backed by host memory, which is all of them"""
+        return self.size()
+
+    def snapshot(self):
+        """A `MemoryImage` of the current contents"""
+        data = self.data
+        pages = []
+        for start in range(0, len(data), PAGESIZE):
+            page = bytes(data[start:start + PAGESIZE])
+            pages.append(ZEROPAGE if page == ZEROPAGE else page)
+        return MemoryImage(pages, self.max)
+
+    @classmethod
+    def fromImage(cls, image):
+        """A new memory holding a copy of `image`. A `bytearray` cannot share pages, so this copies all of them"""
+        memory = cls(image.size(), image.max)
+        for index, page in enumerate(image.pages):
+            if page is not ZEROPAGE:
+                memory.write(index * PAGESIZE, page)
+        return memory
+
+    def grow(self, delta):
+        """Grow by `delta` pages (`memory.grow`). Returns the previous size, or -1 if the memory cannot grow"""
+        previous = len(self.data) // PAGESIZE
+        if delta < 0 or previous + delta > self.max:
+            return -1
+        if delta:
+            self.invalidateViews()
+            self.resize((previous + delta) * PAGESIZE)
+        return previous
+
+    def resize(self, length):
+        try:
+            self.data.extend(bytes(length - len(self.data)))
+        except BufferError:
+            # Something still holds a buffer of the old bytes. It keeps them, and the memory continues in a copy
+            data = bytearray(length)
+            data[:len(self.data)] = self.data
+            self.data = data
+
+    def view(self, address, length):
+        """A zero-copy memoryview of `length` bytes at `address`, for the host to read and write guest memory.
+        Growing the memory releases every view, after which using one raises ValueError; ask for a new one"""
+        if address < 0 or address + length > len(self.data):
+            outOfBounds()
+        self.views = [view for view in self.views if not isReleased(view)]
+        view = memoryview(self.data)[address:address + length]
+        self.views.append(view)
+        return view
+
+    def writeArray(self, address, array, dtype=None):
+        """Copy a NumPy array (or anything NumPy can convert) into memory at `address`, as `dtype` if given.
+        Returns the number of bytes written"""
+        np = numpy()
+        if dtype is not None and dtype not in DTYPES:
+            raise ValueError("Unsupported dtype.")
+        array = np.ascontiguousarray(array, dtype=DTYPES[dtype] if dtype else None)
+        if array.dtype.byteorder == '>':
+            array = array.astype(array.dtype.newbyteorder('<'))
+        self.write(address, memoryview(array).cast('B'))
+        return array.nbytes
+
+    def array(self, address, count, dtype="int32"):
+        """A NumPy array of `count` elements of `dtype` over memory at `address`, sharing the memory's bytes.
+        An array cannot be released like a view, so growing the memory makes it read-only instead: it keeps the old
+        bytes, and writing through it raises ValueError rather than losing the write. Ask for a new one"""
+        np = numpy()
+        if dtype not in DTYPES:
+            raise ValueError("Unsupported dtype.")
+        itemType = np.dtype(DTYPES[dtype])
+        array = np.frombuffer(self.view(address, count * itemType.itemsize), dtype=itemType)
+        self.trackArray(array)
+        return array
+
+    def trackArray(self, array):
+        self.arrays = [reference for reference in self.arrays if reference() is not None]
+        self.arrays.append(weakref.ref(array))
+
+    def invalidateViews(self):
+        for view in self.views:
+            try:
+                view.release()
+            except BufferError:
+                # The view was exported further (to NumPy, say); `resize` leaves that export the old buffer
+                pass
+        self.views = []
+        for reference in self.arrays:
+            array = reference()
+            if array is not None:
+                array.flags.writeable = False
+        self.arrays = []
+
+    def loader(self, op, offset=0):
+        """Return a function reading the value `op` loads from `address + offset`"""
+        unpack = LOADSTRUCTS[op].unpack_from
+        width = LOADSTRUCTS[op].size
+        memory = self
+        def load(address):
+            address += offset
+            data = memory.data
+            if address < 0 or address + width > len(data):
+                outOfBounds()
+            return unpack(data, address)[0]
+        return load
+
+    def storer(self, op, offset=0):
+        """Return a function writing `value` the way `op` stores it at `address + offset`"""
+        packer, mask = STORESTRUCTS[op]
+        pack = packer.pack_into
+        width = packer.size
+        memory = self
+        if mask is None:
+            def store(address, value):
+                address += offset
+                data = memory.data
+                if address < 0 or address + width > len(data):
+                    outOfBounds()
+                pack(data, address, value)
+        else:
+            def store(address, value):
+                address += offset
+                data = memory.data
+                if address < 0 or address + width > len(data):
+                    outOfBounds()
+                pack(data, address, value & mask)
+        return store
+
+    def read(self, address, length):
+        """Copy `length` bytes out of memory, for the host"""
+        if address < 0 or address + length > len(self.data):
+            outOfBounds()
+        return bytes(self.data[address:address + length])
+
+    def write(self, address, data):
+        """Copy bytes into memory, for the host"""
+        if address < 0 or address + len(data) > len(self.data):
+            outOfBounds()
+        self.data[address:address + len(data)] = data
+
+
+class MmapMemory(Memory):
+    """A linear memory in an `mmap`: anonymous, or backed by the file at `path`, whose contents then become the
+    initial contents of the memory. Growing remaps it, releasing the host's views first"""
+
+    def __init__(self, min=0, max=None, path=None):
+        self.max = checkLimits(min, max)
+        self.views = []
+        self.arrays = []
+        self.file = None
+        # Whether `data` maps a snapshot's file copy-on-write (see `fromImage`); such a mapping cannot resize
+        self.copyOnWrite = False
+        if path is not None:
+            self.file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        # mmap cannot map zero bytes, so an empty memory has no mapping until it grows
+        self.data = self.map(min * PAGESIZE) if min else b""
+
+    def map(self, length):
+        if self.file is None:
+            if hasattr(mmap, "MAP_PRIVATE"):
+                # Resizing a shared anonymous mapping leaves the new pages unbacked (SIGBUS), a private one works
+                return mmap.mmap(-1, length, flags=mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS)
+            return mmap.mmap(-1, length)
+        if os.fstat(self.file.fileno()).st_size < length:
+            self.file.truncate(length)
+        return mmap.mmap(self.file.fileno(), length)
+
+    def resize(self, length):
+        if not isinstance(self.data, mmap.mmap):
+            self.data = self.map(length)
+            return
+        if self.file is not None and os.fstat(self.file.fileno()).st_size < length:
+            self.file.truncate(length)
+        if self.copyOnWrite or not MMAPRESIZE:
+            return self.remap(length)
+        try:
+            self.data.resize(length)
+        except BufferError:
+            # Exports of the old mapping keep it alive
+            self.remap(length)
+
+    def remap(self, length):
+        """Move the memory into a new mapping of `length` bytes. A file-backed memory shares the file with the old
+        mapping; an anonymous one, or a copy-on-write one, copies its contents"""
+        remapped = self.map(length)
+        if self.file is None:
+            remapped[:len(self.data)] = self.data
+        self.data = remapped
+        self.copyOnWrite = False
+
+    def snapshot(self):
+        image = Memory.snapshot(self)
+        image.file = imageFile(image)
+        return image
+
+    @classmethod
+    def fromImage(cls, image):
+        """A new memory mapping the file of `image` copy-on-write: the pages are shared with the snapshot, and the
+        operating system copies one when the memory first writes to it. Growing moves the memory into an anonymous
+        mapping, copying it"""
+        if image.file is None:
+            return super().fromImage(image)
+        memory = cls(0, image.max)
+        if image.size():
+            memory.data = mmap.mmap(image.file.fileno(), image.size() * PAGESIZE, access=mmap.ACCESS_COPY)
+            memory.copyOnWrite = True
+        return memory
+
+    def close(self):
+        """Unmap the memory and close its file"""
+        self.invalidateViews()
+        if isinstance(self.data, mmap.mmap):
+            try:
+                self.data.close()
+            except BufferError:
+                pass
+        self.data = b""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class SparseMemory(Memory):
+    """A linear memory whose pages are only allocated when first written, so a module declaring a large memory
+    but touching a few pages costs a few pages. Untouched pages all read from the shared ZEROPAGE.
+    Pages are shared the same way with the snapshot a memory was created from: any page that is still `bytes`
+    (ZEROPAGE or a snapshot page) is copied into a `bytearray` of its own on the first write.
+    Accesses that straddle two pages take a slower path through `read`/`write`"""
+
+    def __init__(self, min=0, max=None):
+        self.max = checkLimits(min, max)
+        self.pages = [ZEROPAGE] * min
+
+    def size(self):
+        return len(self.pages)
+
+    def committed(self):
+        """Number of pages this memory allocated itself, leaving out pages shared with ZEROPAGE or a snapshot"""
+        return sum(1 for page in self.pages if type(page) is not bytes)
+
+    def grow(self, delta):
+        previous = len(self.pages)
+        if delta < 0 or previous + delta > self.max:
+            return -1
+        # New pages cost nothing until they are written
+        self.pages.extend([ZEROPAGE] * delta)
+        return previous
+
+    def view(self, address, length):
+        """A zero-copy view of `length` bytes within one page, allocating the page. Pages never move, so growing
+        leaves views valid"""
+        if address < 0 or address + length > len(self.pages) * PAGESIZE:
+            outOfBounds()
+        start = address & 0xFFFF
+        if start + length > PAGESIZE:
+            raise ValueError("A view of sparse memory cannot span pages.")
+        return memoryview(self.page(address >> 16))[start:start + length]
+
+    def trackArray(self, array):
+        # Pages never move, so arrays stay valid
+        pass
+
+    def page(self, index):
+        """The page at `index`, copying it if it is still shared"""
+        page = self.pages[index]
+        if type(page) is bytes:
+            page = self.pages[index] = bytearray(page)
+        return page
+
+    def snapshot(self):
+        # Pages shared already stay shared; the others are copied, as the memory goes on writing them
+        return MemoryImage([page if type(page) is bytes else bytes(page) for page in self.pages], self.max)
+
+    @classmethod
+    def fromImage(cls, image):
+        """A new memory sharing the pages of `image` until it writes them"""
+        memory = cls(0, image.max)
+        memory.pages.extend(image.pages)
+        return memory
+
+    def loader(self, op, offset=0):
+        unpack = LOADSTRUCTS[op].unpack_from
+        width = LOADSTRUCTS[op].size
+        pages = self.pages
+        memory = self
+        def load(address):
+            address += offset
+            if address < 0 or address + width > len(pages) * PAGESIZE:
+                outOfBounds()
+            start = address & 0xFFFF
+            if start + width > PAGESIZE:
+                return unpack(memory.read(address, width))[0]
+            return unpack(pages[address >> 16], start)[0]
+        return load
+
+    def storer(self, op, offset=0):
+        packer, mask = STORESTRUCTS[op]
+        pack = packer.pack_into
+        width = packer.size
+        pages = self.pages
+        memory = self
+        def store(address, value):
+            address += offset
+            if address < 0 or address + width > len(pages) * PAGESIZE:
+                outOfBounds()
+            if mask is not None:
+                value &= mask
+            start = address & 0xFFFF
+            if start + width > PAGESIZE:
+                memory.write(address, packer.pack(value))
+                return
+            page = pages[address >> 16]
+            if type(page) is bytes:
+                page = memory.page(address >> 16)
+            pack(page, start, value)
+        return store
+
+    def read(self, address, length):
+        if address < 0 or address + length > len(self.pages) * PAGESIZE:
+            outOfBounds()
+        chunks = []
+        while length > 0:
+            start = address & 0xFFFF
+            count = min(length, PAGESIZE - start)
+            chunks.append(self.pages[address >> 16][start:start + count])
+            address += count
+            length -= count
+        return b"".join(chunks)
+
+    def write(self, address, data):
+        if address < 0 or address + len(data) > len(self.pages) * PAGESIZE:
+            outOfBounds()
+        data = memoryview(data).cast('B')
+        position = 0
+        while position < len(data):
+            start = address & 0xFFFF
+            count = min(len(data) - position, PAGESIZE - start)
+            chunk = data[position:position + count]
+            # Writing zeros to a page that is still zero changes nothing
+            if self.pages[address >> 16] is not ZEROPAGE or any(chunk):
+                self.page(address >> 16)[start:start + count] = chunk
+            address += count
+            position += count
+
+
+# Linear memory implementations, selected with `Interpreter(memoryBackend=...)`
+MEMORYBACKENDS = {"dense": Memory, "sparse": SparseMemory, "mmap": MmapMemory}
@@ -0,0 +1,47 @@
+(module
+  (type (;0;) (func (param i32) (result i32)))
+  (memory (;0;) 1)
+  (func $checksum (type 0) (param i32) (result i32)
+    (local i32 i32)
+    block  ;; label = @1 - store n, n - 1, ..., 1 at addresses 4n, 4(n - 1), ..., 4
+      local.get 0
+      i32.eqz
+      br_if 0 (;@1;)
+      local.get 0
+      local.set 1
+      loop  ;; label = @2
+        local.get 1
+        local.get 1
+        i32.add
+        local.tee 2
+        local.get 2
+        i32.add
+        local.get 1
+        i32.store
+        local.get 1
+        i32.const -1
+        i32.add
+        local.tee 1
+        br_if 0 (;@2;)
+      end
+      loop  ;; label = @2 - add them back up
+        local.get 1
+        local.get 0
+        local.get 0
+        i32.add
+        local.tee 2
+        local.get 2
+        i32.add
+        i32.load
+        i32.add
+        local.set 1
+        local.get 0
+        i32.const -1
+        i32.add
+        local.tee 0
+        br_if 0 (;@2;)
+      end
+    end
+    local.get 1)
+  (export "checksum" (func $checksum))
+)
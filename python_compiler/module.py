@@ -0,0 +1,203 @@
+"""Compiled modules. A `Module` is built once from a parsed AST: it validates the module, compiles every function for
+one execution tier and links the calls between them. Nothing in it changes afterwards, so any number of instances
+can share it. An instance is an `Interpreter` bound to the module, which only adds what running code modifies: the
+stacks, the linear memory and the result caches.
+
+    module = Module(Parser().parse(tokens), tier="register")
+    first = module.instantiate()
+    second = module.instantiate(memoryBackend="sparse")
+    first.callExtern("fib", FUNC, 20)
+
+Linked code never refers to an instance. Loads and stores name an entry of `memoryAccesses` by index, and each
+instance binds one accessor per entry to its own memory."""
+from settings import *
+from env import FuncInstance
+import bytecode
+import register
+import closures
+import jit
+import vectorize
+from bytecode import localIndex
+from fusion import fuse
+from purity import analyzePurity, ResultCache
+
+TIERS = ("ast", "bytecode", "register", "closure", "jit")
+# Interpreter options that change the compiled code, and so belong to the Module rather than to each instance
+COMPILEOPTIONS = ("memoize", "cacheSize", "cachePolicy", "superinstructions")
+
+
+def splitOptions(options):
+    """Split `Interpreter` options into those taken by `Module` and those taken by `Module.instantiate`"""
+    compile = {name: value for name, value in options.items() if name in COMPILEOPTIONS}
+    instance = {name: value for name, value in options.items() if name not in COMPILEOPTIONS}
+    return compile, instance
+
+
+class Module:
+    """`tier`, `memoize`, `cacheSize`, `cachePolicy` and `superinstructions` have the meaning described in
+    `Interpreter.__init__`. Raises ValueError for a module the tiers cannot run"""
+
+    def __init__(self, ast, tier="ast", memoize=False, cacheSize=1024, cachePolicy="lru", superinstructions=None):
+        if tier not in TIERS:
+            raise ValueError("Unknown execution tier.")
+        if cachePolicy not in ResultCache.POLICIES:
+            raise ValueError("Unknown eviction policy.")
+        self.ast = ast
+        self.env = ast['env']
+        self.tier = tier
+        self.memoize = memoize
+        self.cacheSize = cacheSize
+        self.cachePolicy = cachePolicy
+        self.superinstructions = superinstructions
+        self.signatures = bytecode.moduleSignatures(ast)
+        self.types = {}
+        self.functions = {}
+        # Export name -> function index, and the export fields keyed by function index
+        self.exports = {}
+        self.exportFields = {}
+        # Page limits of the module's memory, and the (module, name) it is imported from
+        self.memoryType = None
+        self.memoryImport = None
+        # Function run when an instance is created
+        self.start = None
+        # Distinct (instruction, offset) pairs of every load and store, and the index of each pair in the list
+        self.memoryAccesses = []
+        self.accessIndices = {}
+        for field in ast['fields']:
+            if field['type'] == TYPE:
+                self.types[field['id']] = field
+            elif field['type'] == FUNC:
+                self.functions[field['id']] = FuncInstance(field)
+            elif field['type'] == IMPORT:
+                if field['importDesc']['type'] == MEMORY:
+                    self.memoryType = field['importDesc']['valtype']
+                    self.memoryImport = (field['module'], field['name'])
+            elif field['type'] == MEMORY:
+                self.memoryType = field['valtype']
+            elif field['type'] == EXPORT:
+                self.exports[field['name']] = field['id']
+                self.exportFields[field['id']] = field
+            elif field['type'] == START:
+                self.start = field['id']
+        self.validate()
+        self.pure = analyzePurity(ast) if memoize else set()
+        for funcidx in self.pure:
+            self.functions[funcidx].memoized = True
+        self.jit = None
+        if tier == "bytecode" or tier == "register":
+            for funcidx, code in bytecode.compileModule(ast).items():
+                if superinstructions and tier == "bytecode":
+                    fuse(code, superinstructions)
+                self.functions[funcidx].code = code
+        elif tier == "jit":
+            # Sources are generated and compiled here; each instance only executes the code objects
+            self.jit = jit.Jit(ast, self.memoryType is not None)
+            self.jit.compileModule()
+        # Runs functions in lockstep over NumPy arrays of inputs, built on the first vectorized call
+        self.lockstepRunner = None
+        self.link()
+        if tier == "register":
+            # Lowered after linking, so call entries already hold their callee
+            for function in self.functions.values():
+                function.registers = register.lowerCode(function.code, function.template.defaults)
+        # Closure trees of the closure tier, built from the linked instructions and shared by every instance
+        self.closures = closures.compileModule(self.functions) if tier == "closure" else {}
+
+    def instantiate(self, imports=None, **options):
+        """Create a new instance of the module and run its start function. `options` are passed on to `Interpreter`,
+        e.g. `memoryBackend`"""
+        return self.interpreter(**options).bind(self, imports)
+
+    def interpreter(self, **options):
+        """An interpreter with this module's compile options, not bound to anything yet. Compile options may be
+        repeated in `options` but not changed"""
+        from interpeter import Interpreter
+        for name in COMPILEOPTIONS:
+            if name in options and options.pop(name) != getattr(self, name):
+                raise ValueError(f"{name} is fixed when the module is compiled; pass it to Module instead.")
+        if options.pop("tier", self.tier) != self.tier:
+            raise ValueError("The module was compiled for another tier.")
+        return Interpreter(tier=self.tier, memoize=self.memoize, cacheSize=self.cacheSize, cachePolicy=self.cachePolicy,
+                           superinstructions=self.superinstructions, **options)
+
+    def lockstep(self):
+        """The `vectorize.Lockstep` of the functions that can run in lockstep"""
+        if self.lockstepRunner is None:
+            self.lockstepRunner = vectorize.Lockstep(self.ast, vectorize.vectorizable(self.ast))
+        return self.lockstepRunner
+
+    def validate(self):
+        """Reject what the tiers would otherwise only fail on halfway through a call"""
+        for name, funcidx in self.exports.items():
+            if funcidx not in self.functions:
+                raise ValueError("Export of an unknown function.")
+        if self.start is not None:
+            if self.start not in self.functions:
+                raise ValueError("Unknown start function.")
+            template = self.functions[self.start].template
+            if template.paramCount or template.returnArity:
+                raise ValueError("The start function must take no arguments and return nothing.")
+        for function in self.functions.values():
+            self.validateSequence(function.field['instr'], function.field['frame'], 0)
+
+    def validateSequence(self, instructions, frame, depth):
+        for instruction in instructions:
+            type = instruction['type']
+            if type == BLOCK or type == LOOP:
+                self.validateSequence(instruction['instructions'], frame, depth + 1)
+            elif type == BR or type == BR_IF:
+                if int(instruction['operand']) > depth:
+                    raise ValueError("Branch to an unknown label.")
+            elif type == CALL:
+                funcidx = self.env.getIdentifierIndex("funcs", instruction['operand'])
+                if funcidx not in self.signatures:
+                    raise ValueError("Call to an unknown function.")
+                if funcidx not in self.functions:
+                    raise ValueError("Calls to imported functions are not supported.")
+            elif type == LOCALGET or type == LOCALSET or type == LOCALTEE:
+                if localIndex(frame, instruction['operand']) not in frame.locals:
+                    raise ValueError("Unknown local.")
+            elif type in LOADS or type in STORES or type == MEMORYSIZE or type == MEMORYGROW:
+                if self.memoryType is None:
+                    raise ValueError("Memory instruction without a memory.")
+
+    def accessIndex(self, op, offset):
+        """Index of the accessor performing a load or store at a static offset"""
+        key = (op, offset)
+        if key not in self.accessIndices:
+            self.accessIndices[key] = len(self.memoryAccesses)
+            self.memoryAccesses.append(key)
+        return self.accessIndices[key]
+
+    def link(self):
+        """Rewrite every call operand to the callee's function instance, so calls cost the same however many functions
+        the module has, and every load and store to the index of its accessor"""
+        for function in self.functions.values():
+            function.instr = self.linkSequence(function.field['instr'])
+            if function.code is not None:
+                entries = function.code.entries
+                for pc, (op, imm) in enumerate(entries):
+                    if op == CALL:
+                        entries[pc] = (CALL, self.functions[imm])
+                    elif op in LOADS:
+                        entries[pc] = (LOAD, self.accessIndex(op, imm))
+                    elif op in STORES:
+                        entries[pc] = (STORE, self.accessIndex(op, imm))
+
+    def linkSequence(self, instructions):
+        """Copy an instruction sequence with its calls linked. The parsed AST itself is left untouched"""
+        linked = []
+        for instruction in instructions:
+            if instruction['type'] == BLOCK or instruction['type'] == LOOP:
+                instruction = dict(instruction, instructions=self.linkSequence(instruction['instructions']))
+            elif instruction['type'] == CALL:
+                funcidx = self.env.getIdentifierIndex("funcs", instruction['operand'])
+                instruction = dict(instruction, operand=self.functions[funcidx])
+            elif instruction['type'] in LOADS or instruction['type'] in STORES:
+                instruction = dict(instruction, access=self.accessIndex(instruction['type'], instruction['operand']['offset']))
+            linked.append(instruction)
+        return linked
+
+    def exportIndex(self, funcname):
+        """Function index of an export, or None if the module does not export `funcname`"""
+        return self.exports.get(funcname)
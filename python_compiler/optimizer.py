@@ -0,0 +1,137 @@
+"""Peephole optimizer run between `Parser.parse` and `Interpreter.instantiate`. It rewrites the instruction lists of
+every function, so all execution tiers benefit:
+
+    optimizer = Optimizer()
+    ast = optimizer.optimize(Parser().parse(tokens))
+    optimizer.stats -> {"unreachable": 0, "fold": 2, "identity": 2, "tee": 1}
+
+Each pass works on one instruction sequence at a time. Nothing branches into the middle of a sequence, so
+neighbouring instructions can be rewritten freely. Folded values follow the interpreter's semantics."""
+from settings import *
+from bytecode import localIndex, toUnsigned
+
+FOLDABLE = {
+    ADD: lambda first, second: first + second,
+    SUB: lambda first, second: first - second,
+    GE_S: lambda first, second: int(first >= second),
+    GT_U: lambda first, second: int(toUnsigned(first) > toUnsigned(second)),
+    LT_S: lambda first, second: int(first < second),
+    EQ: lambda first, second: int(first == second),
+    OR: lambda first, second: int(first or second),
+    AND: lambda first, second: first & second,
+}
+
+# Binary instructions that leave their first operand unchanged when the second is this constant
+IDENTITIES = {ADD: 0, SUB: 0, OR: 0, AND: -1}
+
+
+def size(instructions):
+    """Number of instructions in a sequence, counting those nested in blocks and loops"""
+    return sum(1 + size(instruction['instructions']) if instruction['type'] in (BLOCK, LOOP) else 1
+               for instruction in instructions)
+
+
+def isConst(instruction):
+    return instruction['type'] == CONST
+
+
+def removeUnreachable(instructions, frame):
+    """Drop everything after an unconditional branch or a return"""
+    for position, instruction in enumerate(instructions):
+        if instruction['type'] == BR or instruction['type'] == RETURN:
+            return instructions[:position + 1]
+    return instructions
+
+
+def foldConstants(instructions, frame):
+    """Replace operations whose operands are all constants by the constant they compute"""
+    folded = []
+    for instruction in instructions:
+        type = instruction['type']
+        if type in FOLDABLE and len(folded) >= 2 and isConst(folded[-2]) and isConst(folded[-1]):
+            second = int(folded.pop()['operand'])
+            first = int(folded.pop()['operand'])
+            instruction = {"type": CONST, "operand": FOLDABLE[type](first, second)}
+        elif type == EQZ and folded and isConst(folded[-1]):
+            instruction = {"type": CONST, "operand": int(int(folded.pop()['operand']) == 0)}
+        folded.append(instruction)
+    return folded
+
+
+def removeIdentities(instructions, frame):
+    """Remove `i32.const 0; i32.add` and the like, and values pushed only to be dropped"""
+    kept = []
+    for instruction in instructions:
+        type = instruction['type']
+        if type in IDENTITIES and kept and isConst(kept[-1]) and int(kept[-1]['operand']) == IDENTITIES[type]:
+            kept.pop()
+            continue
+        if type == DROP and kept and kept[-1]['type'] in (CONST, LOCALGET):
+            kept.pop()
+            continue
+        kept.append(instruction)
+    return kept
+
+
+def mergeTees(instructions, frame):
+    """Turn `local.set N; local.get N` into `local.tee N`"""
+    merged = []
+    for instruction in instructions:
+        if (instruction['type'] == LOCALGET and merged and merged[-1]['type'] == LOCALSET
+                and localIndex(frame, merged[-1]['operand']) == localIndex(frame, instruction['operand'])):
+            merged[-1] = {"type": LOCALTEE, "operand": merged[-1]['operand']}
+            continue
+        merged.append(instruction)
+    return merged
+
+
+# Pass name -> function rewriting one instruction sequence, in the order they run
+PASSES = {
+    "unreachable": removeUnreachable,
+    "fold": foldConstants,
+    "identity": removeIdentities,
+    "tee": mergeTees,
+}
+
+
+class Optimizer:
+    """Runs the selected `passes` (all of PASSES by default) over every function of a module until none of them
+    changes anything, or for at most `maxRounds` rounds. `stats` counts the instructions each pass removed"""
+
+    def __init__(self, passes=None, maxRounds=8):
+        passes = tuple(PASSES) if passes is None else tuple(passes)
+        for name in passes:
+            if name not in PASSES:
+                raise ValueError("Unknown optimizer pass.")
+        self.passes = [name for name in PASSES if name in passes]
+        self.maxRounds = maxRounds
+        self.stats = {name: 0 for name in self.passes}
+
+    def optimize(self, ast):
+        """Return a copy of the AST with optimized function bodies. The parsed AST itself is left untouched"""
+        fields = []
+        for field in ast['fields']:
+            if field['type'] == FUNC:
+                field = dict(field, instr=self.optimizeBody(field['instr'], field['frame']))
+            fields.append(field)
+        return dict(ast, fields=fields)
+
+    def optimizeBody(self, instructions, frame):
+        for _ in range(self.maxRounds):
+            before = size(instructions)
+            for name in self.passes:
+                instructions = self.runPass(name, instructions, frame)
+            if size(instructions) == before:
+                break
+        return instructions
+
+    def runPass(self, name, instructions, frame):
+        """Run one pass over a sequence and, innermost first, over the blocks and loops it contains"""
+        nested = []
+        for instruction in instructions:
+            if instruction['type'] == BLOCK or instruction['type'] == LOOP:
+                instruction = dict(instruction, instructions=self.runPass(name, instruction['instructions'], frame))
+            nested.append(instruction)
+        rewritten = PASSES[name](nested, frame)
+        self.stats[name] += size(nested) - size(rewritten)
+        return rewritten
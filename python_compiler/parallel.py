@@ -0,0 +1,172 @@
+"""Runs export calls on a pool of worker processes, so guest code uses every core despite the GIL. Each worker scans,
+parses and compiles the module once when it starts, then serves chunks of calls from its own instance:
+
+    with ParallelRunner(source, tier="register", workers=4) as runner:
+        results = list(runner.map("fib", [(n,) for n in range(1000)]))
+
+Only the WAT source, the export name and the argument tuples cross process boundaries.
+
+`SubinterpreterRunner` serves the same calls from instances in the current process, dispatched from a host thread
+pool. Each instance lives in a sub-interpreter under its own GIL where `concurrent.interpreters` exists (CPython
+3.14+). CPython 3.12 and 3.13 have no public sub-interpreter API, so there the instances run on the host threads."""
+import os
+import queue
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from scanner import Scanner
+from parser import Parser
+from module import Module, splitOptions
+
+try:
+    # Sub-interpreters with a GIL of their own, CPython 3.14+
+    from concurrent import interpreters
+except ImportError:
+    interpreters = None
+
+# The instance of the worker process, created by `startWorker`
+workerInstance = None
+
+
+def startWorker(source, tier, options):
+    global workerInstance
+    compileOptions, instanceOptions = splitOptions(options)
+    module = Module(Parser().parse(Scanner().scanTokens(source)), tier, **compileOptions)
+    workerInstance = module.instantiate(**instanceOptions)
+
+
+def runChunk(funcname, chunk):
+    return workerInstance.invokeMany(funcname, chunk, asList=True)
+
+
+def availableCores():
+    return len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+
+
+class ParallelRunner:
+    """A pool of `workers` processes (all available cores by default) each holding an instance of the module in
+    `source`, compiled for `tier`. `options` are passed on to `Interpreter`. Calls are sent `chunkSize` argument
+    tuples at a time. With `ordered` results come back in the order of the arguments, otherwise as chunks complete,
+    as (position, result) pairs"""
+
+    def __init__(self, source, tier="register", workers=None, chunkSize=256, ordered=True, **options):
+        if chunkSize < 1:
+            raise ValueError("Chunk size must be positive.")
+        self.workers = workers or availableCores()
+        self.chunkSize = chunkSize
+        self.ordered = ordered
+        self.executor = ProcessPoolExecutor(self.workers, initializer=startWorker, initargs=(source, tier, options))
+
+    def chunks(self, argsIterable):
+        """Split the argument tuples into (position of the first, list of tuples) chunks"""
+        chunk = []
+        start = 0
+        for args in argsIterable:
+            chunk.append(tuple(args))
+            if len(chunk) == self.chunkSize:
+                yield start, chunk
+                start += len(chunk)
+                chunk = []
+        if chunk:
+            yield start, chunk
+
+    def map(self, funcname, argsIterable):
+        """Call an export once per argument tuple, yielding results as `invokeMany` does. At most two chunks per
+        worker are in flight, so arguments are consumed lazily"""
+        chunks = self.chunks(argsIterable)
+        limit = 2 * self.workers
+        if self.ordered:
+            pending = deque()
+            for start, chunk in chunks:
+                pending.append(self.submit(funcname, chunk))
+                if len(pending) >= limit:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+            return
+        pending = {}
+        for start, chunk in chunks:
+            pending[self.submit(funcname, chunk)] = start
+            if len(pending) >= limit:
+                yield from self.completed(pending)
+        while pending:
+            yield from self.completed(pending)
+
+    def submit(self, funcname, chunk):
+        return self.executor.submit(runChunk, funcname, chunk)
+
+    def completed(self, pending):
+        """Wait for at least one chunk and yield the (position, result) pairs of every finished one"""
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            start = pending.pop(future)
+            for offset, result in enumerate(future.result()):
+                yield start + offset, result
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def subinterpretersAvailable():
+    return interpreters is not None
+
+
+class SubinterpreterRunner(ParallelRunner):
+    """A `ParallelRunner` whose `workers` instances live in this process rather than in worker processes, so nothing
+    is pickled and no process is started. A thread pool of the same size dispatches the chunks, each thread borrowing
+    whichever instance is free. In isolated mode every instance lives in a sub-interpreter, which imports the
+    interpreter and compiles the module once.
+
+    `isolated` selects the mode: None (the default) uses sub-interpreters when this Python has them, True requires
+    them and False runs the instances on host threads under the shared GIL. `concurrent.interpreters` only exists from
+    CPython 3.14; on 3.12 and 3.13 the default falls back to threads and True raises ValueError. `isolated` tells
+    which mode was picked"""
+
+    def __init__(self, source, tier="register", workers=None, chunkSize=256, ordered=True, isolated=None, **options):
+        if chunkSize < 1:
+            raise ValueError("Chunk size must be positive.")
+        if isolated and not subinterpretersAvailable():
+            raise ValueError("Sub-interpreters need CPython 3.14 or newer.")
+        self.isolated = subinterpretersAvailable() if isolated is None else isolated
+        self.workers = workers or availableCores()
+        self.chunkSize = chunkSize
+        self.ordered = ordered
+        compileOptions = splitOptions(options)[0]
+        self.module = None if self.isolated else Module(Parser().parse(Scanner().scanTokens(source)), tier, **compileOptions)
+        # Sub-interpreters (or host instances) not running a chunk at the moment
+        self.idle = queue.SimpleQueue()
+        self.slots = [self.createSlot(source, tier, options) for _ in range(self.workers)]
+        for slot in self.slots:
+            self.idle.put(slot)
+        self.executor = ThreadPoolExecutor(self.workers)
+
+    def createSlot(self, source, tier, options):
+        if not self.isolated:
+            return self.module.instantiate(**splitOptions(options)[1])
+        interpreter = interpreters.create()
+        interpreter.exec(f"import sys; sys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r})")
+        interpreter.call(startWorker, source, tier, options)
+        return interpreter
+
+    def submit(self, funcname, chunk):
+        return self.executor.submit(self.runChunk, funcname, chunk)
+
+    def runChunk(self, funcname, chunk):
+        slot = self.idle.get()
+        try:
+            if self.isolated:
+                return slot.call(runChunk, funcname, chunk)
+            return slot.invokeMany(funcname, chunk, asList=True)
+        finally:
+            self.idle.put(slot)
+
+    def close(self):
+        self.executor.shutdown()
+        if self.isolated:
+            for interpreter in self.slots:
+                interpreter.close()
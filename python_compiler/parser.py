@@ -56,9 +56,18 @@ class Parser:
                 moduleField = self.parseGlobal()
             elif self.checkKeyword(IMPORT):
                 moduleField = self.parseImport()
+            # Check if we are parsing the start function
+            elif self.checkKeyword(START):
+                moduleField = {"type": START, "id": self.parseReference()}
             # Assert closing parentheses
             self.checkClosingParentheses()
             moduleFields.append(moduleField)
+        # Exports and the start function may name functions defined further down, so they are resolved last
+        for moduleField in moduleFields:
+            if moduleField.get('type') == EXPORT or moduleField.get('type') == START:
+                moduleField['id'] = self.identifierContext.getIdentifierIndex("funcs", moduleField['id'])
+                if moduleField['id'] is None and moduleField['type'] == START:
+                    raise ValueError("Unknown start function.")
         return moduleFields
 
 
@@ -83,6 +92,12 @@ class Parser:
             return self.identifierContext.addIdentifierIndex(type, identifier)
         return self.identifierContext.addIdentifierIndex(type, None)
 
+    def parseReference(self):
+        """Consume an index or identifier without resolving it, for references that may come before the definition"""
+        reference = self.tokens.nextToken().literal
+        self.tokens.popToken()
+        return reference
+
     def parseIdx(self, type):
         """Inverse of `parseOptionalIdentifier()` (i.e., get instead of set). 
            return the index itself or the index associated with the identifier"""
@@ -122,7 +137,7 @@ class Parser:
         # parse Typeuse
         if self.checkKeyword(TYPE):
             # Add mapping from the id or the integer index to the functional type in the identifier context
-            parsedTypeIdx = self.parseIdx('type')
+            parsedTypeIdx = self.parseIdx('types')
             self.checkClosingParentheses()
 
             self.parseParams(frame)
@@ -133,7 +148,7 @@ class Parser:
             self.parseParams(frame)
             self.parseResults(frame)
             # If a type index does not exist, then it is inserted based on the global scope
-            typeidx = self.identifierContext.createIdentifierIndex("types", None)
+            typeidx = self.identifierContext.addIdentifierIndex("types", None)
             # If we are not parsing a block, then add the implicit type to the end of the module
             #if not parseBlock: self.typesToInsert.append({"type": TYPE, "id": typeidx, "params": env.getParams(), "results": env.getResults()})
             return typeidx, frame
@@ -143,11 +158,11 @@ class Parser:
             # Abbreviation mechanism. This mechanism only works for parameters with no ids
             if self.tokens.nextToken().type in [I32, I64, F32, F64] and self.tokens.nextToken().type in [I32, I64, F32, F64]:
                 while not self.checkClosingParentheses():
-                    # Pop token
-                    self.tokens.popToken()
                     # Add anonymous parameters of certain types to the local environment's locals   
                     identifier = None
                     type = self.tokens.nextToken().type
+                    # Pop token
+                    self.tokens.popToken()
                     frame.setLocal({"id": identifier, "type": type})
                     frame.addArg({"id": identifier, "type": type})
 
@@ -175,10 +190,10 @@ class Parser:
             # Abbreviation mechanism. This mechanism only works for parameters with no ids
             if self.tokens.nextToken().type in [I32, I64, F32, F64] and self.tokens.nextToken().type in [I32, I64, F32, F64]:
                 while not self.checkClosingParentheses():
-                    # Pop token
-                    self.tokens.popToken()
                     identifier = None
                     type = self.tokens.nextToken().type
+                    # Pop token
+                    self.tokens.popToken()
                     frame.setLocal({"id": identifier, "type": type})
 
             # Regular parsing mechanism (i.e., no abbreviations)
@@ -209,7 +224,8 @@ class Parser:
         
     def parseInstruction(self):
         block = self.checkKeyword(BLOCK)
-        loop = self.checkKeyword(LOOP)
+        # Only look for a loop if we did not just consume a block, otherwise `block loop` loses the loop
+        loop = not block and self.checkKeyword(LOOP)
         if block or loop:
             # Add optional label to the local environment 
             # label = self.parseOptionalIdentifier("labels")
@@ -225,6 +241,8 @@ class Parser:
         else:
             instructionType = self.tokens.nextToken().type
             self.tokens.popToken()
+            if instructionType in LOADS or instructionType in STORES:
+                return {"type": instructionType, "operand": self.parseMemarg()}
             if self.tokens.nextToken().type == ID or self.tokens.nextToken().type == INT:
                 op = self.tokens.nextToken().literal
                 self.tokens.popToken()
@@ -233,6 +251,20 @@ class Parser:
                 return {"type": instructionType, "operand": None}
         
 
+    def parseMemarg(self):
+        """Parse the optional `offset=` and `align=` of a load or store. A missing alignment means the natural one"""
+        memarg = {"type": MEMARG, "offset": 0, "align": None}
+        for type, key in ((OFFSET, "offset"), (ALIGN, "align")):
+            if self.tokens.nextToken().type == type:
+                memarg[key] = int(self.tokens.nextToken().literal.split("=")[1], 0)
+                self.tokens.popToken()
+        return memarg
+
+    def parseMemory(self):
+        id = self.parseOptionalIdentifier("mems")
+        memtype = self.parseLimits()
+        return {"type": MEMORY, "id": id, "valtype": memtype}
+
     def parseImport(self):
         module = self.tokens.nextToken().literal
         self.tokens.popToken()
@@ -275,7 +307,8 @@ class Parser:
     def parseExportDesc(self):
         self.checkOpenParentheses()
         if self.checkKeyword(FUNC):
-            idx = self.parseIdx("funcs")
+            idx = self.parseReference()
+            self.checkClosingParentheses()
             return idx
     def parseLimits(self):
         min = max = 0
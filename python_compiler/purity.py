@@ -0,0 +1,134 @@
+"""Finds the functions of a module whose results depend only on their arguments, and the result caches
+used to memoize them."""
+import threading
+from collections import OrderedDict
+from settings import *
+
+# Instructions that only touch the operand stack, the locals and control flow. Anything else (globals, memory,
+# tables, call_indirect, instructions added later) makes a function impure until it is added here
+PUREINSTRUCTIONS = {
+    BLOCK, LOOP, BR, BR_IF, RETURN, LOCALGET, LOCALSET, LOCALTEE, CONST, DROP,
+    ADD, SUB, AND, OR, EQ, EQZ, GE_S, GT_U, LT_S,
+}
+
+# Marks a cache miss, since a function without results caches None
+MISSING = object()
+
+
+def calleesOf(instructions, env, callees):
+    """Add the indices of the functions called by an instruction sequence to `callees`.
+    Returns False if the sequence contains an impure instruction"""
+    for instruction in instructions:
+        type = instruction['type']
+        if type == CALL:
+            callees.add(env.getIdentifierIndex("funcs", instruction['operand']))
+        elif type not in PUREINSTRUCTIONS:
+            return False
+        elif type == BLOCK or type == LOOP:
+            if not calleesOf(instruction['instructions'], env, callees):
+                return False
+    return True
+
+
+def analyzePurity(ast):
+    """Return the indices of the pure functions of a parsed module: functions whose bodies are pure and
+    whose whole call graph only reaches other pure functions defined in the module"""
+    callGraph = {}
+    for field in ast['fields']:
+        if field['type'] == FUNC:
+            callees = set()
+            if calleesOf(field['instr'], ast['env'], callees):
+                callGraph[field['id']] = callees
+    # Start from every function with a pure body and drop those calling anything impure (imports included) until nothing changes
+    pure = set(callGraph)
+    changed = True
+    while changed:
+        changed = False
+        for funcidx in list(pure):
+            if not callGraph[funcidx] <= pure:
+                pure.discard(funcidx)
+                changed = True
+    return pure
+
+
+class ResultCache:
+    """Bounded cache of a function's results keyed by its arguments. Safe to share between threads.
+    `policy` is "lru" (evict the least recently used entry) or "fifo" (evict the oldest entry)"""
+    POLICIES = ("lru", "fifo")
+
+    def __init__(self, maxsize=1024, policy="lru"):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown eviction policy.")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Reordering and eviction are not atomic, so lookups and insertions take turns
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached results for `key`, or MISSING"""
+        with self.lock:
+            results = self.entries.get(key, MISSING)
+            if results is MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+                if self.policy == "lru":
+                    self.entries.move_to_end(key)
+            return results
+
+    def put(self, key, results):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.entries[key] = results
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "size": len(self.entries)}
+
+
+def callMemoized(cache, stack, paramCount, returnArity, run):
+    """Call a function whose arguments are on top of `stack` (the list backing the operand stack), answering from
+    `cache` when possible. `run` performs the actual call, leaving the results on the stack"""
+    base = len(stack) - paramCount
+    key = tuple(stack[base:])
+    results = cache.get(key)
+    if results is MISSING:
+        run()
+        cache.put(key, tuple(stack[len(stack) - returnArity:]))
+    else:
+        del stack[base:]
+        stack.extend(results)
+
+
+def memoizeCompiled(cache, compiled):
+    """Wrap a JIT-compiled function, which takes its arguments and returns its results as Python values"""
+    def memoized(*args):
+        results = cache.get(args)
+        if results is MISSING:
+            results = compiled(*args)
+            cache.put(args, results)
+        return results
+    return memoized
+
+
+def memoizeResults(cache, run):
+    """Wrap a function taking a tuple of arguments and returning the list of its results"""
+    def memoized(args):
+        results = cache.get(args)
+        if results is MISSING:
+            results = tuple(run(args))
+            cache.put(args, results)
+        return results
+    return memoized
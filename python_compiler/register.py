@@ -0,0 +1,203 @@
+"""Lowers flat bytecode into a register-based IR. The operand stack disappears: every stack slot, every local and
+every constant gets its own register, and each instruction names the registers it reads and writes, so
+`local.get 0; i32.const 2; i32.ge_s` becomes a single `GE_S r3, r0, r5`.
+
+Every entry is an (opcode, a, b, c) tuple:
+    ADD/SUB/AND/OR/EQ/GE_S/GT_U/LT_S -> (op, dest, first, second)
+    EQZ/MOVE                         -> (op, dest, source, None)
+    LOAD                             -> (LOAD, dest, address, accessor index)
+    STORE                            -> (STORE, accessor index, address, value)
+    MEMORYSIZE                       -> (MEMORYSIZE, dest, None, None)
+    MEMORYGROW                       -> (MEMORYGROW, dest, delta, None)
+    BR                               -> (BR, target, None, None)
+    BR_IF                            -> (BR_IF, target, condition, None)
+    CALL                             -> (CALL, callee, argument registers, first result register)
+    RETURN                           -> (RETURN, result registers, None, None)
+
+Registers are numbered locals first, then one per stack slot, then the constants of the function."""
+from settings import *
+
+BINARY = {ADD, SUB, AND, OR, EQ, GE_S, GT_U, LT_S}
+
+
+class RegisterCode:
+    """Register IR for a single function"""
+    __slots__ = ('entries', 'paramCount', 'returnArity', 'tail')
+
+    def __init__(self, entries, paramCount, returnArity, tail):
+        self.entries = entries
+        self.paramCount = paramCount
+        self.returnArity = returnArity
+        # Initial values of every register after the parameters: the other locals, the stack slots and the constants
+        self.tail = tail
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class RegisterLowering:
+    """Lowers the bytecode of one function.
+    Values pushed by `local.get` and `i32.const` are not copied anywhere: the symbolic stack just refers to the
+    local's or the constant's register until something needs the value in its stack slot"""
+
+    def __init__(self, code, defaults):
+        self.code = code
+        self.localCount = code.localCount
+        self.defaults = defaults
+        self.slotCount = max(code.heights, default=0) + 1
+        self.constants = {}
+        self.entries = []
+        # Register holding each operand stack slot at the current point
+        self.symbolic = []
+        # The last entry emitted and the stack slot it wrote, which a following local.set may write directly instead
+        self.lastWrite = None
+        # Entries branching within the register code rather than to a bytecode position
+        self.internal = set()
+
+    def slot(self, height):
+        return self.localCount + height
+
+    def constant(self, value):
+        if value not in self.constants:
+            self.constants[value] = self.localCount + self.slotCount + len(self.constants)
+        return self.constants[value]
+
+    def emit(self, op, a, b=None, c=None):
+        self.entries.append([op, a, b, c])
+        self.lastWrite = None
+
+    def materialize(self, register=None):
+        """Copy stack values into their own slots: those referring to `register`, or all of them"""
+        for height, source in enumerate(self.symbolic):
+            if source != self.slot(height) and (register is None or source == register):
+                self.emit(MOVE, self.slot(height), source)
+                self.symbolic[height] = self.slot(height)
+
+    def write(self, op, a, b=None):
+        """Emit an instruction producing a value into the next stack slot"""
+        dest = self.slot(len(self.symbolic))
+        self.emit(op, dest, a, b)
+        self.lastWrite = (len(self.entries) - 1, dest)
+        self.symbolic.append(dest)
+
+    def store(self, local, value):
+        """Store `value` into a local, redirecting the instruction that just computed it when possible"""
+        if value == local:
+            return
+        self.materialize(local)
+        if self.lastWrite is not None and self.lastWrite[1] == value:
+            self.entries[self.lastWrite[0]][1] = local
+        else:
+            self.emit(MOVE, local, value)
+
+    def branch(self, target):
+        """Move the values a branch keeps into the slots its target expects, materializing the rest of the stack"""
+        target, height, arity = target
+        kept = self.symbolic[len(self.symbolic) - arity:] if arity else []
+        del self.symbolic[height:]
+        self.materialize()
+        for offset, source in enumerate(kept):
+            if source != self.slot(height + offset):
+                self.emit(MOVE, self.slot(height + offset), source)
+        return target
+
+    def lower(self):
+        code = self.code
+        targets = {entry[1][0] for entry in code.entries if entry[0] in (BR, BR_IF)}
+        positions = {}
+        reachable = True
+        for pc, (op, imm) in enumerate(code.entries):
+            if pc in targets:
+                # Control merges here, so every path must leave the stack in the same registers
+                if reachable:
+                    self.materialize()
+                self.symbolic = [self.slot(height) for height in range(code.heights[pc])]
+                self.lastWrite = None
+                reachable = True
+            positions[pc] = len(self.entries)
+            if not reachable:
+                continue
+            reachable = self.lowerEntry(op, imm)
+        # Branch targets refer to bytecode positions until now, except for the skips of conditional moves
+        for index, entry in enumerate(self.entries):
+            if (entry[0] == BR or entry[0] == BR_IF) and index not in self.internal:
+                entry[1] = positions[entry[1]]
+        tail = list(self.defaults) + [0] * self.slotCount + list(self.constants)
+        return RegisterCode([tuple(entry) for entry in self.entries], code.paramCount, code.returnArity, tail)
+
+    def lowerEntry(self, op, imm):
+        """
+            False -> the following entries are unreachable until the next branch target
+            True -> continue lowering
+        """
+        symbolic = self.symbolic
+        if op == LOCALGET:
+            symbolic.append(imm)
+        elif op == CONST:
+            symbolic.append(self.constant(imm))
+        elif op in BINARY:
+            second = symbolic.pop()
+            first = symbolic.pop()
+            self.write(op, first, second)
+        elif op == EQZ:
+            self.write(EQZ, symbolic.pop())
+        elif op == LOCALSET:
+            value = symbolic.pop()
+            self.store(imm, value)
+        elif op == LOCALTEE:
+            value = symbolic[-1]
+            self.store(imm, value)
+            symbolic[-1] = imm
+            # The local holds the value now; its stack slot may be stale
+            self.lastWrite = None
+        elif op == DROP:
+            symbolic.pop()
+        elif op == LOAD:
+            self.write(LOAD, symbolic.pop(), imm)
+        elif op == STORE:
+            value = symbolic.pop()
+            self.emit(STORE, imm, symbolic.pop(), value)
+        elif op == MEMORYSIZE:
+            self.write(MEMORYSIZE, imm)
+        elif op == MEMORYGROW:
+            self.write(MEMORYGROW, symbolic.pop(), imm)
+        elif op == CALL:
+            code = imm.code
+            arguments = tuple(symbolic[len(symbolic) - code.paramCount:])
+            del symbolic[len(symbolic) - code.paramCount:]
+            base = self.slot(len(symbolic))
+            self.emit(CALL, imm, arguments, base)
+            symbolic.extend(range(base, base + code.returnArity))
+        elif op == BR:
+            self.emit(BR, self.branch(imm))
+            return False
+        elif op == BR_IF:
+            condition = symbolic.pop()
+            # Values above the target's height are dead once the branch is taken, so nothing is moved
+            self.materialize()
+            target, height, arity = imm
+            if arity and height != len(symbolic) - arity:
+                # The kept values have to move down first, so only the taken path may run the moves:
+                # skip them unless the condition holds, then branch as `br` does
+                self.emit(EQZ, self.slot(len(symbolic)), condition)
+                skip = len(self.entries)
+                self.emit(BR_IF, None, self.slot(len(symbolic)))
+                for offset in range(arity):
+                    self.emit(MOVE, self.slot(height + offset), self.slot(len(symbolic) - arity + offset))
+                self.emit(BR, target)
+                self.entries[skip][1] = len(self.entries)
+                self.internal.add(skip)
+            else:
+                self.emit(BR_IF, target, condition)
+        elif op == RETURN:
+            arity = self.code.returnArity
+            self.emit(RETURN, tuple(symbolic[len(symbolic) - arity:]) if arity else ())
+            return False
+        else:
+            raise ValueError("Unsupported instruction in register lowering.")
+        return True
+
+
+def lowerCode(code, defaults):
+    """Lower the linked bytecode of one function. `defaults` are the initial values of its non-parameter locals"""
+    return RegisterLowering(code, defaults).lower()
@@ -165,6 +165,11 @@ class Scanner:
                 type = None
                 comparisonLiteral = literal
 
+                # Memory instructions are told apart by their full name (`i32.load8_s`, `memory.grow`, ...)
+                if literal in MEMORYINSTRUCTIONS:
+                    token = Token(literal, self.line, MEMORYINSTRUCTIONS[literal], literal)
+                    self.tokens.append(token)
+                    continue
                 # Check if there is a '.'
                 if comparisonLiteral.split(".")[0] != literal:
                     # If there is, split the string into two
@@ -1,6 +1,6 @@
 # Those KVPAIRS with a None entry are considered nonterminals 
-LPAREN, RPAREN, STR, INT, EOF, ID, MODULEFIELD, FUNC, GLOBAL, GET, OFFSET, GE_S, STORE, CALL_INDIRECT, BR, MEMORY, CALL, AND, TYPE, BR_IF, LOAD, SUB, RETURN, CONST, LOCAL, RESULT, MODULE, ALIGN, EXPORT, DROP, TEE, ADD, EQ, OR, EQZ, SET, LOOP, PARAM, END, EXTEND_I32_S, MUT, TABLE, LT_S, FUNCREF, VECTYPE, REFTYPE, EXTERNREF, I32, I64, F32, F64, BLOCK, BLOCKTYPE, IF, ELSE, IMPORT, GT_U = range(57)
-KVPAIRS = ['(', ')', None, None, None, None, None, 'func', 'global', 'get', 'offset', 'ge_s', 'store', 'call_indirect', 'br', 'memory', 'call', 'and', 'type', 'br_if', 'load', 'sub', 'return', 'const', 'local', 'result', 'module', 'align', 'export', 'drop', 'tee', 'add', 'eq', 'or', 'eqz', 'set', 'loop', 'param', 'end', 'extend_i32_s', 'mut', 'table', 'lt_s', 'funcref', 'v128', None, 'externref', 'i32', 'i64', 'f32', 'f64', 'block', None, 'if', 'else', 'import', 'gt_u']
+LPAREN, RPAREN, STR, INT, EOF, ID, MODULEFIELD, FUNC, GLOBAL, GET, OFFSET, GE_S, STORE, CALL_INDIRECT, BR, MEMORY, CALL, AND, TYPE, BR_IF, LOAD, SUB, RETURN, CONST, LOCAL, RESULT, MODULE, ALIGN, EXPORT, DROP, TEE, ADD, EQ, OR, EQZ, SET, LOOP, PARAM, END, EXTEND_I32_S, MUT, TABLE, LT_S, FUNCREF, VECTYPE, REFTYPE, EXTERNREF, I32, I64, F32, F64, BLOCK, BLOCKTYPE, IF, ELSE, IMPORT, GT_U, START = range(58)
+KVPAIRS = ['(', ')', None, None, None, None, None, 'func', 'global', 'get', 'offset', 'ge_s', 'store', 'call_indirect', 'br', 'memory', 'call', 'and', 'type', 'br_if', 'load', 'sub', 'return', 'const', 'local', 'result', 'module', 'align', 'export', 'drop', 'tee', 'add', 'eq', 'or', 'eqz', 'set', 'loop', 'param', 'end', 'extend_i32_s', 'mut', 'table', 'lt_s', 'funcref', 'v128', None, 'externref', 'i32', 'i64', 'f32', 'f64', 'block', None, 'if', 'else', 'import', 'gt_u', 'start']
 
 
 INSTRUCTION = 1489393
@@ -26,3 +26,60 @@ I64CONST = 162745309
 F32CONST = 162034309
 F64CONST = 162022309
 LABEL = 162026309
+
+# Memory instructions, which the scanner recognizes by their full name
+I32LOAD = 170045001
+I64LOAD = 170045002
+F32LOAD = 170045003
+F64LOAD = 170045004
+I32LOAD8_S = 170045005
+I32LOAD8_U = 170045006
+I32LOAD16_S = 170045007
+I32LOAD16_U = 170045008
+I64LOAD8_S = 170045009
+I64LOAD8_U = 170045010
+I64LOAD16_S = 170045011
+I64LOAD16_U = 170045012
+I64LOAD32_S = 170045013
+I64LOAD32_U = 170045014
+I32STORE = 170045015
+I64STORE = 170045016
+F32STORE = 170045017
+F64STORE = 170045018
+I32STORE8 = 170045019
+I32STORE16 = 170045020
+I64STORE8 = 170045021
+I64STORE16 = 170045022
+I64STORE32 = 170045023
+MEMORYSIZE = 170045024
+MEMORYGROW = 170045025
+MEMORYINSTRUCTIONS = {
+    'i32.load': I32LOAD, 'i64.load': I64LOAD, 'f32.load': F32LOAD, 'f64.load': F64LOAD,
+    'i32.load8_s': I32LOAD8_S, 'i32.load8_u': I32LOAD8_U, 'i32.load16_s': I32LOAD16_S, 'i32.load16_u': I32LOAD16_U,
+    'i64.load8_s': I64LOAD8_S, 'i64.load8_u': I64LOAD8_U, 'i64.load16_s': I64LOAD16_S, 'i64.load16_u': I64LOAD16_U,
+    'i64.load32_s': I64LOAD32_S, 'i64.load32_u': I64LOAD32_U,
+    'i32.store': I32STORE, 'i64.store': I64STORE, 'f32.store': F32STORE, 'f64.store': F64STORE,
+    'i32.store8': I32STORE8, 'i32.store16': I32STORE16, 'i64.store8': I64STORE8, 'i64.store16': I64STORE16,
+    'i64.store32': I64STORE32, 'memory.size': MEMORYSIZE, 'memory.grow': MEMORYGROW,
+}
+LOADS = {I32LOAD, I64LOAD, F32LOAD, F64LOAD, I32LOAD8_S, I32LOAD8_U, I32LOAD16_S, I32LOAD16_U,
+         I64LOAD8_S, I64LOAD8_U, I64LOAD16_S, I64LOAD16_U, I64LOAD32_S, I64LOAD32_U}
+STORES = {I32STORE, I64STORE, F32STORE, F64STORE, I32STORE8, I32STORE16, I64STORE8, I64STORE16, I64STORE32}
+
+# Superinstructions produced by fusion.py, each replacing a sequence of bytecode entries
+LOCALGET_CONST = 200000001
+LOCALGET_LOCALGET = 200000002
+LOCALGET_CONST_ADD = 200000003
+LOCALGET_LOCALGET_ADD = 200000004
+LOCALGET_ADD = 200000005
+LOCALGET_ADD_LOCALSET = 200000006
+CONST_ADD = 200000007
+ADD_LOCALSET = 200000008
+LOCALTEE_LOCALSET = 200000009
+LOCALGET_BR_IF = 200000010
+GE_S_BR_IF = 200000011
+LT_S_BR_IF = 200000012
+EQZ_BR_IF = 200000013
+
+# Register IR (register.py): copies a value from one register to another
+MOVE = 210000001
@@ -0,0 +1,55 @@
+class Stack:
+    """Stores elements that are processed in LIFO fashion (Last-In First-Out).
+    The top of the stack is the end of the underlying list, so push, pop and peek are amortized O(1)"""
+    __slots__ = ('stack',)
+
+    def __init__(self):
+        self.stack = []
+    def peek(self):
+        return self.stack[-1]
+    def pop(self):
+        return self.stack.pop()
+    def push(self, e):
+        self.stack.append(e)
+    def search(self, e):
+        if e in self.stack: return e
+        return None
+    def empty(self):
+        return not self.stack
+    def height(self):
+        return len(self.stack)
+    def clear(self):
+        self.stack.clear()
+
+class OperandStack(Stack):
+    """Holds the values produced and consumed by instructions"""
+    __slots__ = ()
+
+    def popValues(self, n):
+        """Pop the top n values, returned in the order they were pushed"""
+        if n == 0:
+            return []
+        values = self.stack[-n:]
+        del self.stack[-n:]
+        return values
+    def pushValues(self, values):
+        self.stack.extend(values)
+    def unwind(self, height, arity):
+        """Drop every value above `height`, keeping the top `arity` values as the results of the unwound construct"""
+        if arity:
+            results = self.stack[-arity:]
+            del self.stack[height:]
+            self.stack.extend(results)
+        else:
+            del self.stack[height:]
+
+class LabelStack(Stack):
+    """Holds the labels of the structured control instructions that are currently entered"""
+    __slots__ = ()
+
+class CallStack(Stack):
+    """Holds the activation frames of the functions that are currently executing"""
+    __slots__ = ()
+
+    def depth(self):
+        return len(self.stack)
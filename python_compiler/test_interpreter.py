@@ -0,0 +1,457 @@
+"""Regression tests for every execution tier and memory backend. Run from this directory with `python -m pytest`"""
+import pytest
+from scanner import Scanner
+from parser import Parser
+from settings import *
+from env import Trap
+from module import Module, TIERS
+from memory import MEMORYBACKENDS
+from interpeter import Interpreter
+from fusion import SUPERINSTRUCTIONS, selectPatterns
+from benchmark import CORPUS, loadModule
+
+
+def parse(source):
+    return Parser().parse(Scanner().scanTokens(source))
+
+
+def reference(path, name, n):
+    """The result of the AST walker, which every other tier must reproduce"""
+    return Module(loadModule(path), "ast").instantiate().callExtern(name, FUNC, n)
+
+
+@pytest.mark.parametrize("tier", TIERS)
+@pytest.mark.parametrize("path, name, arguments", CORPUS)
+def testCorpus(tier, path, name, arguments):
+    instance = Module(loadModule(path), tier).instantiate()
+    for n in arguments:
+        assert instance.callExtern(name, FUNC, n) == reference(path, name, n)
+        assert getattr(instance.exports, name)(n) == reference(path, name, n)
+
+
+@pytest.mark.parametrize("tier", TIERS)
+def testBranchToFunctionBody(tier):
+    instance = Module(loadModule("branch.wat"), tier).instantiate()
+    assert [instance.exports.pick(n) for n in (0, 1)] == [9, 5]
+    assert [instance.exports.first(n) for n in (0, 1)] == [1, 7]
+    assert [instance.exports.over(n) for n in (0, 1)] == [-3, 3]
+
+
+LOCALS = """(module
+  (type (;0;) (func (param i32) (result f64)))
+  (type (;1;) (func (param i32) (result i32)))
+  (func $float (type 0) (param i32) (result f64)
+    (local f64)
+    local.get 1)
+  (func $int (type 1) (param i32) (result i32)
+    (local f32 i32)
+    local.get 2)
+  (func $both (type 0) (param i32) (result f64)
+    local.get 0
+    call $int
+    drop
+    local.get 0
+    call $float)
+  (export "float" (func $float))
+  (export "int" (func $int))
+  (export "both" (func $both))
+)"""
+
+
+@pytest.mark.parametrize("tier", TIERS)
+def testLocalDefaults(tier):
+    """Float locals start at 0.0 and integer locals at 0 on every tier, in called functions too"""
+    instance = Module(parse(LOCALS), tier).instantiate()
+    results = (instance.exports.float(1), instance.exports.int(1), instance.exports.both(1))
+    assert results == (0.0, 0, 0.0)
+    assert [type(result) for result in results] == [float, int, float]
+
+
+@pytest.mark.parametrize("tier", TIERS)
+@pytest.mark.parametrize("backend", MEMORYBACKENDS)
+def testMemory(tier, backend):
+    instance = Module(loadModule("memory.wat"), tier).instantiate(memoryBackend=backend)
+    assert instance.exports.checksum(1000) == 500500
+    assert instance.memory.read(4, 4) == (1).to_bytes(4, "little")
+
+
+@pytest.mark.parametrize("tier", TIERS)
+@pytest.mark.parametrize("backend", MEMORYBACKENDS)
+def testOutOfBounds(tier, backend):
+    instance = Module(loadModule("memory.wat"), tier).instantiate(memoryBackend=backend)
+    with pytest.raises(Trap):
+        instance.exports.checksum(20000)
+    # The trap leaves nothing behind, so the instance keeps working
+    assert instance.stack.height() == 0
+    assert instance.exports.checksum(10) == 55
+
+
+@pytest.mark.parametrize("tier", ("bytecode", "register"))
+@pytest.mark.parametrize("memoize", (False, True))
+def testHeapFrameDepth(tier, memoize):
+    """The flat loops keep guest calls off the Python stack, memoized ones included"""
+    instance = Module(loadModule("depth.wat"), tier, memoize=memoize).instantiate(maxCallDepth=6000)
+    assert instance.callExtern("depth", FUNC, 5000) == 5000
+    assert instance.stack.height() == 0
+    shallow = Module(loadModule("depth.wat"), tier, memoize=memoize).instantiate(maxCallDepth=100)
+    with pytest.raises(Trap):
+        shallow.callExtern("depth", FUNC, 5000)
+    assert (shallow.stack.height(), shallow.frames.depth()) == (0, 0)
+    assert shallow.exports.depth(50) == 50
+
+
+@pytest.mark.parametrize("tier", ("bytecode", "register"))
+def testMemoizedResults(tier):
+    instance = Module(loadModule(), tier, memoize=True).instantiate()
+    assert instance.exports.fib(20) == 6765
+    stats = instance.resultCache("fib").stats()
+    # Every distinct argument missed once and was stored when its frame returned
+    assert stats["size"] == stats["misses"] and stats["hits"] > 0
+
+
+def testErrorsLeaveStacksClean():
+    """Errors other than traps, such as Python's recursion limit on the AST walker, also discard the call"""
+    instance = Module(loadModule("depth.wat"), "ast").instantiate()
+    with pytest.raises(RecursionError):
+        instance.callExtern("depth", FUNC, 100000)
+    assert (instance.stack.height(), instance.frames.depth(), instance.labels.height()) == (0, 0, 0)
+    assert instance.callExtern("depth", FUNC, 10) == 10
+
+
+START = """(module
+  (type (;0;) (func (param i32) (result i32)))
+  (memory (;0;) 4)
+  {before}
+  (func $init
+    i32.const 70000
+    i32.const 42
+    i32.store)
+  (func $get (type 0) (param i32) (result i32)
+    local.get 0
+    i32.load)
+  {after}
+)"""
+EXPORTGET = '(export "get" (func $get))'
+
+
+@pytest.mark.parametrize("tier", TIERS)
+@pytest.mark.parametrize("start", ("(start $init)", "(start 0)"))
+@pytest.mark.parametrize("first", (True, False))
+def testStartFunction(tier, start, first):
+    """The start function runs whichever side of its definition the start field is on"""
+    fields = start + "\n  " + EXPORTGET
+    source = START.format(before=fields, after="") if first else START.format(before="", after=fields)
+    instance = Module(parse(source), tier).instantiate()
+    assert instance.exports.get(70000) == 42
+
+
+def testUnknownStartFunction():
+    with pytest.raises(ValueError):
+        parse(START.format(before="", after="(start $missing)"))
+
+
+def fusedResults(path, name, arguments, patterns):
+    module = Module(loadModule(path), "bytecode", superinstructions=patterns)
+    instance = module.instantiate()
+    return module, [instance.callExtern(name, FUNC, n) for n in arguments]
+
+
+@pytest.mark.parametrize("pattern", list(SUPERINSTRUCTIONS))
+@pytest.mark.parametrize("path, name, arguments", CORPUS)
+def testSuperinstruction(pattern, path, name, arguments):
+    module, results = fusedResults(path, name, arguments, [pattern])
+    assert results == [reference(path, name, n) for n in arguments]
+
+
+@pytest.mark.parametrize("pattern", list(SUPERINSTRUCTIONS))
+def testEveryPatternFuses(pattern):
+    """Some corpus function contains every pattern, so each fused handler runs in testSuperinstruction"""
+    fusedOp = SUPERINSTRUCTIONS[pattern][0]
+    assert any(fusedOp in (op for op, imm in function.code.entries)
+               for path in {path for path, name, arguments in CORPUS}
+               for function in fusedResults(path, None, (), [pattern])[0].functions.values())
+
+
+@pytest.mark.parametrize("path, name, arguments", CORPUS)
+def testProfiledFusion(path, name, arguments):
+    """The superinstructions chosen from a profile of the workload itself give the same results in fewer entries"""
+    profiler = Interpreter(tier="bytecode", profileOpcodes=True)
+    instance = profiler.instantiate(loadModule(path))
+    expected = [instance.callExtern(name, FUNC, n) for n in arguments]
+    patterns = selectPatterns(profiler.opcodeProfile)
+    assert patterns
+    module, results = fusedResults(path, name, arguments, patterns)
+    assert results == expected
+    funcidx = module.exportIndex(name)
+    assert len(module.functions[funcidx].code) < len(instance.module.functions[funcidx].code)
+
+
+PEEPHOLE = """(module
+  (type (;0;) (func (param i32) (result i32)))
+  (func $run (type 0) (param i32) (result i32)
+    {body})
+  (export "run" (func $run))
+)"""
+# Pass name -> function body the pass rewrites, and the number of instructions it removes
+PASSBODIES = {
+    "fold": (
+        """i32.const 7
+    i32.const 3
+    i32.sub
+    i32.const -1
+    i32.const 3
+    i32.gt_u
+    i32.add
+    local.get 0
+    i32.add""", 6),
+    "identity": (
+        """local.get 0
+    i32.const 0
+    i32.add
+    i32.const -1
+    i32.and
+    i32.const 0
+    i32.sub
+    i32.const 0
+    i32.or
+    i32.const 9
+    drop""", 10),
+    "tee": (
+        """(local i32)
+    local.get 0
+    i32.const 2
+    i32.add
+    local.set 1
+    local.get 1
+    local.get 1
+    i32.add""", 1),
+    "unreachable": (
+        """block
+      br 0
+      i32.const 3
+      drop
+    end
+    block
+      local.get 0
+      br_if 0
+      i32.const 1
+      return
+      i32.const 2
+      drop
+    end
+    local.get 0
+    return
+    local.get 0
+    drop""", 6),
+}
+
+
+@pytest.mark.parametrize("tier", TIERS)
+@pytest.mark.parametrize("name", PASSBODIES)
+def testPeephole(tier, name):
+    """Each pass removes what it should, alone and with the others, without changing results"""
+    from optimizer import Optimizer
+    body, removed = PASSBODIES[name]
+    ast = parse(PEEPHOLE.format(body=body))
+    arguments = (0, 1, -1, 5, 1 << 30)
+    unoptimized = Module(ast, "ast").instantiate()
+    expected = [unoptimized.exports.run(n) for n in arguments]
+    single = Optimizer(passes=[name])
+    instance = Module(single.optimize(ast), tier).instantiate()
+    assert single.stats == {name: removed}
+    assert [instance.exports.run(n) for n in arguments] == expected
+    instance = Module(Optimizer().optimize(ast), tier).instantiate()
+    assert [instance.exports.run(n) for n in arguments] == expected
+
+
+@pytest.mark.parametrize("tier", TIERS)
+def testCompileOptionsOnInstantiate(tier):
+    module = Module(loadModule(), tier, memoize=True)
+    # Repeating the module's compile options is allowed, changing them is not
+    assert module.instantiate(memoize=True, cacheSize=1024).exports.fib(10) == 55
+    with pytest.raises(ValueError):
+        module.instantiate(memoize=False)
+    with pytest.raises(ValueError):
+        module.instantiate(superinstructions=[(LOCALGET, CONST)])
+
+
+@pytest.mark.parametrize("backend", MEMORYBACKENDS)
+def testSharedClosures(backend):
+    """Instances of a closure-tier module share its closures but not their memory or result caches"""
+    module = Module(loadModule("memory.wat"), "closure", memoize=True)
+    first, second = module.instantiate(memoryBackend=backend), module.instantiate(memoryBackend=backend)
+    assert first.closures is second.closures is module.closures
+    assert first.exports.checksum(100) == 5050
+    first.memory.write(4, (9).to_bytes(4, "little"))
+    assert first.memory.read(4, 4) != second.memory.read(4, 4)
+    assert second.exports.checksum(10) == 55
+    fib = Module(loadModule(), "closure", memoize=True)
+    instance = fib.instantiate()
+    assert instance.exports.fib(15) == 610 and fib.instantiate().resultCache("fib").stats()["size"] == 0
+
+
+def testJitCodeCache():
+    """Identical sources compile once, and only the most recent ones are kept"""
+    import jit
+    jit.compileSource.cache_clear()
+    Module(loadModule(), "jit")
+    compiled = jit.compileSource.cache_info()
+    assert Module(loadModule(), "jit").instantiate().exports.fib(10) == 55
+    info = jit.compileSource.cache_info()
+    assert info.hits > compiled.hits and info.currsize == compiled.currsize
+    assert info.maxsize == jit.CODECACHESIZE
+
+
+def testOpcodeProfile():
+    """Profiling records every executed opcode, callees included, without touching the module's shared bytecode"""
+    profiler = Interpreter(tier="bytecode", profileOpcodes=True)
+    instance = profiler.instantiate(loadModule("depth.wat"))
+    assert instance.exports.depth(50) == 50
+    profile = profiler.opcodeProfile
+    assert profile.bigrams[(ADD, CALL)] == profile.bigrams[(CALL, LOCALGET)] == 50
+    assert sum(profile.bigrams.values()) == sum(profile.trigrams.values()) + 1
+    assert all(type(function.code.entries) is list for function in instance.module.functions.values())
+    assert Module(loadModule("depth.wat"), "bytecode").instantiate().exports.depth(50) == 50
+
+
+@pytest.mark.parametrize("tier", TIERS)
+@pytest.mark.parametrize("memoize", (False, True))
+def testConcurrentCalls(tier, memoize):
+    """Threads sharing one instance each run on their own stacks, through callExtern, exports and invokeMany"""
+    import random
+    import sys
+    import threading
+    fib = [0, 1]
+    while len(fib) < 12:
+        fib.append(fib[-1] + fib[-2])
+    instance = Module(loadModule(), tier, memoize=memoize, cacheSize=4).instantiate()
+    failures = []
+    def worker(seed):
+        rng = random.Random(seed)
+        for i in range(30):
+            n = rng.randrange(12)
+            try:
+                if i % 3 == 0:
+                    result = instance.callExtern("fib", FUNC, n)
+                elif i % 3 == 1:
+                    result = instance.exports.fib(n)
+                else:
+                    result = instance.invokeMany("fib", [(n,)], asList=True)[0]
+            except Exception as error:
+                failures.append(repr(error))
+                continue
+            if result != fib[n]:
+                failures.append((n, result))
+    # Switch threads as often as possible so unsafe interleavings show up
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert failures == []
+    assert instance.stack.height() == 0
+
+
+def testRunnerOptions():
+    from parallel import ParallelRunner, SubinterpreterRunner
+    with open("fib.wat", 'r', encoding='utf-8') as file:
+        source = file.read()
+    arguments = [(n,) for n in range(12)]
+    expected = [Module(loadModule(), "register").instantiate().exports.fib(n) for n in range(12)]
+    with ParallelRunner(source, workers=1, chunkSize=4, memoize=True, maxCallDepth=1000) as runner:
+        assert list(runner.map("fib", arguments)) == expected
+    with SubinterpreterRunner(source, workers=2, chunkSize=4, isolated=False, memoize=True) as runner:
+        assert list(runner.map("fib", arguments)) == expected
+        assert runner.slots[0].module.memoize
+
+
+@pytest.mark.parametrize("tier", TIERS)
+@pytest.mark.parametrize("path, name, arguments", CORPUS)
+def testLockstep(tier, path, name, arguments):
+    """Lockstep results match the scalar tiers, including lanes that branch differently"""
+    np = pytest.importorskip("numpy")
+    module = Module(loadModule(path), tier)
+    # Nothing is analyzed for lockstep execution until a vectorized call needs it
+    assert module.lockstepRunner is None
+    instance = module.instantiate()
+    expected = [instance.callExtern(name, FUNC, n) for n in arguments]
+    assert instance.invokeVectorized(name, np.array(arguments)).tolist() == expected
+    assert instance.invokeVectorized(name, np.array(arguments), chunkSize=2).tolist() == expected
+    # Functions with calls are left to the scalar tiers
+    calls = path in ("fib.wat", "depth.wat")
+    assert (module.exportIndex(name) in module.lockstep().functions) is not calls
+    assert instance.stack.height() == 0
+
+
+@pytest.mark.parametrize("tier", TIERS)
+@pytest.mark.parametrize("backend", MEMORYBACKENDS)
+def testSnapshotSpawn(tier, backend):
+    from benchmark import initializedModule
+    module = Module(parse(initializedModule(4, 256)), tier)
+    snapshot = module.instantiate(memoryBackend=backend).snapshot()
+    first, second = snapshot.spawn(), snapshot.spawn()
+    assert first.exports.get(256) == 256 and first.exports.get(4 * 65536 - 256) == 4 * 65536 - 256
+    # Spawned instances share nothing they write
+    first.memory.write(256, (1).to_bytes(4, "little"))
+    assert (first.exports.get(256), second.exports.get(256), snapshot.spawn().exports.get(256)) == (1, 256, 256)
+    assert first.memory.grow(2) == 4
+    assert first.exports.get(256) == 1 and first.exports.get(5 * 65536) == 0
+    if backend == "sparse":
+        assert first.memory.committed() == 1 and second.memory.committed() == 0
+    if backend == "mmap":
+        # Growing moved the first memory out of the snapshot's copy-on-write mapping
+        assert (first.memory.copyOnWrite, second.memory.copyOnWrite) == (False, True)
+
+
+@pytest.mark.parametrize("backend", MEMORYBACKENDS)
+def testArraysAfterGrow(backend):
+    """Arrays over memory that growing moved refuse writes instead of losing them"""
+    pytest.importorskip("numpy")
+    instance = Module(loadModule("memory.wat"), "register").instantiate(memoryBackend=backend)
+    array = instance.arrayView(0, 4)
+    array[1] = 7
+    assert instance.exports.checksum(0) == 0 and instance.memory.read(4, 1) == b"\x07"
+    instance.memory.grow(1)
+    if backend == "sparse":
+        # Sparse pages never move, so the array still writes to the memory
+        array[1] = 8
+        assert instance.memory.read(4, 1) == b"\x08"
+    else:
+        with pytest.raises(ValueError):
+            array[1] = 8
+    fresh = instance.arrayView(0, 4)
+    fresh[1] = 9
+    assert instance.memory.read(4, 1) == b"\x09"
+
+
+def testSubinterpreterRunnerDefault():
+    """Sub-interpreters are used whenever this Python has them, host threads otherwise"""
+    from parallel import SubinterpreterRunner, subinterpretersAvailable
+    with open("fib.wat", 'r', encoding='utf-8') as file:
+        source = file.read()
+    with SubinterpreterRunner(source, workers=2, chunkSize=2) as runner:
+        assert runner.isolated is subinterpretersAvailable()
+        assert list(runner.map("fib", [(n,) for n in range(6)])) == [0, 1, 1, 2, 3, 5]
+
+
+def testIsolationUnavailable():
+    from parallel import SubinterpreterRunner, subinterpretersAvailable
+    if subinterpretersAvailable():
+        pytest.skip("this Python has sub-interpreters")
+    with pytest.raises(ValueError):
+        SubinterpreterRunner("(module)", isolated=True)
+
+
+def testIsolatedSubinterpreterRunner():
+    pytest.importorskip("concurrent.interpreters", reason="sub-interpreters need CPython 3.14+")
+    from parallel import SubinterpreterRunner
+    with open("fib.wat", 'r', encoding='utf-8') as file:
+        source = file.read()
+    with SubinterpreterRunner(source, workers=2, chunkSize=2, isolated=True, memoize=True) as runner:
+        assert runner.isolated is True and runner.module is None
+        assert list(runner.map("fib", [(n,) for n in range(12)])) == [0, 1, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89]
@@ -0,0 +1,21 @@
+(module
+  (type (;0;) (func (param i32) (result i32)))
+  (func $wrap (type 0) (param i32) (result i32)
+    local.get 0  ;; i32.add wraps, so 4 * 2^30 compares as 0
+    local.get 0
+    i32.add
+    local.get 0
+    i32.add
+    local.get 0
+    i32.add
+    i32.const 0
+    i32.gt_u)
+  (func $above (type 0) (param i32) (result i32)
+    local.get 0  ;; negative arguments are large unsigned values
+    i32.const -2
+    i32.add
+    i32.const 3
+    i32.gt_u)
+  (export "wrap" (func $wrap))
+  (export "above" (func $above))
+)
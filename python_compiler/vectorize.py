@@ -0,0 +1,192 @@
+"""Lockstep execution of one function over many inputs. Every local and operand stack slot holds a NumPy array with
+one lane per invocation, so each instruction is executed once for the whole batch:
+
+    instance.invokeVectorized("sum", numpy.arange(1000000) % 100)
+
+Lanes only diverge at `br_if`. A boolean mask tracks the lanes still running at each point: lanes taking a branch
+leave the mask and rejoin it at the branch target, lanes returning store their results and drop out, and writes to
+locals only reach the lanes in the mask. A loop runs again as long as any lane branched back to its head.
+
+Only straight-line and loop-bounded functions run this way: pure (see `purity.analyzePurity`), without calls and with
+integer locals only. Running a call tree lane-wise costs a Python call per guest call, which is slower than the scalar
+tiers, so calls, memory accesses and float locals are left to them. Lanes hold int64 values, so results match the scalar
+interpreter as long as no intermediate value leaves the int64 range."""
+from settings import *
+from bytecode import localIndex, toUnsigned
+from purity import analyzePurity
+from memory import numpy
+
+
+def vectorizable(ast):
+    """Indices of the functions that can run in lockstep: pure functions without calls, with integer locals"""
+    pure = analyzePurity(ast)
+    for field in ast['fields']:
+        if field['type'] == FUNC and field['id'] in pure:
+            if any(local['type'] in (F32, F64) for local in field['frame'].locals.values()) or hasCalls(field['instr']):
+                pure.discard(field['id'])
+    return pure
+
+
+def hasCalls(instructions):
+    for instruction in instructions:
+        if instruction['type'] == CALL:
+            return True
+        if (instruction['type'] == BLOCK or instruction['type'] == LOOP) and hasCalls(instruction['instructions']):
+            return True
+    return False
+
+
+# Lane-wise versions of the binary instructions, filled in on first use so NumPy is only imported when needed
+OPERATIONS = {}
+
+
+def binaryOperations(np):
+    """Lane-wise versions of the binary instructions, following the scalar interpreter's semantics"""
+    if OPERATIONS:
+        return OPERATIONS
+    OPERATIONS.update({
+        ADD: np.add,
+        SUB: np.subtract,
+        AND: np.bitwise_and,
+        # `int(a or b)` is a when a is non-zero, otherwise b
+        OR: lambda first, second: np.where(first != 0, first, second),
+        EQ: lambda first, second: (first == second).astype(np.int64),
+        GE_S: lambda first, second: (first >= second).astype(np.int64),
+        LT_S: lambda first, second: (first < second).astype(np.int64),
+        GT_U: lambda first, second: (toUnsigned(first) > toUnsigned(second)).astype(np.int64),
+    })
+    return OPERATIONS
+
+
+class LaneFrame:
+    """The activation of a function for a set of lanes"""
+    __slots__ = ('locals', 'stack', 'labels', 'results')
+
+    def __init__(self, locals, results):
+        self.locals = locals
+        self.stack = []
+        # For every entered block or loop, the mask of the lanes that branched to it
+        self.labels = []
+        # Results of the lanes that returned so far
+        self.results = results
+
+
+class Lockstep:
+    """Runs the `functions` of a parsed module in lockstep. Instructions are translated once into (opcode, immediate)
+    pairs with their locals resolved; the runner keeps no state between calls"""
+
+    def __init__(self, ast, functions):
+        self.functions = set(functions)
+        self.bodies = {}
+        self.shapes = {}
+        for field in ast['fields']:
+            if field['type'] == FUNC and field['id'] in self.functions:
+                frame = field['frame']
+                self.bodies[field['id']] = self.translate(field['instr'], frame)
+                self.shapes[field['id']] = (frame.argArity(), len(frame.locals), frame.returnArity())
+
+    def translate(self, instructions, frame):
+        translated = []
+        for instruction in instructions:
+            type = instruction['type']
+            if type == BLOCK or type == LOOP:
+                imm = self.translate(instruction['instructions'], frame)
+            elif type == LOCALGET or type == LOCALSET or type == LOCALTEE:
+                imm = localIndex(frame, instruction['operand'])
+            elif type == CONST or type == BR or type == BR_IF:
+                imm = int(instruction['operand'])
+            else:
+                imm = None
+            translated.append((type, imm))
+        return translated
+
+    def run(self, funcidx, columns):
+        """Call a function once per lane. `columns` holds one int64 array per parameter, all of the same length.
+        Returns the list of result arrays"""
+        np = numpy()
+        paramCount, localCount, returnArity = self.shapes[funcidx]
+        lanes = len(columns[0])
+        mask = np.ones(lanes, dtype=bool)
+        locals = list(columns) + [np.zeros(lanes, dtype=np.int64) for _ in range(localCount - paramCount)]
+        frame = LaneFrame(locals, [np.zeros(lanes, dtype=np.int64) for _ in range(returnArity)])
+        fallthrough = self.runSequence(frame, self.bodies[funcidx], mask)
+        if fallthrough.any():
+            self.returnLanes(frame, fallthrough)
+        return frame.results
+
+    def returnLanes(self, frame, mask):
+        """Store the results on top of the stack for the lanes in `mask`"""
+        stack = frame.stack
+        arity = len(frame.results)
+        for k, value in enumerate(stack[len(stack) - arity:]):
+            frame.results[k] = numpy().where(mask, value, frame.results[k])
+
+    def branch(self, frame, depth, mask):
+        if depth == len(frame.labels):
+            # Branching to the function body itself returns
+            self.returnLanes(frame, mask)
+        else:
+            labels = frame.labels
+            labels[-1 - depth] = labels[-1 - depth] | mask
+
+    def runSequence(self, frame, instructions, mask):
+        """Run an instruction sequence for the lanes in `mask`. Returns the mask of the lanes reaching its end"""
+        np = numpy()
+        stack = frame.stack
+        locals = frame.locals
+        operations = binaryOperations(np)
+        for op, imm in instructions:
+            if op == LOCALGET:
+                stack.append(locals[imm])
+            elif op == CONST:
+                stack.append(np.int64(imm))
+            elif op in operations:
+                second = stack.pop()
+                stack[-1] = operations[op](stack[-1], second)
+            elif op == LOCALSET:
+                locals[imm] = np.where(mask, stack.pop(), locals[imm])
+            elif op == LOCALTEE:
+                locals[imm] = np.where(mask, stack[-1], locals[imm])
+            elif op == EQZ:
+                stack[-1] = (stack[-1] == 0).astype(np.int64)
+            elif op == DROP:
+                stack.pop()
+            elif op == BR_IF:
+                condition = stack.pop()
+                taken = mask & (condition != 0)
+                if taken.any():
+                    self.branch(frame, imm, taken)
+                    mask = mask & ~taken
+                    if not mask.any():
+                        return mask
+            elif op == BR:
+                self.branch(frame, imm, mask)
+                return np.zeros_like(mask)
+            elif op == RETURN:
+                self.returnLanes(frame, mask)
+                return np.zeros_like(mask)
+            elif op == BLOCK:
+                height = len(stack)
+                frame.labels.append(np.zeros_like(mask))
+                fallthrough = self.runSequence(frame, imm, mask)
+                del stack[height:]
+                mask = fallthrough | frame.labels.pop()
+                if not mask.any():
+                    return mask
+            elif op == LOOP:
+                height = len(stack)
+                exits = np.zeros_like(mask)
+                while True:
+                    frame.labels.append(np.zeros_like(mask))
+                    exits |= self.runSequence(frame, imm, mask)
+                    mask = frame.labels.pop()
+                    del stack[height:]
+                    # Lanes that branched back to the head run the body again
+                    if not mask.any():
+                        break
+                mask = exits
+                if not mask.any():
+                    return mask
+            else:
+                raise ValueError("Unsupported instruction in lockstep execution.")
+        return mask